@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from checkmk import Checkmk
+
+
+# Activation manager
+#
+# Scripts that make many changes activate once at the end instead of after every batch: they count their batches with
+# add() and call activate() (or leave the with block, which activates if any batch was added). add() sends nothing and
+# is only a counter; the coalescing is that the caller does not activate per batch. activate() can skip the activation
+# if nothing is pending and waits (polling with backoff) until it is finished.
+
+
+class ActivationManager:
+    def __init__(self, cmk: Checkmk, force_foreign_changes=False, poll_interval=0.5, max_poll_interval=10.0, timeout=None):
+        self.cmk = cmk
+        self.force_foreign_changes = force_foreign_changes
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Activate once for all batches of the with block (not if it failed)
+        if exc_type is None and self.batches:
+            self.activate()
+
+    def add(self, batches=1):
+        '''Count batches of changes that the next activation covers (reported as batches in its summary, and the with
+        block activates on exit only if batches were added). Nothing is sent or deferred here.'''
+        with self.lock:
+            self.batches += batches
+
+    def pending_changes(self):
+        'Return (list of pending changes, etag of the pending changes)'
+        res = self.cmk.get_pending_changes()
+        if not res.ok():
+            raise Exception(f'Pending changes query failed ({res.res.status_code})!')
+        return res.json().get('value', []), res.res.headers.get('etag')
+
+    def activate(self, wait=True, only_if_pending=True) -> dict:
+        '''Activate all pending changes with one activation.
+        only_if_pending skips the activation when check mk has no pending changes, wait polls until the activation is finished.
+        Returns a summary {'activation_id', 'changes', 'batches', 'skipped', 'duration'}.'''
+        start = time.monotonic()
+        with self.lock:
+            batches, self.batches = self.batches, 0
+
+        changes, etag = None, None
+        if only_if_pending:
+            pending, etag = self.pending_changes()
+            changes = len(pending)
+            if not pending:
+                logging.debug('No pending changes, activation skipped')
+                return {'activation_id': None, 'changes': 0, 'batches': batches, 'skipped': True, 'duration': time.monotonic() - start}
+
+        res = self.cmk.activate_changes(self.force_foreign_changes, etag=etag)
+        if res.res.status_code not in (200, 201, 202):
+            raise Exception(f'Activation failed ({res.res.status_code}): {res.res.text}')
+        activation_id = res.json().get('id')
+
+        if wait and activation_id is not None:
+            self.wait(activation_id, start)
+
+        return {'activation_id': activation_id, 'changes': changes, 'batches': batches, 'skipped': False,
+                'duration': time.monotonic() - start}
+
+    def wait(self, activation_id: str, start=None):
+        'Poll activation status with backoff until it is no longer running'
+        start = start if start is not None else time.monotonic()
+        interval = self.poll_interval
+        while True:
+            res = self.cmk.get_activation_status(activation_id)
+            if not res.ok():
+                raise Exception(f'Activation status query failed ({res.res.status_code})!')
+            if not res.json().get('extensions', {}).get('is_running', False):
+                return
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                raise TimeoutError(f'Activation {activation_id} still running after {self.timeout}s')
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import logging
+import time
+import httpx
+import transport
+from checkmk import CheckmkRequests, BulkDiscoveryPoll, bulk_discovery_outcome, bulk_results, chunked, folder_id, json_dumps, \
+    json_result, merge_results
+
+
+# asyncio variant of Checkmk
+#
+# AsyncCheckmk has the same methods as Checkmk, but every method that talks to check mk is a coroutine
+# (bulk_create_hosts, bulk_update_hosts and bulk_delete_hosts are async generators). All requests share one
+# httpx connection pool of transport.pool_size connections.
+#
+#   async with create_checkmk(use_async=True) as cmk:
+#       results = await gather_bounded(lambda h: cmk.update_host_tag(h, 'tag_env', 'prod'), hostnames, limit=50)
+#
+# Methods that are only a single rest_query call (get_tag_group, get_all_hosts, activate_changes, ...) come from the
+# shared request layer CheckmkRequests: they return the coroutine of the async rest_query. Everything that reads a
+# response is implemented here; sync only helpers of Checkmk (iter_all_hosts_sharded, get_folder_hosts) do not exist
+# on AsyncCheckmk.
+
+
+async def gather_bounded(fn, items, limit=10) -> list:
+    'await fn(item) for all items with at most limit running at once. Results are in input order.'
+    sem = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with sem:
+            return await fn(item)
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+class AsyncCheckmk(CheckmkRequests):
+    def __init__(self, url, ca_cert, bearerAuth, site_name, log_body_limit=None, transport_config=None):
+        super().__init__(url, ca_cert, bearerAuth, site_name, log_body_limit, transport_config)
+        if self.transport.rate:
+            self.limiter = transport.AsyncTokenBucket(self.transport.rate, self.transport.burst)
+
+    async def __aenter__(self):
+        self.open_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def open_session(self):
+        'Create check MK session (httpx.AsyncClient with a shared connection pool)'
+        limits = httpx.Limits(max_connections=self.transport.pool_size, max_keepalive_connections=self.transport.pool_size)
+        self.session = httpx.AsyncClient(
+            headers={'Authorization': f'Bearer {self.username} {self.secret}',
+                     'accept': 'application/json', 'Content-Type': 'application/json'},
+            verify=self.ca_cert if self.ca_cert else True, limits=limits)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.aclose()
+            self.session = None
+
+    def log_pre(self, pre):
+        'Log prepared requst'
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        logging.debug('Prepared request:')
+        logging.debug('URL: %s', pre.url)
+        logging.debug('BODY: %s', self.truncate(pre.content.decode('utf-8', errors='replace')))
+        logging.debug('HEADERS: %s', pre.headers)
+
+    def log_response(self, res, body=True):
+        'Log response objects'
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        logging.debug('Response:')
+        logging.debug('res.status_code: %s', res.status_code)
+        logging.debug('RESPONSE BODY: ')
+        logging.debug('%s', self.truncate(res.text) if res.content else 'No returned data')
+        logging.debug('RESPONSE HEADERS: %s', res.headers)
+
+    async def rest_query(self, url_action, req_type='GET', data=None, header=None, send=True, timeout=None, stream=False):
+        'execute rest query (timeout in seconds, None uses the transport default; bodies are always read, stream is ignored)'
+        if self.session is None:
+            raise Exception('Check MK session is not opened')
+
+        timeout = timeout if timeout is not None else self.transport.timeout
+        pre = self.session.build_request(req_type, self.url + url_action, content=data, headers=header, timeout=timeout)
+        self.log_pre(pre)
+
+        if not send:
+            return None
+
+        if self.metrics is None:
+            res = await transport.async_send(self.session, pre, self.transport, self.limiter)
+        else:
+            retries = []
+            start = time.perf_counter()
+            try:
+                res = await transport.async_send(self.session, pre, self.transport, self.limiter, on_retry=retries.append)
+            except Exception:
+                self.metrics.record(req_type, url_action, None, time.perf_counter() - start, 0, len(retries), self.site_name)
+                raise
+            self.metrics.record(req_type, url_action, res.status_code, time.perf_counter() - start, len(res.content), len(retries),
+                                self.site_name)
+        self.log_response(res)
+        return json_result(res, metrics=self.metrics)
+
+    async def discover_service(self, hostname: str, mode: str, send=True, timeout=None):
+        'Discover services on a single check mk host'
+        assert mode in ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']
+        data = json.dumps({'mode': mode})
+        print(f'{hostname} {mode}')
+        url = f'/objects/host/{hostname}/actions/discover_services/invoke'
+        try:
+            return await self.rest_query(url, req_type='POST', data=data, send=send, timeout=timeout)
+        except httpx.TimeoutException:
+            # Don't let one slow host abort the discovery of all other hosts
+            logging.error(f'{hostname} {mode}: timed out after {timeout}s')
+            return None
+
+    async def discover_services(self, hostnames: list, mode: str, send=True, workers=10, timeout=None) -> list:
+        'Discover services on check mk hosts, at most workers at once. Results are in the same order as hostnames.'
+        assert mode in ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']
+        return await gather_bounded(lambda host: self.discover_service(host, mode, send, timeout), hostnames, workers)
+
+    async def discover_fixall(self, hostnames: list, send=True, workers=10, timeout=None) -> list:
+        'Fix all services on check mk hosts (refresh and then fix_all per host)'
+        async def refresh_fixall(host):
+            return (await self.discover_service(host, 'refresh', send, timeout),
+                    await self.discover_service(host, 'fix_all', send, timeout))
+
+        res = await gather_bounded(refresh_fixall, hostnames, workers)
+        return [r[0] for r in res] + [r[1] for r in res]
+
+    async def bulk_discover(self, hostnames: list, mode: str, batch_size=10, do_full_scan=True, ignore_errors=True,
+                            poll_interval=1.0, max_poll_interval=30.0, timeout=None, progress=print) -> dict:
+        'Discover services on check mk hosts with one server side background job (see Checkmk.bulk_discover)'
+        res = await self.start_bulk_discovery(hostnames, mode, batch_size, do_full_scan, ignore_errors)
+        if not res.ok():
+            raise Exception(f'Bulk discovery could not be started ({res.res.status_code}): {res.res.text}')
+
+        job_id = res.json().get('id', 'bulk_discovery')
+        start = time.monotonic()
+        poll = BulkDiscoveryPoll(poll_interval, max_poll_interval, progress)
+
+        while poll.update(await self.get_bulk_discovery_status(job_id)):
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'Bulk discovery job {job_id} still running after {timeout}s')
+            await asyncio.sleep(poll.interval)
+
+        return bulk_discovery_outcome(hostnames, poll.state, poll.lines)
+
+    async def get_host(self, hostname: str, get_effective_attributes: bool, send=True):
+        'Get host info'
+        eff_str = '?effective_attributes=true' if get_effective_attributes else ''
+        url = f'/objects/host_config/{hostname}{eff_str}'
+        return self.remember_etag(hostname, await self.rest_query(url, req_type='GET', send=send))
+
+    async def get_host_if_changed(self, hostname: str, etag: str, send=True):
+        'Conditional GET of a host (If-None-Match): status 304 without body if its etag is still etag'
+        url = f'/objects/host_config/{hostname}'
+        res = await self.rest_query(url, req_type='GET', header={'If-None-Match': etag}, send=send)
+        return res if res is None or res.res.status_code == 304 else self.remember_etag(hostname, res)
+
+    async def get_etag(self, hostname: str) -> str:
+        'Get host etag (value that changes on every modification of check mk host)'
+        json_result = await self.get_host(hostname, False)
+        return '' if json_result is None else json_result.res.headers.get('etag', '')
+
+    async def cached_etag(self, hostname: str) -> str:
+        'Get host etag from the etag cache, fetch it (GET) if host is not cached'
+        with self.etags_lock:
+            etag = self.etags.get(hostname)
+        return etag if etag is not None else await self.get_etag(hostname)
+
+    async def update_host_cached(self, hostname: str, data: str, send=True):
+        'Update a checkmk host using the cached etag, refetch it and retry once on 412 Precondition Failed'
+        res = await self.update_host(hostname, data, await self.cached_etag(hostname), send)
+        if res is not None and res.res.status_code == 412:
+            logging.debug(f'{hostname}: cached etag is stale, refetching')
+            self.forget_etag(hostname)
+            res = await self.update_host(hostname, data, await self.get_etag(hostname), send)
+        return res
+
+    async def update_host(self, hostname: str, data: str, etag: str, send=True):
+        'Update a checkmk host with request body (data) as variable'
+        header = {
+            'accept': 'application/json',
+            'If-Match': etag,
+            'Content-Type': 'application/json'
+        }
+        url = f'/objects/host_config/{hostname}'
+        return self.remember_etag(hostname, await self.rest_query(url, req_type='PUT', data=data, send=send, header=header))
+
+    async def move_host(self, hostname: str, target_folder: str, etag: str, send=True):
+        'Move a checkmk host to target_folder'
+        header = {
+            'accept': 'application/json',
+            'If-Match': etag,
+            'Content-Type': 'application/json'
+        }
+        data = json.dumps({'target_folder': target_folder})
+        url = f'/objects/host_config/{hostname}/actions/move/invoke'
+        return self.remember_etag(hostname, await self.rest_query(url, req_type='POST', data=data, send=send, header=header))
+
+    async def create_host(self, hostname, folder, ip=None, alias=None, send=True):
+        'Create a checkmk host. If ip is not set, dns is used on hostname.'
+        attributes = ({'ipaddress': ip} if ip is not None else {}) | \
+            ({'alias': alias} if alias is not None else {})
+        data = json.dumps({'host_name': hostname, 'folder': folder, 'attributes': attributes})
+        url = '/domain-types/host_config/collections/all'
+        return self.remember_etag(hostname, await self.rest_query(url, req_type='POST', data=data, send=send))
+
+    async def bulk_create_hosts(self, hosts, chunk_size=100, send=True):
+        'Create checkmk hosts in chunks of chunk_size hosts per request. Yields one BulkResult per host, in input order.'
+        url = '/domain-types/host_config/actions/bulk-create/invoke'
+        for chunk in chunked(hosts, chunk_size):
+            valid, rejected = self.check_tags(chunk)
+            res = await self.rest_query(url, req_type='POST', data=json_dumps({'entries': valid}), send=send) if valid else None
+            for r in merge_results(len(chunk), rejected, bulk_results([h['host_name'] for h in valid], res)):
+                yield r
+
+    async def bulk_update_hosts(self, hosts, chunk_size=100, send=True):
+        'Update checkmk hosts in chunks of chunk_size hosts per request. Yields one BulkResult per host, in input order.'
+        url = '/domain-types/host_config/actions/bulk-update/invoke'
+        for chunk in chunked(hosts, chunk_size):
+            valid, rejected = self.check_tags(chunk)
+            res = await self.rest_query(url, req_type='PUT', data=json_dumps({'entries': valid}), send=send) if valid else None
+            for r in merge_results(len(chunk), rejected, bulk_results([h['host_name'] for h in valid], res)):
+                yield r
+
+    async def bulk_delete_hosts(self, hostnames, chunk_size=100, send=True):
+        'Delete checkmk hosts in chunks of chunk_size hosts per request. Yields one BulkResult per host.'
+        url = '/domain-types/host_config/actions/bulk-delete/invoke'
+        for chunk in chunked(hostnames, chunk_size):
+            res = await self.rest_query(url, req_type='POST', data=json_dumps({'entries': chunk}), send=send)
+            for r in bulk_results(chunk, res):
+                yield r
+
+    async def get_folder_paths(self, parent='~') -> list:
+        'Paths (~ separated) of parent and all its sub-folders'
+        res = await self.get_all_folders(parent, recursive=True)
+        if not res.ok():
+            raise Exception(f'Listing folders failed ({res.res.status_code})')
+        return [folder_id(f) for f in res.json()['value']]
+
+    def map_hosts(self, fn, hostnames: list, workers=10):
+        'Coroutine: await fn(hostname) for every host, at most workers at once. Results are in input order.'
+        return gather_bounded(fn, hostnames, workers)
@@ -1,26 +1,126 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import signal
 import subprocess
 import shlex as shl
+import tempfile
+import threading
+import time
 
 
-def bash_no_stdin(cmd: str, merge_stdout_stderr=True) -> subprocess.Popen:
-    'Run cmd string in bash, close stdin and wait for execution to finish'
+# Outcome of a command (stderr is None if it was merged into stdout)
+Result = namedtuple('Result', 'cmd returncode stdout stderr timed_out duration')
 
-    cmd = shl.split(cmd)
+# Seconds the output is still read after the command ended (background children may keep the pipes open)
+READ_TIMEOUT = 5.0
+
+
+def format_cmd(template: str, **kwargs) -> str:
+    'Fill {name} fields of a command template with shell quoted values, e.g. format_cmd("ping -c1 {host}", host=h)'
+    return template.format(**{k: shl.quote(str(v)) for k, v in kwargs.items()})
+
+
+def kill_group(p: subprocess.Popen):
+    'Kill the process group of p (started with start_new_session=True) and reap p'
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # The command and its children ended in the meantime
+        pass
+    p.wait()
+
+
+def pump(stream, lines: list, callback):
+    'Read stream line by line until EOF, keep the lines and pass each one to callback'
+    for line in stream:
+        lines.append(line)
+        if callback is not None:
+            callback(line)
+    stream.close()
+
+
+def run(cmd, timeout=None, merge_stdout_stderr=True, on_stdout=None, on_stderr=None, running: set = None) -> Result:
+    '''Run cmd (string split like a shell command line, or a list) with stdin closed and wait for it without polling.
+    Output is read while the command runs (full pipes can't block it) and every line is passed to on_stdout/on_stderr.
+    After timeout seconds the command and its children are killed (timed_out=True), as on any error or Ctrl-C while waiting.
+    running is a set the Popen is kept in while the command runs (run_many kills those on Ctrl-C).'''
+    args = shl.split(cmd) if isinstance(cmd, str) else list(cmd)
+    start = time.monotonic()
+    # Own process group, so a timeout also kills the children of the command
+    p = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT if merge_stdout_stderr else subprocess.PIPE,
+                         encoding='utf8', errors='replace', start_new_session=True)
 
-    if merge_stdout_stderr:
-        # stderr => stdout, stdout => pipe
-        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT, encoding='utf8')
-    else:
-        # stderr => pipe, stdout => pipe
-        p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
+    out, err = [], []
+    readers = [threading.Thread(target=pump, args=(p.stdout, out, on_stdout), daemon=True)]
+    if not merge_stdout_stderr:
+        readers.append(threading.Thread(target=pump, args=(p.stderr, err, on_stderr), daemon=True))
+    for t in readers:
+        t.start()
+
+    timed_out = False
+    if running is not None:
+        running.add(p)
+    try:
+        p.wait(timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+    finally:
+        # Timeout, Ctrl-C or any other error: the group doesn't get the terminal's SIGINT, so kill it here
+        if p.returncode is None:
+            kill_group(p)
+        if running is not None:
+            running.discard(p)
+    for t in readers:
+        t.join(READ_TIMEOUT)
+
+    # Copies of the lines: readers that are still blocked on a pipe may append to them
+    return Result(cmd, p.returncode, ''.join(out[:]), None if merge_stdout_stderr else ''.join(err[:]),
+                  timed_out, time.monotonic() - start)
+
+
+def run_many(cmds, workers=4, timeout=None, merge_stdout_stderr=True) -> list:
+    'Run commands with at most workers running at once (timeout per command). Results are in input order.'
+    cmds = list(cmds)
+    if workers <= 1 or len(cmds) <= 1:
+        return [run(cmd, timeout, merge_stdout_stderr) for cmd in cmds]
+
+    running = set()
+    with ThreadPoolExecutor(max_workers=min(workers, len(cmds))) as executor:
+        try:
+            return list(executor.map(lambda cmd: run(cmd, timeout, merge_stdout_stderr, running=running), cmds))
+        except BaseException:
+            # Ctrl-C reaches only this thread: drop queued commands and kill the running ones, so the workers end
+            executor.shutdown(wait=False, cancel_futures=True)
+            for p in list(running):
+                kill_group(p)
+            raise
+
+
+def bash_no_stdin(cmd: str, merge_stdout_stderr=True, timeout=None) -> subprocess.Popen:
+    '''Run cmd string in bash, close stdin and wait for execution to finish (after timeout seconds the command and its children are killed).
+    Returns the finished Popen, its stdout/stderr are read from the start (output goes to temporary files, full pipes can't block the command).'''
+    cmd = shl.split(cmd)
+    out = tempfile.TemporaryFile()
+    err = subprocess.STDOUT if merge_stdout_stderr else tempfile.TemporaryFile()
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out, stderr=err, start_new_session=True)
 
     # Close stdin
     p.stdin.close()
 
-    # Wait till command finishes
-    while p.returncode is None:
-        p.poll()
+    try:
+        p.wait(timeout)
+    except subprocess.TimeoutExpired:
+        pass
+    finally:
+        if p.returncode is None:
+            kill_group(p)
 
+    out.seek(0)
+    p.stdout = io.TextIOWrapper(out, encoding='utf8', errors='replace')
+    if not merge_stdout_stderr:
+        err.seek(0)
+        p.stderr = io.TextIOWrapper(err, encoding='utf8', errors='replace')
     return p
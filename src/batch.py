@@ -0,0 +1,332 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from activation import ActivationManager
+from checkmk import Checkmk, JsonResult, json_dumps, json_loads, split_hosts
+import checkutil as p
+
+
+# Batch mode: run a stream of operations over one persistent check mk session
+#
+# Input is NDJSON, one operation per line: {"op": "update-host-tag", "args": {"hostname": "h1", ...}, "id": 1}
+# Operation names are the fab task names (or their aliases), args are the task parameters. Output is NDJSON,
+# one result per operation in input order: {"id": 1, "op": "update-host-tag", "ok": true, "status": 200, "result": {...}}
+#
+# A daemon keeps the session warm between invocations: it listens on a unix socket and runs batches sent to it.
+
+
+def hosts_list(hostnames) -> list:
+    'Hostnames as list (list or string separated with ; or ,)'
+    return hostnames if isinstance(hostnames, list) else split_hosts(hostnames)
+
+
+def check_mk_result(res) -> dict:
+    'Convert return value of Checkmk methods to a result dictionary'
+    if res is None:
+        return {'ok': None, 'status': None, 'result': None}
+    if isinstance(res, JsonResult):
+        try:
+            body = res.json() if res.res.content else None
+        except ValueError:
+            body = res.res.text
+        return {'ok': res.res.status_code in (200, 204), 'status': res.res.status_code, 'result': body}
+    if isinstance(res, list):
+        return {'ok': True, 'status': None, 'result': [check_mk_result(r) if isinstance(r, JsonResult) or r is None else r for r in res]}
+    return {'ok': True, 'status': None, 'result': res}
+
+
+def records(rows) -> list:
+    'Named tuples to dictionaries'
+    return [r._asdict() for r in rows]
+
+
+# Operations: the fab tasks that can run in a batch, they get the session and return the check mk result
+def get_host(cmk, hostname, get_effective_attributes=False):
+    return cmk.get_host(hostname, get_effective_attributes)
+
+
+def delete_host(cmk, hostname, doit=False):
+    return cmk.delete_host(hostname, send=doit)
+
+
+def create_host(cmk, hostname, folder, ip=None, alias=None, doit=False):
+    return cmk.create_host(hostname, folder, ip, alias, send=doit)
+
+
+def update_host(cmk, hostname, data, etag, doit=False):
+    return cmk.update_host(hostname, data if isinstance(data, str) else json_dumps(data), etag, send=doit)
+
+
+def bulk_create_hosts(cmk, filename, chunk_size=100, doit=False):
+    return records(cmk.bulk_create_hosts(p.read_hosts_create(filename), chunk_size, send=doit))
+
+
+def bulk_update_hosts(cmk, filename, chunk_size=100, doit=False):
+    return records(cmk.bulk_update_hosts(p.read_hosts_update(filename), chunk_size, send=doit))
+
+
+def bulk_delete_hosts(cmk, filename, chunk_size=100, doit=False):
+    return records(cmk.bulk_delete_hosts(p.read_hosts_delete(filename), chunk_size, send=doit))
+
+
+def update_host_tag(cmk, hostname, tag_group, tag_group_value, doit=False):
+    return cmk.update_host_tag(hostname, tag_group, tag_group_value, send=doit)
+
+
+def remove_host_tag(cmk, hostname, tag_group, doit=False):
+    return cmk.remove_host_tag(hostname, tag_group, send=doit)
+
+
+def update_host_ip(cmk, hostname, ip, doit=False):
+    return cmk.update_host_ipaddress(hostname, ip, send=doit)
+
+
+def remove_host_ip(cmk, hostname, doit=False):
+    return cmk.remove_host_ipaddress(hostname, send=doit)
+
+
+def activate(cmk, force_foreign_changes=False, wait=False, if_pending=False, timeout=None, doit=False):
+    'Activate changes, with wait or if_pending through the activation manager (its summary is returned)'
+    if not doit:
+        return None
+    if wait or if_pending:
+        timeout = float(timeout) if timeout is not None else None
+        am = ActivationManager(cmk, force_foreign_changes, timeout=timeout)
+        return am.activate(wait=wait, only_if_pending=if_pending)
+    return cmk.activate_changes(force_foreign_changes)
+
+
+def discover(cmk, hostnames, mode, workers=1, timeout=None, doit=False):
+    return cmk.discover_services(hosts_list(hostnames), mode, send=doit, workers=workers, timeout=timeout)
+
+
+def discover_fixall(cmk, hostnames, workers=1, timeout=None, doit=False):
+    return cmk.discover_fixall(hosts_list(hostnames), send=doit, workers=workers, timeout=timeout)
+
+
+def bulk_discover(cmk, hostnames, mode, batch_size=10, timeout=None, doit=False):
+    'Bulk discovery without progress prints, returns the outcome per host'
+    if not doit:
+        return None
+    timeout = float(timeout) if timeout is not None else None
+    return cmk.bulk_discover(hosts_list(hostnames), mode, batch_size, timeout=timeout, progress=None)
+
+
+def get_etag(cmk, hostname):
+    return cmk.get_etag(hostname)
+
+
+def get_tag_group(cmk, tag_group_name):
+    return cmk.get_tag_group(tag_group_name)
+
+
+def get_all_hosts(cmk):
+    return cmk.get_all_hosts()
+
+
+def get_all_hosts_in_folder(cmk, folder):
+    return cmk.get_all_hosts_in_folder(folder)
+
+
+def get_all_folders(cmk, parent, recursive=False, show_hosts=False):
+    return cmk.get_all_folders(parent, recursive, show_hosts)
+
+
+def get_all_tags(cmk):
+    return records(p.iter_all_hosts_tags(cmk))
+
+
+def get_all_tag_group(cmk):
+    return records(p.get_all_tag_groups(cmk))
+
+
+def get_tag_hist(cmk):
+    return [{'tag_group': k[0], 'tag_value': k[1], 'hosts': hosts} for k, hosts in p.get_tag_histogram(cmk).items()]
+
+
+def tag_query(cmk, query, count=False):
+    index = p.get_tag_index(cmk)
+    return index.count(query) if count else index.query(query)
+
+
+# op name => (aliases, function(cmk, **args)); write operations only send requests with doit=true
+OPS = {
+    'get-host': (['h'], get_host),
+    'delete-host': (['d'], delete_host),
+    'create-host': (['c'], create_host),
+    'update-host': (['u'], update_host),
+    'bulk-create-hosts': (['bc'], bulk_create_hosts),
+    'bulk-update-hosts': (['bu'], bulk_update_hosts),
+    'bulk-delete-hosts': (['bd'], bulk_delete_hosts),
+    'update-host-tag': (['ut'], update_host_tag),
+    'remove-host-tag': (['rt'], remove_host_tag),
+    'update-host-ip': (['ui'], update_host_ip),
+    'remove-host-ip': (['ri'], remove_host_ip),
+    'activate': (['a'], activate),
+    'discover': (['di'], discover),
+    'discover-fixall': (['df'], discover_fixall),
+    'bulk-discover': (['bdi'], bulk_discover),
+    'get-etag': (['etag'], get_etag),
+    'get-tag-group': (['gtg'], get_tag_group),
+    'get-all-hosts': (['ah'], get_all_hosts),
+    'get-all-hosts-in-folder': (['ahf'], get_all_hosts_in_folder),
+    'get-all-folders': (['gaf'], get_all_folders),
+    'get-all-tags': (['at'], get_all_tags),
+    'get-all-tag-group': (['atg'], get_all_tag_group),
+    'get-tag-hist': (['th'], get_tag_hist),
+    'tag-query': (['tq'], tag_query),
+}
+
+# op name, alias or python name (get_host) => function
+OP_FUNCTIONS = {}
+for name, (aliases, fn) in OPS.items():
+    for n in [name, name.replace('-', '_')] + aliases:
+        OP_FUNCTIONS[n] = fn
+
+
+def run_op(cmk: Checkmk, line) -> dict:
+    'Run one operation (NDJSON line or decoded dictionary). Errors are returned as results, they never stop the batch.'
+    op = None
+    res = {}
+    try:
+        req = json_loads(line) if isinstance(line, (str, bytes)) else line
+        op = req.get('op')
+        if 'id' in req:
+            res['id'] = req['id']
+        res['op'] = op
+        fn = OP_FUNCTIONS.get(op)
+        if fn is None:
+            raise ValueError(f'Unknown op: {op}')
+        res.update(check_mk_result(fn(cmk, **req.get('args', {}))))
+    except Exception as e:
+        logging.debug('op %s failed', op, exc_info=True)
+        res.update({'op': op, 'ok': False, 'status': None, 'error': f'{type(e).__name__}: {e}'})
+    return res
+
+
+def run_batch(cmk: Checkmk, lines, workers=1):
+    '''Run operations from an iterable of NDJSON lines and yield results in input order.
+    With workers > 1 up to workers operations run concurrently; input is read only a little ahead of the output.'''
+    lines = (line for line in lines if line.strip())
+    if workers <= 1:
+        for line in lines:
+            yield run_op(cmk, line)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for line in lines:
+            pending.append(executor.submit(run_op, cmk, line))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_results(results, out):
+    'Write results as NDJSON'
+    for r in results:
+        out.write(json_dumps(r) + '\n')
+        out.flush()
+
+
+def runtime_dir() -> str:
+    'Per user directory of the daemon socket: XDG_RUNTIME_DIR or /tmp/checkmk-rest-<uid> (only accessible by the user)'
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.environ['XDG_RUNTIME_DIR']
+    path = os.path.join('/tmp', f'checkmk-rest-{os.getuid()}')
+    private_dir(path)
+    return path
+
+
+def default_socket() -> str:
+    'Daemon socket from env DAEMON_SOCKET, default checkmk-rest.sock in the runtime directory'
+    return os.environ.get('DAEMON_SOCKET') or os.path.join(runtime_dir(), 'checkmk-rest.sock')
+
+
+def private_dir(path: str):
+    'Create directory path with mode 0700, refuse to use it if it belongs to another user or others can access it'
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'{path} is not a private directory of this user')
+
+
+class BatchHandler(socketserver.StreamRequestHandler):
+    'Run the batch sent by a client (NDJSON until the client shuts down writing) and stream back results'
+
+    def handle(self):
+        lines = (line.decode('utf-8') for line in self.rfile)
+        for r in run_batch(self.server.cmk, lines, self.server.workers):
+            self.wfile.write((json_dumps(r) + '\n').encode('utf-8'))
+
+
+class BatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, cmk: Checkmk, workers=1):
+        self.cmk = cmk
+        self.workers = workers
+        remove_stale_socket(path)
+        # Create the socket with mode 0600 (umask is process wide, the daemon sets it before serving)
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, BatchHandler)
+        finally:
+            os.umask(umask)
+
+
+def remove_stale_socket(path: str):
+    'Remove the socket of a daemon that is gone, refuse to remove anything else or the socket of a running daemon'
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise FileExistsError(f'{path} exists and is not a socket')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise FileExistsError(f'A daemon is already listening on {path}')
+
+
+def serve(cmk: Checkmk, path=None, workers=1):
+    'Run daemon on unix socket path until interrupted'
+    path = path or default_socket()
+    with BatchServer(path, cmk, workers) as server:
+        logging.info('Listening on %s', path)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def send_batch(lines, out=sys.stdout, path=None):
+    'Send a batch to the daemon and copy its results to out'
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path or default_socket())
+
+        # Send from a thread: results arrive while the batch is still being sent
+        def sender():
+            for line in lines:
+                s.sendall(line.encode('utf-8') if line.endswith('\n') else (line + '\n').encode('utf-8'))
+            s.shutdown(socket.SHUT_WR)
+
+        t = threading.Thread(target=sender, daemon=True)
+        t.start()
+        with s.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                out.write(line)
+        t.join()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+
+# Throughput benchmark against the local mock server (mock_server.py)
+#
+# For every inventory size a mock server is started and every scenario runs in a fresh python process, so peak memory
+# (max RSS) belongs to that scenario only. Reported per scenario: requests, requests/s, p50/p99 request latency,
+# wall time and peak memory of the client.
+#
+#   $ python bench.py --sizes 1000,10000,100000 --latency 2 --workers 16
+
+SCENARIOS = ['tags', 'histogram', 'tag_updates', 'discovery']
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb() -> float:
+    '''Peak resident memory of this process.
+    VmHWM is reset by execve, ru_maxrss (KiB on linux) is not: it would include the parent (mock server) at fork time.'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed_checkmk(url: str):
+    'Checkmk that records the latency of every request'
+    from checkmk import Checkmk
+
+    class TimedCheckmk(Checkmk):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.latencies = []
+            self.latencies_lock = threading.Lock()
+
+        def rest_query(self, *args, **kwargs):
+            start = time.perf_counter()
+            res = super().rest_query(*args, **kwargs)
+            with self.latencies_lock:
+                self.latencies.append(time.perf_counter() - start)
+            return res
+
+    cmk = TimedCheckmk(url, None, ['automation', 'secret'], 'main')
+    cmk.open_session()
+    return cmk
+
+
+def run_scenario(scenario: str, url: str, count: int, workers: int) -> dict:
+    'Run one scenario in this process and return its measurements'
+    import checkutil as p
+    cmk = timed_checkmk(url)
+    hostnames = [f'host{i:06}' for i in range(count)]
+
+    start = time.perf_counter()
+    items = 0
+    if scenario == 'tags':
+        for _ in p.iter_all_hosts_tags(cmk):
+            items += 1
+    elif scenario == 'histogram':
+        items = sum(len(hosts) for hosts in p.get_tag_histogram(cmk).values())
+    elif scenario == 'tag_updates':
+        res = cmk.map_hosts(lambda h: cmk.update_host_tag(h, 'tag_group0', 'value1'), hostnames, workers)
+        items = sum(1 for r in res if r is not None and r.ok())
+    elif scenario == 'discovery':
+        with contextlib.redirect_stdout(sys.stderr):
+            res = cmk.discover_services(hostnames, 'refresh', workers=workers)
+        items = sum(1 for r in res if r is not None and r.ok())
+    else:
+        raise ValueError(f'Unknown scenario {scenario}')
+    seconds = time.perf_counter() - start
+
+    lat = cmk.latencies
+    return {
+        'scenario': scenario, 'items': items, 'requests': len(lat), 'seconds': seconds,
+        'requests_per_s': len(lat) / seconds if seconds else 0.0,
+        'p50_ms': percentile(lat, 50) * 1000, 'p99_ms': percentile(lat, 99) * 1000,
+        'mean_ms': statistics.mean(lat) * 1000 if lat else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_child(scenario: str, url: str, count: int, workers: int) -> dict:
+    'Run scenario in a fresh python process'
+    cmd = [sys.executable, __file__, '--child', scenario, '--url', url, '--count', str(count), '--workers', str(workers)]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8', check=True)
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Checkmk client benchmark against the local mock server')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Inventory sizes (hosts, separated with ,)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Scenarios to run (separated with ,)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mock server latency per request in ms')
+    parser.add_argument('--discovery-time', type=float, default=0.0, help='Mock server discovery time per host in ms')
+    parser.add_argument('--updates', type=int, default=1000, help='Hosts updated/discovered per write scenario')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--json', action='store_true', help='Print results as NDJSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--count', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.url, args.count, args.workers)))
+        return 0
+
+    from mock_server import start_mock_server
+
+    if not args.json:
+        print(f'{"hosts":>8} {"scenario":<12} {"requests":>9} {"req/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"wall s":>8} {"peak MB":>8}')
+    for size in (int(s) for s in args.sizes.split(',')):
+        server = start_mock_server(size, latency=args.latency / 1000, discovery_time=args.discovery_time / 1000)
+        try:
+            for scenario in args.scenarios.split(','):
+                r = run_child(scenario, server.url, min(size, args.updates), args.workers)
+                r['hosts'] = size
+                if args.json:
+                    print(json.dumps(r))
+                else:
+                    print(f'{size:>8} {scenario:<12} {r["requests"]:>9} {r["requests_per_s"]:>9.1f} {r["p50_ms"]:>8.2f} '
+                          f'{r["p99_ms"]:>8.2f} {r["seconds"]:>8.2f} {r["peak_rss_mb"]:>8.1f}')
+        finally:
+            server.shutdown()
+            server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import atexit
+from collections import deque
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.response import HTTPResponse
+
+
+# Record / replay of REST traffic
+#
+# Recorder saves every request/response pair of Checkmk.rest_query (method, url, headers, bodies, status, ETags and
+# measured latency) as one NDJSON line of a cassette file (gzip compressed if it ends with .gz). Credentials are
+# never written: auth headers and JSON keys that look like secrets are replaced with REDACTED.
+#
+# ReplayAdapter is mounted on the session instead of the HTTP connection pool and answers requests from a cassette,
+# at full speed or with the recorded latency (scaled with speed), so a production run can be repeated offline.
+# Enabled by env:
+#   CASSETTE_RECORD=run.ndjson.gz
+#   CASSETTE_REPLAY=run.ndjson.gz   CASSETTE_LATENCY=1 (0: full speed, 1: recorded latency, 0.5: half of it)
+
+REDACTED = 'REDACTED'
+SECRET_HEADERS = {'authorization', 'cookie', 'set-cookie', 'proxy-authorization'}
+secret_key_reg = re.compile(r'secret|password|passphrase|token|community|credential', re.IGNORECASE)
+
+
+def open_cassette(filename: str, mode: str):
+    'Open cassette file as text (gzip if filename ends with .gz)'
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def redact_json(obj):
+    'Copy of a decoded JSON value with the values of secret looking keys replaced'
+    if isinstance(obj, dict):
+        return {k: REDACTED if secret_key_reg.search(k) else redact_json(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [redact_json(v) for v in obj]
+    return obj
+
+
+def redact_body(body) -> str:
+    'Request/response body as text with secrets redacted (bodies that are not JSON are kept as they are)'
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    try:
+        return json.dumps(redact_json(json.loads(body)), separators=(',', ':'))
+    except ValueError:
+        return body
+
+
+def redact_headers(headers) -> dict:
+    return {k: REDACTED if k.lower() in SECRET_HEADERS else v for k, v in headers.items()}
+
+
+class Recorder:
+    def __init__(self, filename: str):
+        self.lock = threading.Lock()
+        self.f = open_cassette(filename, 'w')
+        self.count = 0
+
+    def record(self, site: str, url_action: str, pre: requests.PreparedRequest, res: requests.Response, seconds: float):
+        'Append one request/response pair (the response body must already be read)'
+        entry = {
+            'site': site, 'method': pre.method, 'url': url_action, 'request_headers': redact_headers(pre.headers),
+            'request_body': redact_body(pre.body), 'status': res.status_code,
+            'headers': redact_headers(res.headers), 'body': redact_body(res.content) if res.content else '',
+            'latency': round(seconds, 6)}
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.f.write(line)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def read_cassette(filename: str) -> list:
+    with open_cassette(filename, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayAdapter(BaseAdapter):
+    '''requests transport adapter that answers from a cassette. Requests are matched by method and url (path after the
+    REST url prefix, with query); repeated requests get the recorded responses in order, the last one is repeated.'''
+
+    def __init__(self, entries: list, prefix: str, speed=0.0, site=None):
+        super().__init__()
+        self.prefix = urlsplit(prefix).path.rstrip('/')
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.responses = {}
+        for e in entries:
+            if site is not None and e.get('site') not in (None, site):
+                continue
+            self.responses.setdefault((e['method'], e['url']), deque()).append(e)
+        self.misses = 0
+
+    def url_action(self, url: str) -> str:
+        parts = urlsplit(url)
+        path = parts.path[len(self.prefix):] if parts.path.startswith(self.prefix) else parts.path
+        return path + (f'?{parts.query}' if parts.query else '')
+
+    def next_entry(self, method: str, url_action: str):
+        with self.lock:
+            entries = self.responses.get((method, url_action))
+            if not entries:
+                self.misses += 1
+                return None
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        entry = self.next_entry(request.method, self.url_action(request.url))
+        if entry is None:
+            logging.debug(f'cassette: no response for {request.method} {request.url}')
+            entry = {'status': 404, 'headers': {'Content-Type': 'application/problem+json'}, 'latency': 0.0,
+                     'body': json.dumps({'title': 'Not Found', 'status': 404, 'detail': 'Request is not in the cassette'})}
+        if self.speed:
+            time.sleep(entry['latency'] * self.speed)
+
+        body = (entry['body'] or '').encode('utf-8')
+        headers = {k: v for k, v in entry['headers'].items() if k.lower() not in ('content-encoding', 'transfer-encoding')}
+        headers['Content-Length'] = str(len(body))
+        raw = HTTPResponse(body=io.BytesIO(body), headers=headers, status=entry['status'], preload_content=False,
+                           decode_content=False)
+
+        res = requests.Response()
+        res.status_code = entry['status']
+        res.headers = CaseInsensitiveDict(headers)
+        res.raw = raw
+        res.reason = raw.reason
+        res.url = request.url
+        res.request = request
+        res.encoding = requests.utils.get_encoding_from_headers(res.headers)
+        if not stream:
+            res.content
+        return res
+
+    def close(self):
+        pass
+
+
+def mount_replay(session: requests.Session, filename: str, prefix: str, speed=0.0, site=None) -> ReplayAdapter:
+    'Answer all requests of session from the cassette filename (prefix is the REST url, site the site of the recording)'
+    adapter = ReplayAdapter(read_cassette(filename), prefix, speed, site)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
+
+
+# Recorder created by recorder_from_env (shared by all clients of the process)
+_env_recorder = None
+
+
+def recorder_from_env():
+    'Recorder of env CASSETTE_RECORD (closed at exit), None if it is not set. All calls return the same Recorder.'
+    global _env_recorder
+    filename = os.environ.get('CASSETTE_RECORD')
+    if not filename:
+        return None
+    if _env_recorder is not None:
+        return _env_recorder
+    recorder = _env_recorder = Recorder(filename)
+    atexit.register(recorder.close)
+    return recorder
+
+
+def replay_from_env():
+    '(cassette filename, speed) from env CASSETTE_REPLAY and CASSETTE_LATENCY, None if replay is off'
+    filename = os.environ.get('CASSETTE_REPLAY')
+    if not filename:
+        return None
+    return filename, float(os.environ.get('CASSETTE_LATENCY') or 0)
@@ -1,37 +1,424 @@
-from dataclasses import dataclass
+import abc
+import cassette
+import codecs
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 import ipaddress
+from itertools import islice
 from operator import attrgetter
 import os
 import requests
 import logging
 import json
+import metrics
+import monitoring
+import threading
+import time
+import transport
+from urllib.parse import urlencode
+
+# Use a faster JSON codec if one is installed (loads accepts str or bytes, dumps returns str)
+try:
+    import orjson
+
+    def json_loads(s):
+        return orjson.loads(s)
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Use ijson for streaming parsing of large collections if it is installed
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 
 # business logic
 
 
+_NOT_PARSED = object()
+
+
 @dataclass
 class JsonResult:
     'Result od http request'
     res: requests.Response
+    # Body was not read yet (rest_query(..., stream=True))
+    streamed: bool = False
+    # Decoded body, parsed on first call of json()
+    _json: object = field(default=_NOT_PARSED, init=False, repr=False)
+    # metrics.Metrics that records the decode time (None: not instrumented)
+    metrics: object = field(default=None, repr=False)
 
     def ok(self):
         return self.res.status_code == 200
 
-
-def json_result(res: requests.Response) -> JsonResult:
-    return JsonResult(res=res)
-
-
-class Checkmk:
-    def __init__(self, url, ca_cert, bearerAuth, site_name):
+    def json(self):
+        'Decode response body once and cache it'
+        if self._json is _NOT_PARSED:
+            if self.metrics is None:
+                self._json = json_loads(self.res.content)
+            else:
+                content = self.res.content
+                start = time.perf_counter()
+                self._json = json_loads(content)
+                self.metrics.record_decode(time.perf_counter() - start)
+        return self._json
+
+    def iter_values(self, key='value', envelope=None):
+        '''Yield items of the array in top level key (collections keep their members in value) one at a time.
+        For responses of rest_query(..., stream=True) the body is parsed incrementally and never held in memory.
+        The other top level fields (links, id, domainType, ...) are put into the dict envelope if it is given, it is
+        complete when all items were read. Raises requests.HTTPError if the request failed (an error body has no items).'''
+        self.res.raise_for_status()
+        if self._json is not _NOT_PARSED or not self.streamed:
+            j = self.json()
+            if envelope is not None:
+                envelope.update((k, v) for k, v in j.items() if k != key)
+            yield from j[key]
+        elif ijson is not None:
+            self.res.raw.decode_content = True
+            events = ijson.parse(self.res.raw, use_float=True)
+            if envelope is not None:
+                events = split_events(events, key, envelope)
+            yield from self.timed(ijson.items(events, f'{key}.item'))
+        else:
+            yield from self.timed(iter_json_array(codecs.iterdecode(self.res.iter_content(64 * 1024), 'utf-8'), key, envelope))
+
+    def timed(self, items):
+        'Yield from items, the time spent producing them is recorded as decode time of the body (without metrics: items)'
+        if self.metrics is None:
+            yield from items
+            return
+        seconds = 0.0
+        try:
+            it = iter(items)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            self.metrics.record_decode(seconds)
+
+
+def json_result(res: requests.Response, streamed=False, metrics=None) -> JsonResult:
+    return JsonResult(res=res, streamed=streamed, metrics=metrics)
+
+
+def split_events(events, key: str, envelope: dict):
+    'Pass on the ijson events of top level key, build the values of the other top level keys into envelope'
+    name, builder = None, None
+    for prefix, event, value in events:
+        if prefix == '':
+            if event == 'map_key':
+                name, builder = value, None
+        elif name == key:
+            yield prefix, event, value
+        else:
+            if builder is None:
+                builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            envelope[name] = builder.value
+
+
+def iter_json_array(chunks, key='value', envelope=None):
+    '''Yield items of the array in top level key of a JSON object that is read from an iterable of str chunks.
+    Only one item (and the unparsed rest of the current chunk) is kept in memory. The other top level fields are put
+    into the dict envelope if it is given (the rest of the object is then read too).'''
+    it = iter(chunks)
+    dec = json.JSONDecoder()
+    buf, pos = '', 0
+
+    def fill():
+        nonlocal buf, pos
+        chunk = next(it, None)
+        if chunk is None:
+            return False
+        buf, pos = buf[pos:] + chunk, 0
+        return True
+
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError('Unexpected end of JSON stream')
+
+    def value():
+        nonlocal pos
+        while True:
+            try:
+                obj, end = dec.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Value continues in the next chunk
+                if not fill():
+                    raise
+                continue
+            # A number at the end of the buffer could continue in the next chunk
+            if end < len(buf) or not fill():
+                pos = end
+                return obj
+
+    def expect(ch):
+        nonlocal pos
+        if peek() != ch:
+            raise ValueError(f'Expected {ch!r} at JSON stream position {pos}')
+        pos += 1
+
+    expect('{')
+    while peek() != '}':
+        if buf[pos] == ',':
+            pos += 1
+            continue
+        k = value()
+        expect(':')
+        peek()
+        if k != key:
+            v = value()
+            if envelope is not None:
+                envelope[k] = v
+            continue
+
+        expect('[')
+        while peek() != ']':
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            yield value()
+        if envelope is None:
+            return
+        expect(']')
+
+
+# Outcome of one host in a bulk operation
+BulkResult = namedtuple('BulkResult', 'host ok status detail')
+
+
+class CheckmkRequests(abc.ABC):
+    '''Request layer shared by Checkmk and async_checkmk.AsyncCheckmk: client state and the methods that only build a
+    request and return what rest_query (or update_host_cached) returns, unchanged. Subclasses implement rest_query and
+    update_host_cached, as plain methods or as coroutines. Methods that read a response belong in the subclasses.'''
+    def __init__(self, url, ca_cert, bearerAuth, site_name, log_body_limit=None, transport_config=None):
         self.url = url
         self.ca_cert = ca_cert
         self.username = bearerAuth[0]
         self.secret = bearerAuth[1]
         self.site_name = site_name
         self.session = None
+        # Pool size, timeouts, retries and rate limit (transport.TransportConfig)
+        self.transport = transport_config if transport_config is not None else transport.TransportConfig()
+        self.limiter = transport.TokenBucket(self.transport.rate, self.transport.burst) if self.transport.rate else None
+        # Maximum number of logged request/response body characters (None logs everything)
+        self.log_body_limit = log_body_limit
+        # ETag cache {hostname: etag}, filled from get_host/create_host/update_host responses
+        self.etags = {}
+        self.etags_lock = threading.Lock()
+        # Per request instrumentation (metrics.Metrics, None disables it)
+        self.metrics = None
+        # cassette.Recorder that saves every request/response pair (None: not recording)
+        self.recorder = None
+        # Tag writes are validated against this tagcatalog.TagCatalog before they are sent (None: no validation)
+        self.tag_catalog = None
+
+    @abc.abstractmethod
+    def rest_query(self, url_action, req_type='GET', data=None, header=None, send=True, timeout=None, stream=False):
+        'Send the request (or only log it if send=False) and return the response'
+
+    @abc.abstractmethod
+    def update_host_cached(self, hostname: str, data: str, send=True):
+        'Update host with the cached ETag (fetched once if missing), retry once with a fresh one on 412'
+
+    def truncate(self, body):
+        'Shorten logged body to log_body_limit characters (None logs everything)'
+        if body is None or self.log_body_limit is None or len(body) <= self.log_body_limit:
+            return body
+        return f'{body[:self.log_body_limit]}... ({len(body)} total)'
 
+    # POST ​/domain-types​/activation_run​/actions​/activate-changes​/invoke Activate pending changes
+    def activate_changes(self, force_foreign_changes=False, send=True, etag=None):
+        'Activate changes on check mk site (etag of the pending changes is sent as If-Match if set)'
+        ffc_str = 'true' if force_foreign_changes else 'false'
+        data = {
+            'redirect': 'false',
+            'sites': [self.site_name],
+            'force_foreign_changes': ffc_str}
+        data = json.dumps(data)
+        header = {'If-Match': etag} if etag is not None else None
+        url = '/domain-types/activation_run/actions/activate-changes/invoke'
+        return self.rest_query(url, req_type='POST', data=data, send=send, header=header)
+
+    # GET /domain-types/activation_run/collections/pending_changes Show all pending changes
+    def get_pending_changes(self, send=True):
+        'Show all pending changes (etag header identifies this set of changes)'
+        url = '/domain-types/activation_run/collections/pending_changes'
+        return self.rest_query(url, send=send)
+
+    # GET /objects/activation_run/{activation_id} Show the activation status
+    def get_activation_status(self, activation_id: str, send=True):
+        'Show the status of a running or completed activation (extensions.is_running)'
+        url = f'/objects/activation_run/{activation_id}'
+        return self.rest_query(url, send=send)
+
+    # POST /domain-types/discovery_run/actions/bulk-discovery-start/invoke Start a bulk discovery job
+    def start_bulk_discovery(self, hostnames: list, mode: str, batch_size=10, do_full_scan=True, ignore_errors=True, send=True):
+        '''Start a server side background job that discovers services on hostnames
+        batch_size is the number of hosts the server discovers in one go.'''
+        assert mode in ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']
+        data = {
+            'hostnames': hostnames,
+            'mode': mode,
+            'bulk_size': batch_size,
+            'do_full_scan': do_full_scan,
+            'ignore_errors': ignore_errors}
+        data = json.dumps(data)
+        url = '/domain-types/discovery_run/actions/bulk-discovery-start/invoke'
+        return self.rest_query(url, req_type='POST', data=data, send=send)
+
+    # GET /objects/discovery_run/{job_id} Show the bulk discovery job status
+    def get_bulk_discovery_status(self, job_id='bulk_discovery', send=True):
+        'Get status (active, state, logs) of the bulk discovery background job'
+        url = f'/objects/discovery_run/{job_id}'
+        return self.rest_query(url, send=send)
+
+    def remember_etag(self, hostname: str, json_result):
+        'Store etag header of a host response in the etag cache. Returns json_result.'
+        if json_result is not None:
+            etag = json_result.res.headers.get('etag')
+            with self.etags_lock:
+                if json_result.ok() and etag:
+                    self.etags[hostname] = etag
+                else:
+                    self.etags.pop(hostname, None)
+        return json_result
+
+    def forget_etag(self, hostname: str):
+        'Drop hostname from the etag cache'
+        with self.etags_lock:
+            self.etags.pop(hostname, None)
+
+    # PUT /objects/host_config/{host_name} Update a host
+    def update_host_tag(self, hostname: str, tag_group: str, tag_group_value: str, send=True):
+        'Update (set new or update existing) tag (raises tagcatalog.InvalidTag if the tag catalogue rejects it)'
+        if self.tag_catalog is not None:
+            self.tag_catalog.validate(tag_group, tag_group_value)
+        data = {
+            'update_attributes': {
+                tag_group: tag_group_value
+            }
+        }
+        data = json.dumps(data)
+        return self.update_host_cached(hostname, data, send)
+
+    def remove_host_tag(self, hostname: str, tag_group: str, send=True):
+        'Remove existing tag'
+        data = {'remove_attributes': [tag_group, ]}
+        data = json.dumps(data)
+        return self.update_host_cached(hostname, data, send)
+
+    def update_host_ipaddress(self, hostname: str, ip: str, send=True):
+        'Update (set new or update existing) ipaddress'
+        data = {'update_attributes': {'ipaddress': ip}}
+        data = json.dumps(data)
+        return self.update_host_cached(hostname, data, send)
+
+    def remove_host_ipaddress(self, hostname: str, send=True):
+        'Remove ipaddress (resolve ip from hostname after removal)'
+        data = {'remove_attributes': ['ipaddress', ]}
+        data = json.dumps(data)
+        return self.update_host_cached(hostname, data, send)
+
+    def get_tag_group(self, tag_group_name: str, send=True):
+        'Get a host tag group with all its values'
+        url = f'/objects/host_tag_group/{tag_group_name}'
+        return self.rest_query(url, req_type='GET', send=send)
+
+    def get_all_tag_groups(self, send=True):
+        'Show all host tag groups'
+        url = '/domain-types/host_tag_group/collections/all'
+        return self.rest_query(url, req_type='GET', send=send)
+
+    def get_all_hosts(self, send=True, stream=False, etag=None):
+        '''Get all hosts defined in check mk (slow operation). Use stream=True with JsonResult.iter_values() for large sites.
+        With etag (ETag of an earlier response) the request is conditional: status 304 without body if nothing changed.'''
+        url = '/domain-types/host_config/collections/all'
+        header = {'If-None-Match': etag} if etag else None
+        return self.rest_query(url, send=send, stream=stream, header=header)
+
+    def get_all_hosts_in_folder(self, folder: str, send=True, stream=False):
+        'Get all host in folder: Please replace the path delimiters with the tilde character ~. Path delimiters can be either ~, / or \\'
+        url = f'/objects/folder_config/{folder}/collections/hosts'
+        return self.rest_query(url, send=send, stream=stream)
+
+    def get_all_folders(self, parent: str, recursive=False, show_hosts=False, send=True, stream=False):
+        '''
+        Lists subfolders (and the hosts in subfolders) of folder x. It won't show the files that are in folder x. 
+        parent string - Show all sub-folders of this folder. The default is the root-folder. Path delimiters can be either ~, / or \. Please use the one most appropriate for your quoting/escaping needs. A good default choice is ~.
+        recursive boolean - List the folder (default: root) and all its sub-folders recursively.
+        show_hosts boolean - When set, all hosts that are stored in each folder will also be shown. On large setups this may come at a performance cost, so by default this is switched off.
+        '''
+        parent_str = f'parent={parent}'
+        recursive_str = 'recursive=true' if recursive else 'recursive=false'
+        show_hosts_str = 'show_hosts=true' if show_hosts else 'show_hosts=false'
+        url = f'/domain-types/folder_config/collections/all?{parent_str}&{recursive_str}&{show_hosts_str}'
+        return self.rest_query(url, send=send, stream=stream)
+
+    def status_query_url(self, domain_type: str, query, columns, params=()) -> str:
+        'Url of a monitoring collection with the query expression and columns as query parameters'
+        args = list(params)
+        query = monitoring.to_query(query)
+        if query is not None:
+            args.append(('query', json_dumps(query)))
+        args += [('columns', c) for c in columns or []]
+        return f'/domain-types/{domain_type}/collections/all' + (f'?{urlencode(args)}' if args else '')
+
+    # GET /domain-types/host/collections/all Show hosts (monitoring state)
+    def get_hosts_status(self, query=None, columns=None, send=True, stream=False):
+        '''Monitoring state of hosts, filtered on the server (livestatus).
+        query is a query expression (monitoring.Expr, dict or JSON string), columns the list of returned columns.'''
+        return self.rest_query(self.status_query_url('host', query, columns), send=send, stream=stream)
+
+    # GET /domain-types/service/collections/all Show services (monitoring state)
+    def get_services_status(self, query=None, columns=None, host_name=None, send=True, stream=False):
+        '''Monitoring state of services, filtered on the server (livestatus).
+        query is a query expression (monitoring.Expr, dict or JSON string), columns the list of returned columns.'''
+        params = [('host_name', host_name)] if host_name else []
+        return self.rest_query(self.status_query_url('service', query, columns, params), send=send, stream=stream)
+
+    def check_tags(self, entries: list):
+        '''Split bulk entries into (valid entries, {position in entries: BulkResult} of entries the tag catalogue rejects).
+        merge_results puts the results back into the order of entries.'''
+        if self.tag_catalog is None:
+            return entries, {}
+        valid, rejected = [], {}
+        for i, entry in enumerate(entries):
+            errors = self.tag_catalog.entry_errors(entry)
+            if errors:
+                rejected[i] = BulkResult(entry['host_name'], False, None, '; '.join(errors))
+            else:
+                valid.append(entry)
+        return valid, rejected
+
+    def delete_host(self, hostname: str, send=True):
+        'Delete a checkmk host'
+        url = f'/objects/host_config/{hostname}'
+        self.forget_etag(hostname)
+        return self.rest_query(url, req_type='DELETE', send=send)
+
+
+class Checkmk(CheckmkRequests):
     def open_session(self):
         'Create check MK session'
 
@@ -55,42 +442,46 @@ class Checkmk:
         self.session = requests.Session()
         self.session.headers.update({'Authorization': f'Bearer {self.username} {self.secret}',
                                     'accept': 'application/json', 'Content-Type': 'application/json'})
+        transport.configure_session(self.session, self.transport)
 
     def log_pre(self, pre):
         'Log prepared requst'
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
         logging.debug('Prepared request:')
-        logging.debug(f'URL: {pre.url}')
-        logging.debug(f'BODY: {pre.body}')
-        logging.debug(f'HEADERS: {pre.headers}')
-
-    def log_response(self, res):
-        'Log response objects'
+        logging.debug('URL: %s', pre.url)
+        logging.debug('BODY: %s', self.truncate(pre.body))
+        logging.debug('HEADERS: %s', pre.headers)
+
+    def log_response(self, res, body=True):
+        'Log response objects (body=False leaves streamed bodies unread)'
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
         # Response objects have a .request property which is the original PreparedRequest object that was sent.
         logging.debug('Response.request:')
-        logging.debug(f'res.request.url: {res.request.url}')
-        logging.debug(f'res.request.body: {res.request.body}')
-        logging.debug(f'res.request.headers: {res.request.headers}')
+        logging.debug('res.request.url: %s', res.request.url)
+        logging.debug('res.request.body: %s', self.truncate(res.request.body))
+        logging.debug('res.request.headers: %s', res.request.headers)
 
         # Output response
         logging.debug('Response:')
-        logging.debug(f'res.status_code: {res.status_code}')
-        logging.debug(f'res: {res}')
-        logging.debug(f'res.content: {res.content}')
+        logging.debug('res.status_code: %s', res.status_code)
+        logging.debug('res: %s', res)
 
         # If data not empty
         logging.debug('RESPONSE BODY: ')
-        if res.content is not None and len(res.content) != 0:
-            # res.content are bytes, decode them to produce string
-            dmp = json.loads(res.content.decode('utf-8'))
-            # Beautifying JSON output
-            logging.debug(json.dumps(dmp, indent=4))
+        if not body:
+            logging.debug('Streamed data')
+        elif res.content is not None and len(res.content) != 0:
+            # res.content are bytes, decode them to produce string (not parsed, the caller parses it once)
+            logging.debug('%s', self.truncate(res.content.decode('utf-8', errors='replace')))
         else:
             logging.debug('No returned data')
 
-        logging.debug(f'RESPONSE HEADERS: {res.headers}')
+        logging.debug('RESPONSE HEADERS: %s', res.headers)
 
-    def rest_query(self, url_action, req_type='GET', data=None, header=None, send=True):
-        'execute rest query'
+    def rest_query(self, url_action, req_type='GET', data=None, header=None, send=True, timeout=None, stream=False):
+        'execute rest query (timeout in seconds, None uses the transport default; stream=True leaves the body unread)'
         if self.session is None:
             raise Exception('Check MK session is not opened')
 
@@ -105,46 +496,113 @@ class Checkmk:
         if not send:
             return None
 
-        res = self.session.send(pre, verify=self.ca_cert)
-        self.log_response(res)
-        return json_result(res)
+        timeout = timeout if timeout is not None else self.transport.timeout
+        start = time.perf_counter()
+        if self.metrics is None:
+            res = transport.send(self.session, pre, self.transport, self.limiter, verify=self.ca_cert, timeout=timeout, stream=stream)
+        else:
+            res = self.send_measured(url_action, pre, timeout, stream)
+        if self.recorder is not None:
+            # The cassette needs the body: recorded responses are never streamed
+            res.content
+            stream = False
+            self.recorder.record(self.site_name, url_action, pre, res, time.perf_counter() - start)
+        self.log_response(res, body=not stream)
+        return json_result(res, stream, self.metrics)
+
+    def send_measured(self, url_action, pre, timeout, stream):
+        'transport.send recorded in self.metrics (streamed bodies are counted by their Content-Length)'
+        retries = []
+        start = time.perf_counter()
+        try:
+            res = transport.send(self.session, pre, self.transport, self.limiter, verify=self.ca_cert, timeout=timeout,
+                                 stream=stream, on_retry=retries.append)
+        except Exception:
+            self.metrics.record(pre.method, url_action, None, time.perf_counter() - start, 0, len(retries), self.site_name)
+            raise
+        size = int(res.headers.get('content-length') or 0) if stream else len(res.content)
+        self.metrics.record(pre.method, url_action, res.status_code, time.perf_counter() - start, size, len(retries),
+                            self.site_name)
+        return res
 
-    # POST ​/domain-types​/activation_run​/actions​/activate-changes​/invoke Activate pending changes
-    def activate_changes(self, force_foreign_changes=False, send=True):
-        'Activate changes on check mk site'
-        ffc_str = 'true' if force_foreign_changes else 'false'
-        data = {
-            'redirect': 'false',
-            'sites': [self.site_name],
-            'force_foreign_changes': ffc_str}
-        data = json.dumps(data)
-        url = '/domain-types/activation_run/actions/activate-changes/invoke'
-        return self.rest_query(url, req_type='POST', data=data, send=send)
+    def discover_service(self, hostname: str, mode: str, send=True, timeout=None):
+        'Discover services on a single check mk host'
+        assert mode in ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']
+        data = json.dumps({'mode': mode})
+        print(f'{hostname} {mode}')
+        url = f'/objects/host/{hostname}/actions/discover_services/invoke'
+        try:
+            return self.rest_query(url, req_type='POST', data=data, send=send, timeout=timeout)
+        except requests.exceptions.Timeout:
+            # Don't let one slow host abort the discovery of all other hosts
+            logging.error(f'{hostname} {mode}: timed out after {timeout}s')
+            return None
 
-    def discover_services(self, hostnames: list, mode: str, send=True) -> list:
+    def discover_services(self, hostnames: list, mode: str, send=True, workers=1, timeout=None) -> list:
         '''Discover services on check mk hosts
-        mode is one of the enum values: ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']'''
+        mode is one of the enum values: ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']
+        workers is the number of hosts discovered concurrently, timeout is the per host timeout in seconds.
+        Results are returned in the same order as hostnames.'''
         assert mode in ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']
         #    raise ValueError("Mode has to be one of values 'new', 'remove', 'fix_all', 'refresh' or 'only_host_labels'")
-        data = {'mode': mode}
-        data = json.dumps(data)
-        res = []
-        for host in hostnames:
-            print(f'{host} {mode}')
-            url = f'/objects/host/{host}/actions/discover_services/invoke'
-            res.append(self.rest_query(url, req_type='POST', data=data, send=send))
-        return res
+        return self.map_hosts(lambda host: self.discover_service(host, mode, send, timeout), hostnames, workers)
 
-    def discover_fixall(self, hostnames: list, send=True) -> list:
+    def discover_fixall(self, hostnames: list, send=True, workers=1, timeout=None) -> list:
         '''Fix all services on check mk hosts'''
-        # Execute refresh, execute fix_all, concat lists with result jsons
-        return self.discover_services(hostnames, 'refresh', send) + self.discover_services(hostnames, 'fix_all', send)
+        # Execute refresh and then fix_all per host (pipeline), so a host can be fixed while others are still refreshing
+        def refresh_fixall(host):
+            return (self.discover_service(host, 'refresh', send, timeout),
+                    self.discover_service(host, 'fix_all', send, timeout))
+
+        res = self.map_hosts(refresh_fixall, hostnames, workers)
+        # Concat lists with result jsons (all refresh results, then all fix_all results)
+        return [r[0] for r in res] + [r[1] for r in res]
+
+    def map_hosts(self, fn, hostnames: list, workers=1) -> list:
+        'Call fn(hostname) for every host using at most workers threads. Results are in input order.'
+        if workers <= 1 or len(hostnames) <= 1:
+            return [fn(host) for host in hostnames]
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(hostnames))) as executor:
+            return list(executor.map(fn, hostnames))
+
+    def bulk_discover(self, hostnames: list, mode: str, batch_size=10, do_full_scan=True, ignore_errors=True,
+                      poll_interval=1.0, max_poll_interval=30.0, timeout=None, progress=print) -> dict:
+        '''Discover services on check mk hosts with one server side background job
+        The job status is polled with adaptive backoff: the interval grows while nothing happens (up to max_poll_interval)
+        and is reset when new progress lines show up. Every new progress line is passed to progress (None disables it).
+        Returns a dictionary {hostname: {'state': ..., 'log': [...]}}.'''
+        res = self.start_bulk_discovery(hostnames, mode, batch_size, do_full_scan, ignore_errors)
+        if not res.ok():
+            raise Exception(f'Bulk discovery could not be started ({res.res.status_code}): {res.res.text}')
+
+        job_id = res.json().get('id', 'bulk_discovery')
+        start = time.monotonic()
+        poll = BulkDiscoveryPoll(poll_interval, max_poll_interval, progress)
+
+        while True:
+            status = self.get_bulk_discovery_status(job_id)
+            if not poll.update(status):
+                break
+
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'Bulk discovery job {job_id} still running after {timeout}s')
+
+            time.sleep(poll.interval)
+
+        return bulk_discovery_outcome(hostnames, poll.state, poll.lines)
 
     def get_host(self, hostname: str, get_effective_attributes: bool, send=True):
         'Get host info'
         eff_str = '?effective_attributes=true' if get_effective_attributes else ''
         url = f'/objects/host_config/{hostname}{eff_str}'
-        return self.rest_query(url, req_type='GET', send=send)
+        return self.remember_etag(hostname, self.rest_query(url, req_type='GET', send=send))
+
+    def get_host_if_changed(self, hostname: str, etag: str, send=True):
+        'Conditional GET of a host (If-None-Match): status 304 without body if its etag is still etag'
+        url = f'/objects/host_config/{hostname}'
+        res = self.rest_query(url, req_type='GET', header={'If-None-Match': etag}, send=send)
+        return res if res is None or res.res.status_code == 304 else self.remember_etag(hostname, res)
 
     def get_etag(self, hostname: str) -> str:
         'Get host etag (value that changes on every modification of check mk host)'
@@ -154,40 +612,23 @@ class Checkmk:
             return ''
         else:
             # If hostname was found : get etag value
-            return json_result.res.headers['etag']
-
-    # PUT /objects/host_config/{host_name} Update a host
-    def update_host_tag(self, hostname: str, tag_group: str, tag_group_value: str, send=True):
-        'Update (set new or update existing) tag'
-        data = {
-            'update_attributes': {
-                tag_group: tag_group_value
-            }
-        }
-        data = json.dumps(data)
-        etag = self.get_etag(hostname)
-        return self.update_host(hostname, data, etag, send)
-
-    def remove_host_tag(self, hostname: str, tag_group: str, send=True):
-        'Remove existing tag'
-        data = {'remove_attributes': [tag_group, ]}
-        data = json.dumps(data)
-        etag = self.get_etag(hostname)
-        return self.update_host(hostname, data, etag, send)
-
-    def update_host_ipaddress(self, hostname: str, ip: str, send=True):
-        'Update (set new or update existing) ipaddress'
-        data = {'update_attributes': {'ipaddress': ip}}
-        data = json.dumps(data)
-        etag = self.get_etag(hostname)
-        return self.update_host(hostname, data, etag, send)
-
-    def remove_host_ipaddress(self, hostname: str, send=True):
-        'Remove ipaddress (resolve ip from hostname after removal)'
-        data = {'remove_attributes': ['ipaddress', ]}
-        data = json.dumps(data)
-        etag = self.get_etag(hostname)
-        return self.update_host(hostname, data, etag, send)
+            return json_result.res.headers.get('etag', '')
+
+    def cached_etag(self, hostname: str) -> str:
+        'Get host etag from the etag cache, fetch it (GET) if host is not cached'
+        with self.etags_lock:
+            etag = self.etags.get(hostname)
+        return etag if etag is not None else self.get_etag(hostname)
+
+    def update_host_cached(self, hostname: str, data: str, send=True):
+        '''Update a checkmk host using the cached etag.
+        If the cached etag is stale (412 Precondition Failed) fetch a fresh one and retry once.'''
+        res = self.update_host(hostname, data, self.cached_etag(hostname), send)
+        if res is not None and res.res.status_code == 412:
+            logging.debug(f'{hostname}: cached etag is stale, refetching')
+            self.forget_etag(hostname)
+            res = self.update_host(hostname, data, self.get_etag(hostname), send)
+        return res
 
     # PUT /objects/host_config/{host_name} Update a host
     #
@@ -208,45 +649,95 @@ class Checkmk:
             'Content-Type': 'application/json'
         }
         url = f'/objects/host_config/{hostname}'
-        return self.rest_query(url, req_type='PUT', data=data, send=send, header=header)
-
-    def get_tag_group(self, tag_group_name: str, send=True):
-        'Get a host tag group with all its values'
-        url = f'/objects/host_tag_group/{tag_group_name}'
-        return self.rest_query(url, req_type='GET', send=send)
-
-    def get_all_tag_groups(self, send=True):
-        'Show all host tag groups'
-        url = '/domain-types/host_tag_group/collections/all'
-        return self.rest_query(url, req_type='GET', send=send)
-
-    def get_all_hosts(self, send=True):
-        'Get all hosts defined in check mk (slow operation)'
-        url = '/domain-types/host_config/collections/all'
-        return self.rest_query(url, send=send)
-
-    def get_all_hosts_in_folder(self, folder: str, send=True):
-        'Get all host in folder: Please replace the path delimiters with the tilde character ~. Path delimiters can be either ~, / or \\'
-        url = f'/objects/folder_config/{folder}/collections/hosts'
-        return self.rest_query(url, send=send)
-
-    def get_all_folders(self, parent: str, recursive=False, show_hosts=False, send=True):
-        '''
-        Lists subfolders (and the hosts in subfolders) of folder x. It won't show the files that are in folder x. 
-        parent string - Show all sub-folders of this folder. The default is the root-folder. Path delimiters can be either ~, / or \. Please use the one most appropriate for your quoting/escaping needs. A good default choice is ~.
-        recursive boolean - List the folder (default: root) and all its sub-folders recursively.
-        show_hosts boolean - When set, all hosts that are stored in each folder will also be shown. On large setups this may come at a performance cost, so by default this is switched off.
-        '''
-        parent_str = f'parent={parent}'
-        recursive_str = 'recursive=true' if recursive else 'recursive=false'
-        show_hosts_str = 'show_hosts=true' if show_hosts else 'show_hosts=false'
-        url = f'/domain-types/folder_config/collections/all?{parent_str}&{recursive_str}&{show_hosts_str}'
-        return self.rest_query(url, send=send)
+        return self.remember_etag(hostname, self.rest_query(url, req_type='PUT', data=data, send=send, header=header))
 
-    def delete_host(self, hostname: str, send=True):
-        'Delete a checkmk host'
-        url = f'/objects/host_config/{hostname}'
-        return self.rest_query(url, req_type='DELETE', send=send)
+    # POST /objects/host_config/{host_name}/actions/move/invoke Move a host to another folder
+    def move_host(self, hostname: str, target_folder: str, etag: str, send=True):
+        'Move a checkmk host to target_folder'
+        header = {
+            'accept': 'application/json',
+            'If-Match': etag,
+            'Content-Type': 'application/json'
+        }
+        data = json.dumps({'target_folder': target_folder})
+        url = f'/objects/host_config/{hostname}/actions/move/invoke'
+        return self.remember_etag(hostname, self.rest_query(url, req_type='POST', data=data, send=send, header=header))
+
+    def get_folder_paths(self, parent='~') -> list:
+        'Paths (~ separated) of parent and all its sub-folders'
+        res = self.get_all_folders(parent, recursive=True)
+        if not res.ok():
+            raise Exception(f'Listing folders failed ({res.res.status_code})')
+        return [folder_id(f) for f in res.json()['value']]
+
+    def get_folder_hosts(self, folder: str, retries=2) -> list:
+        'Host objects in folder (without sub-folders), a failed request is repeated up to retries times'
+        attempt = 0
+        while True:
+            try:
+                res = self.get_all_hosts_in_folder(folder)
+                if res.ok():
+                    return res.json()['value']
+                error = f'status {res.res.status_code}'
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error = str(e)
+            if attempt >= retries:
+                raise Exception(f'Fetching hosts in folder {folder} failed ({error})')
+            attempt += 1
+            logging.debug(f'{folder}: {error}, retry {attempt}/{retries}')
+
+    def iter_all_hosts_sharded(self, workers=8, retries=2, parent='~'):
+        '''Yield all host objects like get_all_hosts, fetched folder by folder with at most workers parallel requests.
+        Hosts of a folder are yielded as soon as it arrives (folder order is not kept). A failed folder is refetched alone.
+        At most 2 * workers folders are fetched ahead of the consumer, so a slow consumer keeps memory bounded.'''
+        folders = self.get_folder_paths(parent)
+        if workers <= 1 or len(folders) <= 1:
+            for folder in folders:
+                yield from self.get_folder_hosts(folder, retries)
+            return
+
+        pending = iter(folders)
+        with ThreadPoolExecutor(max_workers=min(workers, len(folders))) as executor:
+            running = {executor.submit(self.get_folder_hosts, folder, retries) for folder in islice(pending, 2 * workers)}
+            try:
+                while running:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    running |= {executor.submit(self.get_folder_hosts, folder, retries) for folder in islice(pending, len(done))}
+                    for future in done:
+                        yield from future.result()
+            finally:
+                for future in running:
+                    future.cancel()
+
+    # POST /domain-types/host_config/actions/bulk-create/invoke Bulk create hosts
+    def bulk_create_hosts(self, hosts, chunk_size=100, send=True):
+        '''Create checkmk hosts in chunks of chunk_size hosts per request.
+        hosts is an iterable of dicts {'host_name': ..., 'folder': ..., 'attributes': {...}}.
+        Yields one BulkResult per host, in input order.'''
+        url = '/domain-types/host_config/actions/bulk-create/invoke'
+        for chunk in chunked(hosts, chunk_size):
+            valid, rejected = self.check_tags(chunk)
+            res = self.rest_query(url, req_type='POST', data=json_dumps({'entries': valid}), send=send) if valid else None
+            yield from merge_results(len(chunk), rejected, bulk_results([h['host_name'] for h in valid], res))
+
+    # PUT /domain-types/host_config/actions/bulk-update/invoke Bulk update hosts
+    def bulk_update_hosts(self, hosts, chunk_size=100, send=True):
+        '''Update checkmk hosts in chunks of chunk_size hosts per request.
+        hosts is an iterable of dicts {'host_name': ..., 'update_attributes': {...}} (or 'attributes' / 'remove_attributes').
+        Yields one BulkResult per host, in input order.'''
+        url = '/domain-types/host_config/actions/bulk-update/invoke'
+        for chunk in chunked(hosts, chunk_size):
+            valid, rejected = self.check_tags(chunk)
+            res = self.rest_query(url, req_type='PUT', data=json_dumps({'entries': valid}), send=send) if valid else None
+            yield from merge_results(len(chunk), rejected, bulk_results([h['host_name'] for h in valid], res))
+
+    # POST /domain-types/host_config/actions/bulk-delete/invoke Bulk delete hosts
+    def bulk_delete_hosts(self, hostnames, chunk_size=100, send=True):
+        '''Delete checkmk hosts in chunks of chunk_size hosts per request. Yields one BulkResult per host.'''
+        url = '/domain-types/host_config/actions/bulk-delete/invoke'
+        for chunk in chunked(hostnames, chunk_size):
+            data = json_dumps({'entries': chunk})
+            yield from bulk_results(chunk, self.rest_query(url, req_type='POST', data=data, send=send))
 
     def create_host(self, hostname, folder, ip=None, alias=None, send=True):
         'Create a checkmk host. If ip is not set, dns is used on hostname.'
@@ -255,7 +746,98 @@ class Checkmk:
         data = {'host_name': hostname, 'folder': folder, 'attributes': attributes}
         data = json.dumps(data)
         url = '/domain-types/host_config/collections/all'
-        return self.rest_query(url, req_type='POST', data=data, send=send)
+        return self.remember_etag(hostname, self.rest_query(url, req_type='POST', data=data, send=send))
+
+
+def chunked(iterable, size: int):
+    'Yield lists of at most size items from iterable without reading it all into memory'
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def folder_id(folder_json: dict) -> str:
+    'Folder path with ~ separators (as used in folder urls) of a folder object'
+    path = folder_json.get('extensions', {}).get('path')
+    return path.replace('/', '~') if path else folder_json['id']
+
+
+def bulk_results(hostnames: list, json_res: JsonResult) -> list:
+    '''Split the answer of a bulk request into one BulkResult per host.
+    Checkmk reports partially failed bulk requests with ext.failed_hosts ({hostname: error}).'''
+    if json_res is None:
+        return [BulkResult(host, None, None, 'not sent') for host in hostnames]
+
+    res = json_res.res
+    if json_res.ok() or res.status_code == 204:
+        return [BulkResult(host, True, res.status_code, '') for host in hostnames]
+
+    try:
+        j = json_res.json()
+    except ValueError:
+        j = {}
+    failed = j.get('ext', {}).get('failed_hosts')
+    if isinstance(failed, dict):
+        # The status code is the one of the batch: only failed hosts get it, the others have no status of their own
+        return [BulkResult(host, False, res.status_code, str(failed[host])) if host in failed else BulkResult(host, True, None, '')
+                for host in hostnames]
+
+    # Whole chunk was rejected
+    detail = j.get('detail', res.text)
+    return [BulkResult(host, False, res.status_code, detail) for host in hostnames]
+
+
+def merge_results(count: int, rejected: dict, results: list) -> list:
+    'Results of count entries in input order: rejected {position: BulkResult} and results of the sent entries in between'
+    sent = iter(results)
+    return [rejected[i] if i in rejected else next(sent) for i in range(count)]
+
+
+class BulkDiscoveryPoll:
+    '''State of bulk discovery job polling with adaptive backoff: the interval grows while nothing happens
+    (up to max_poll_interval) and is reset when new progress lines show up.'''
+
+    def __init__(self, poll_interval: float, max_poll_interval: float, progress=print):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.progress = progress
+        self.interval = poll_interval
+        self.lines = []
+        self.state = ''
+
+    def update(self, status: JsonResult) -> bool:
+        'Process a job status response, pass new log lines to progress. Returns True while the job is active.'
+        if not status.ok():
+            raise Exception(f'Bulk discovery status query failed ({status.res.status_code})')
+
+        ext = status.json()['extensions']
+        logs = ext.get('logs', {})
+        lines = logs.get('progress', []) + logs.get('result', [])
+
+        if len(lines) > len(self.lines):
+            if self.progress is not None:
+                for line in lines[len(self.lines):]:
+                    self.progress(line)
+            self.interval = self.poll_interval
+        else:
+            self.interval = min(self.interval * 1.5, self.max_poll_interval)
+
+        self.lines = lines
+        self.state = ext.get('state', '')
+        return ext.get('active', False)
+
+
+def bulk_discovery_outcome(hostnames: list, job_state: str, lines: list) -> dict:
+    'Assign bulk discovery job log lines to hosts. A host fails if one of its lines reports a failure or an error.'
+    res = {host: {'state': job_state, 'log': []} for host in hostnames}
+    for line in lines:
+        for host in hostnames:
+            if host in line:
+                res[host]['log'].append(line)
+                low = line.lower()
+                if 'failed' in low or 'error' in low:
+                    res[host]['state'] = 'failed'
+    return res
 
 
 def split_hosts(hostnames: str) -> list:
@@ -263,8 +845,25 @@ def split_hosts(hostnames: str) -> list:
     return hostnames.replace(',', ';').split(';')
 
 
-def create_checkmk() -> Checkmk:
-    'Init checkmk rest API'
+def create_transport_config() -> transport.TransportConfig:
+    'Transport settings from env POOL_SIZE, REST_TIMEOUT, RETRIES, RATE_LIMIT (requests/s) and RATE_BURST'
+    g = os.environ.get
+    config = transport.TransportConfig()
+    if g('POOL_SIZE'):
+        config.pool_size = int(g('POOL_SIZE'))
+    if g('REST_TIMEOUT'):
+        config.timeout = float(g('REST_TIMEOUT'))
+    if g('RETRIES'):
+        config.retries = int(g('RETRIES'))
+    if g('RATE_LIMIT'):
+        config.rate = float(g('RATE_LIMIT'))
+    if g('RATE_BURST'):
+        config.burst = int(g('RATE_BURST'))
+    return config
+
+
+def create_checkmk(use_async=False) -> Checkmk:
+    'Init checkmk rest API (use_async=True returns an async_checkmk.AsyncCheckmk, open it with: async with cmk)'
 
     g = os.environ.get
 
@@ -283,16 +882,51 @@ def create_checkmk() -> Checkmk:
     # Checkmk filename with secret token
     secret_token_filename = g('TOKENF')
 
+    return new_checkmk(site_name, cmk_rest_url, cafile, username, secret_token_filename, use_async)
+
+
+def new_checkmk(site_name, cmk_rest_url, cafile, username, secret_token_filename, use_async=False) -> Checkmk:
+    'Init checkmk rest API of one site (transport, log and metrics settings are read from env)'
+
+    g = os.environ.get
+
     logging.debug(f'site_name: {site_name}')
     logging.debug(f'cmk_rest_url: {cmk_rest_url}')
     logging.debug(f'cafile: {cafile}')
     logging.debug(f'username: {username}')
     logging.debug(f'secret_token_filename: {secret_token_filename}')
 
-    secret_token = open(secret_token_filename, 'r').readline().strip('\n')
+    # Maximum number of logged body characters
+    log_body_limit = g('LOG_BODY_LIMIT')
+    log_body_limit = int(log_body_limit) if log_body_limit else None
+
+    # Replayed sessions (env CASSETTE_REPLAY) don't need credentials
+    replay = cassette.replay_from_env()
+    if replay is not None and not os.path.exists(secret_token_filename or ''):
+        secret_token = ''
+    else:
+        secret_token = open(secret_token_filename, 'r').readline().strip('\n')
 
     bearerAuth = [username, secret_token]
-    cmk = Checkmk(cmk_rest_url, cafile, bearerAuth, site_name)
+    cmk = Checkmk(cmk_rest_url, cafile, bearerAuth, site_name, log_body_limit, create_transport_config())
+    cmk.metrics = metrics.from_env()
+    cmk.recorder = cassette.recorder_from_env()
     cmk.open_session()
+    if replay is not None:
+        cassette.mount_replay(cmk.session, replay[0], cmk_rest_url, replay[1], site_name)
+
+    # Imported here: checkutil (and tagcatalog through it) import checkmk, a module level import would be circular
+    import checkutil
+    import tagcatalog
+    cmk.tag_catalog = tagcatalog.from_env(lambda: checkutil.get_all_tag_groups(cmk), site_name)
+
+    if use_async:
+        # Imported here: async_checkmk imports checkmk and needs httpx, which only the async client uses
+        from async_checkmk import AsyncCheckmk
+        acmk = AsyncCheckmk(cmk_rest_url, cafile, bearerAuth, site_name, log_body_limit, create_transport_config())
+        acmk.metrics = cmk.metrics
+        # Tag validation is synchronous: the catalogue is fetched (once, on first use) over the blocking session of cmk
+        acmk.tag_catalog = cmk.tag_catalog
+        return acmk
 
     return cmk
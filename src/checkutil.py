@@ -1,5 +1,7 @@
+import csv
 import re
-from checkmk import Checkmk
+import sys
+from checkmk import Checkmk, json_loads
 from collections import namedtuple
 
 str_tag_reg = re.compile('^tag_', re.UNICODE)
@@ -17,25 +19,38 @@ def is_tag(hostname: str) -> bool:
     return str_tag_reg.search(hostname) is not None
 
 
-def get_all_hosts_tags(cmk: Checkmk) -> list[Tag]:
-    'Iterate over all hosts and extract their tags. Returns a list of named tuples Tag.'
-    j = cmk.get_all_hosts().res.json()
-    res = []
+def host_tags(host_json: dict):
+    'Yield Tag for every tag attribute of a host object'
+    host_id = host_json['id']
+
+    for key, value in host_json['extensions']['attributes'].items():
+        if is_tag(key):
+            # print(f'{host_id}: tag detected: key: {key} => value: {value}')
+            yield Tag(host_id, key, value)
+
+
+def iter_all_hosts(cmk: Checkmk, workers=None):
+    '''Iterate over all host objects. The host collection is parsed while it is downloaded,
+    with workers set hosts are fetched folder by folder in parallel (Checkmk.iter_all_hosts_sharded).'''
+    if workers:
+        return cmk.iter_all_hosts_sharded(workers)
+    return cmk.get_all_hosts(stream=True).iter_values()
 
-    for host_json in j['value']:
-        host_id = host_json['id']
 
-        for key, value in host_json['extensions']['attributes'].items():
-            if is_tag(key):
-                # print(f'{host_id}: tag detected: key: {key} => value: {value}')
-                t = Tag(host_id, key, value)
-                res.append(t)
-    return res
+def iter_all_hosts_tags(cmk: Checkmk, workers=None):
+    'Iterate over all hosts and yield their tags (named tuples Tag)'
+    for host_json in iter_all_hosts(cmk, workers):
+        yield from host_tags(host_json)
+
+
+def get_all_hosts_tags(cmk: Checkmk, workers=None) -> list[Tag]:
+    'Iterate over all hosts and extract their tags. Returns a list of named tuples Tag.'
+    return list(iter_all_hosts_tags(cmk, workers))
 
 
 def get_all_tag_groups(cmk: Checkmk) -> list[TagGroupOption]:
     'Iterate over all tag groups and their possible values (enums). Return a list of named tuples TagGroupOption'
-    j = cmk.get_all_tag_groups().res.json()
+    j = cmk.get_all_tag_groups().json()
     tag_groups = []
     for tag_group_json in j['value']:
         tag_group_id = tag_group_json['id']
@@ -53,10 +68,15 @@ def get_all_tag_groups(cmk: Checkmk) -> list[TagGroupOption]:
     return tag_groups
 
 
-def get_tag_histogram(cmk: Checkmk) -> list:
-    'Get all tag groups and their possible values and use them for dictionary keys. Each key has a list of hosts that use this tag.'
-    tag_groups = get_all_tag_groups(cmk)
-    host_tags = get_all_hosts_tags(cmk)
+def get_tag_histogram(cmk: Checkmk, snapshot=None, workers=None) -> list:
+    '''Get all tag groups and their possible values and use them for dictionary keys. Each key has a list of hosts that use this tag.
+    Read from snapshot (snapshot.Snapshot) instead of check mk if it is set, fetch hosts folder by folder with workers.'''
+    if snapshot is not None:
+        tag_groups = snapshot.get_all_tag_groups()
+        host_tags = snapshot.iter_all_hosts_tags()
+    else:
+        tag_groups = get_all_tag_groups(cmk)
+        host_tags = iter_all_hosts_tags(cmk, workers)
 
     d = {}
 
@@ -72,11 +92,216 @@ def get_tag_histogram(cmk: Checkmk) -> list:
         key = ht.tag_group, ht.value
 
         # Use the created key TagGroupOption to find the correct entry in hash table and insert the host to its list
-        d[key].append(ht.host)
+        # (tag values missing from the tag group definition get their own entry)
+        d.setdefault(key, []).append(ht.host)
 
     return d
 
 
+class TagIndex:
+    '''Inverted index of host tags.
+    Hosts and (tag_group, value) pairs are interned to integer ids. Every tag value maps to a bitset (python int, bit i = host id i)
+    of hosts that use it, so boolean queries are evaluated with bit operations instead of rescanning hosts.'''
+
+    def __init__(self):
+        self.hosts = []        # host id => hostname
+        self.host_ids = {}     # hostname => host id
+        self.terms = []        # term id => (tag_group, value)
+        self.term_ids = {}     # (tag_group, value) => term id
+        self.term_hosts = []   # term id => list of host ids
+        self.host_terms = []   # host id => set of term ids
+        self.group_terms = {}  # tag_group => list of term ids
+        self.bits = {}         # cache: term id or tag_group => bitset of hosts (cleared on add)
+
+    @classmethod
+    def from_tags(cls, tags, hostnames=()):
+        '''Build index from an iterable of named tuples Tag. hostnames are all hosts: hosts without any tag only
+        appear there, they are needed for NOT and != queries.'''
+        index = cls()
+        for hostname in hostnames:
+            index.host_id(hostname)
+        for t in tags:
+            index.add(t.host, t.tag_group, t.value)
+        return index
+
+    @classmethod
+    def from_hosts(cls, hosts):
+        'Build index from an iterable of host objects (hosts without tags are included)'
+        index = cls()
+        for host_json in hosts:
+            index.host_id(host_json['id'])
+            for t in host_tags(host_json):
+                index.add(t.host, t.tag_group, t.value)
+        return index
+
+    def host_id(self, hostname: str) -> int:
+        hid = self.host_ids.get(hostname)
+        if hid is None:
+            hid = self.host_ids[hostname] = len(self.hosts)
+            self.hosts.append(hostname)
+            self.host_terms.append(set())
+        return hid
+
+    def term_id(self, tag_group: str, value: str) -> int:
+        key = (tag_group, value)
+        tid = self.term_ids.get(key)
+        if tid is None:
+            tid = self.term_ids[key] = len(self.terms)
+            self.terms.append(key)
+            self.term_hosts.append([])
+            self.group_terms.setdefault(tag_group, []).append(tid)
+        return tid
+
+    def add(self, hostname: str, tag_group: str, value: str):
+        'Add tag of a host'
+        hid = self.host_id(hostname)
+        tid = self.term_id(tag_group, value)
+        if tid not in self.host_terms[hid]:
+            self.host_terms[hid].add(tid)
+            self.term_hosts[tid].append(hid)
+            self.bits.clear()
+
+    def ids_to_bits(self, host_ids) -> int:
+        'Bitset of host ids'
+        ba = bytearray((len(self.hosts) + 7) // 8)
+        for hid in host_ids:
+            ba[hid >> 3] |= 1 << (hid & 7)
+        return int.from_bytes(ba, 'little')
+
+    def bits_to_hosts(self, bits: int) -> list:
+        'Hostnames of a bitset (in index order)'
+        res = []
+        for i, byte in enumerate(bits.to_bytes((len(self.hosts) + 7) // 8, 'little')):
+            while byte:
+                low = byte & -byte
+                res.append(self.hosts[(i << 3) + low.bit_length() - 1])
+                byte ^= low
+        return res
+
+    def all_bits(self) -> int:
+        return (1 << len(self.hosts)) - 1
+
+    def tags_of(self, hostname: str) -> dict:
+        'Tags of a host {tag_group: value}'
+        hid = self.host_ids.get(hostname)
+        return {} if hid is None else dict(self.terms[tid] for tid in self.host_terms[hid])
+
+    def hosts_with(self, tag_group: str, value=None) -> int:
+        'Bitset of hosts that have tag_group set to value (or set at all if value is None)'
+        key = tag_group if value is None else self.term_ids.get((tag_group, value))
+        if key is None:
+            return 0
+        bits = self.bits.get(key)
+        if bits is None:
+            if value is None:
+                bits = self.ids_to_bits(hid for tid in self.group_terms.get(tag_group, []) for hid in self.term_hosts[tid])
+            else:
+                bits = self.ids_to_bits(self.term_hosts[key])
+            self.bits[key] = bits
+        return bits
+
+    def evaluate(self, query: str) -> int:
+        'Evaluate query expression (see parse_tag_query) to a bitset of hosts'
+        return parse_tag_query(query)(self)
+
+    def query(self, query: str) -> list:
+        'Hostnames matching query expression'
+        return self.bits_to_hosts(self.evaluate(query))
+
+    def count(self, query: str) -> int:
+        'Number of hosts matching query expression'
+        return self.evaluate(query).bit_count()
+
+    def cardinality(self) -> dict:
+        'Number of hosts per (tag_group, value)'
+        return {term: len(hosts) for term, hosts in zip(self.terms, self.term_hosts)}
+
+
+tag_query_token_reg = re.compile(r'\s*(\(|\)|!=|=|[^\s()!=]+)', re.UNICODE)
+
+
+def parse_tag_query(query: str):
+    '''Compile a boolean tag query to a function TagIndex => bitset of hosts.
+    Grammar (AND binds stronger than OR, keywords are case insensitive):
+        expr := term (OR term)*
+        term := factor (AND factor)*
+        factor := NOT factor | ( expr ) | tag_group=value | tag_group!=value | tag_group
+    Example: tag_os=linux AND NOT (tag_env=prod OR tag_env=test)'''
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        m = tag_query_token_reg.match(query, pos)
+        if m is None:
+            raise ValueError(f'Invalid tag query at position {pos}: {query[pos:]}')
+        tokens.append(m.group(1))
+        pos = m.end()
+    tokens.append(None)
+    i = 0
+
+    def peek_kw():
+        tok = tokens[i]
+        return tok.upper() if tok is not None else None
+
+    def take():
+        nonlocal i
+        tok = tokens[i]
+        i += 1
+        return tok
+
+    def expr():
+        left = term()
+        while peek_kw() == 'OR':
+            take()
+            left = (lambda a, b: lambda idx: a(idx) | b(idx))(left, term())
+        return left
+
+    def term():
+        left = factor()
+        while peek_kw() == 'AND':
+            take()
+            left = (lambda a, b: lambda idx: a(idx) & b(idx))(left, factor())
+        return left
+
+    def factor():
+        tok = take()
+        if tok is None:
+            raise ValueError(f'Unexpected end of tag query: {query}')
+        if tok.upper() == 'NOT':
+            f = factor()
+            return lambda idx: idx.all_bits() & ~f(idx)
+        if tok == '(':
+            f = expr()
+            if take() != ')':
+                raise ValueError(f'Missing ) in tag query: {query}')
+            return f
+        if tok in (')', '=', '!='):
+            raise ValueError(f'Unexpected {tok} in tag query: {query}')
+
+        tag_group = tok
+        if tokens[i] in ('=', '!='):
+            op = take()
+            value = take()
+            if value is None or value in ('(', ')', '=', '!='):
+                raise ValueError(f'Missing value for {tag_group} in tag query: {query}')
+            if op == '=':
+                return lambda idx: idx.hosts_with(tag_group, value)
+            return lambda idx: idx.all_bits() & ~idx.hosts_with(tag_group, value)
+        return lambda idx: idx.hosts_with(tag_group)
+
+    f = expr()
+    if tokens[i] is not None:
+        raise ValueError(f'Unexpected {tokens[i]} in tag query: {query}')
+    return f
+
+
+def get_tag_index(cmk: Checkmk, snapshot=None) -> TagIndex:
+    'Build TagIndex of all hosts (from snapshot if it is set)'
+    if snapshot is not None:
+        return TagIndex.from_tags(snapshot.iter_all_hosts_tags(), snapshot.host_names())
+    return TagIndex.from_hosts(iter_all_hosts(cmk))
+
+
 def get_tag_group_list(cmk: Checkmk, tag_group_name: str) -> list:
     'Return entire tag group in a list of named tuples TagGroupOption'
     res = cmk.get_tag_group(tag_group_name)
@@ -85,11 +310,87 @@ def get_tag_group_list(cmk: Checkmk, tag_group_name: str) -> list:
         print(f'Query failed ({res.res.status_code})!')
         return None
 
-    tag_group_id = res.res.json()['id']
-    tags_json = res.res.json()['extensions']['tags']
+    j = res.json()
+    tag_group_id = j['id']
+    tags_json = j['extensions']['tags']
     tags = []
     for tag_json in tags_json:
         t = TagGroupOption(tag_group_id, tag_json['id'], tag_json['title'], tag_json['aux_tags'])
         tags.append(t)
 
     return tags
+
+
+def open_input(filename: str):
+    'Open filename for reading (- is stdin)'
+    return sys.stdin if filename == '-' else open(filename, 'r', newline='')
+
+
+def is_ndjson(filename: str) -> bool:
+    'NDJSON files end with .ndjson, .jsonl or .json. Everything else is read as CSV.'
+    return filename.endswith(('.ndjson', '.jsonl', '.json'))
+
+
+def read_records(filename: str, ndjson=None):
+    '''Stream records (dicts) from a CSV (; separated, with header) or NDJSON file one line at a time.
+    ndjson=None detects the format from the file extension.'''
+    if ndjson is None:
+        ndjson = is_ndjson(filename)
+
+    f = open_input(filename)
+    try:
+        if ndjson:
+            for line in f:
+                if line.strip():
+                    yield json_loads(line)
+        else:
+            for row in csv.DictReader(f, delimiter=';'):
+                yield row
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def host_attributes(rec: dict) -> dict:
+    '''Collect host attributes from a flat record (CSV row): every column except host_name/hostname and folder
+    that has a value. Column ip is an alias for ipaddress.'''
+    attributes = dict(rec.get('attributes') or {})
+    for key, value in rec.items():
+        if key in ('host_name', 'hostname', 'folder', 'attributes', 'update_attributes', 'remove_attributes') or value in (None, ''):
+            continue
+        attributes['ipaddress' if key == 'ip' else key] = value
+    return attributes
+
+
+def record_hostname(rec: dict) -> str:
+    'Host name of a record (column host_name or hostname)'
+    return rec.get('host_name') or rec['hostname']
+
+
+def read_hosts_create(filename: str, ndjson=None):
+    'Stream bulk create entries {host_name, folder, attributes} from a CSV/NDJSON file'
+    for rec in read_records(filename, ndjson):
+        yield {'host_name': record_hostname(rec), 'folder': rec.get('folder') or '/', 'attributes': host_attributes(rec)}
+
+
+def read_hosts_update(filename: str, ndjson=None):
+    '''Stream bulk update entries from a CSV/NDJSON file.
+    NDJSON records may contain update_attributes, attributes or remove_attributes, other columns are added to update_attributes.'''
+    for rec in read_records(filename, ndjson):
+        entry = {'host_name': record_hostname(rec)}
+        if 'attributes' in rec:
+            entry['attributes'] = rec['attributes']
+        else:
+            update_attributes = dict(rec.get('update_attributes') or {})
+            update_attributes.update(host_attributes({k: v for k, v in rec.items() if k != 'attributes'}))
+            if update_attributes:
+                entry['update_attributes'] = update_attributes
+        if rec.get('remove_attributes'):
+            entry['remove_attributes'] = rec['remove_attributes']
+        yield entry
+
+
+def read_hosts_delete(filename: str, ndjson=None):
+    'Stream host names to delete from a CSV/NDJSON file'
+    for rec in read_records(filename, ndjson):
+        yield record_hostname(rec)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import argparse
+import inspect
+import os
+import sys
+import tasks as t
+
+
+# Author: Blaž Poje
+# cli <=> fast start frontend
+#
+# Same tasks (names, aliases and options) as fabfile.py without importing Fabric, Invoke and Paramiko.
+# The commands run the plain functions of tasks.py, they import requests, checkmk and checkutil only for the command that runs.
+# All operations are read only without parameter 'doit'.
+#
+#   $ checkmk get-host -h myhost
+#   $ checkmk ut myhost tag_env prod -d
+
+# command => (function in tasks.py, aliases, print return value)
+COMMANDS = {
+    'get-host': (t.get_host, ['h'], True),
+    'delete-host': (t.delete_host, ['d'], True),
+    'create-host': (t.create_host, ['c'], True),
+    'update-host': (t.update_host, ['u'], True),
+    'bulk-create-hosts': (t.bulk_create_hosts, ['bc'], False),
+    'bulk-update-hosts': (t.bulk_update_hosts, ['bu'], False),
+    'bulk-delete-hosts': (t.bulk_delete_hosts, ['bd'], False),
+    'reconcile': (t.reconcile, ['rc'], False),
+    'check-file': (t.check_file, ['cf'], False),
+    'update-host-tag': (t.update_host_tag, ['ut'], True),
+    'remove-host-tag': (t.remove_host_tag, ['rt'], True),
+    'update-host-ip': (t.update_host_ip, ['ui'], True),
+    'remove-host-ip': (t.remove_host_ip, ['ri'], True),
+    'activate': (t.activate, ['a'], True),
+    'discover': (t.discover, ['di'], True),
+    'discover-fixall': (t.discover_fixall, ['df'], True),
+    'bulk-discover': (t.bulk_discover, ['bdi'], True),
+    'get-etag': (t.get_etag, ['etag'], True),
+    'get-tag-group': (t.get_tag_group, ['gtg'], True),
+    'snapshot-refresh': (t.snapshot_refresh, ['sr'], False),
+    'get-all-hosts': (t.get_all_hosts, ['ah'], False),
+    'get-all-hosts-in-folder': (t.get_all_hosts_in_folder, ['ahf'], False),
+    'get-all-folders': (t.get_all_folders, ['gaf'], False),
+    'get-all-tags': (t.get_all_tags, ['at'], False),
+    'get-all-tag-group': (t.get_all_tag_group, ['atg'], False),
+    'get-tag-hist': (t.get_tag_hist, ['th'], False),
+    'tag-query': (t.tag_query, ['tq'], False),
+    'sites-get-host': (t.sites_get_host, ['sh'], False),
+    'sites-get-all-tags': (t.sites_get_all_tags, ['sat'], False),
+    'sites-get-tag-hist': (t.sites_get_tag_hist, ['sth'], False),
+    'sites-activate': (t.sites_activate, ['sa'], False),
+    'host-status': (t.host_status, ['hs'], False),
+    'service-status': (t.service_status, ['ss'], False),
+    'watch': (t.watch, ['w'], False),
+    'batch': (t.batch, ['b'], False),
+    'daemon': (t.daemon, [], False),
+    'test': (t.test, ['tes'], False),
+}
+
+# alias => command
+ALIASES = {alias: name for name, (fn, aliases, autoprint) in COMMANDS.items() for alias in aliases}
+
+
+def build_parser(name: str) -> argparse.ArgumentParser:
+    '''Build parser of one command from its signature (like invoke): every parameter is an option --param-name with
+    the first free letter as short flag, parameters without default can also be given positionally.'''
+    fn = COMMANDS[name][0]
+    help = t.HELP.get(name, {})
+    parser = argparse.ArgumentParser(prog=f'checkmk {name}', description=fn.__doc__, add_help=False)
+    parser.add_argument('--help', action='help', help='Show this help')
+    short = set()
+    for param in inspect.signature(fn).parameters.values():
+        opt = param.name.replace('_', '-')
+        flags = [f'--{opt}']
+        if opt[0] not in short and param.name not in t.LONG_ONLY:
+            short.add(opt[0])
+            flags.insert(0, f'-{opt[0]}')
+        default = None if param.default is inspect.Parameter.empty else param.default
+        kwargs = {'dest': param.name, 'default': default, 'help': help.get(opt)}
+        if isinstance(default, bool):
+            parser.add_argument(*flags, action='store_true', **kwargs)
+        else:
+            parser.add_argument(*flags, type=int if isinstance(default, int) else str, **kwargs)
+        if param.default is inspect.Parameter.empty:
+            parser.add_argument(f'_{param.name}', nargs='?', metavar=param.name, help=argparse.SUPPRESS)
+    return parser
+
+
+def print_list():
+    print('Available commands:\n')
+    for name, (fn, aliases, autoprint) in COMMANDS.items():
+        label = f'{name} ({", ".join(aliases)})' if aliases else name
+        doc = (fn.__doc__ or '').split('\n')[0]
+        print(f'  {label:<32}{doc}')
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-l', '--list', '-h', '--help'):
+        print_list()
+        return 0
+
+    name = ALIASES.get(argv[0], argv[0])
+    if name not in COMMANDS:
+        print(f'No idea what \'{argv[0]}\' is!', file=sys.stderr)
+        return 1
+
+    fn, aliases, autoprint = COMMANDS[name]
+    parser = build_parser(name)
+    args = vars(parser.parse_args(argv[1:]))
+
+    # Fill parameters without default from positional values
+    kwargs = {}
+    for param in inspect.signature(fn).parameters.values():
+        value = args[param.name]
+        if param.default is inspect.Parameter.empty:
+            value = value if value is not None else args[f'_{param.name}']
+            if value is None:
+                parser.error(f'missing required argument: --{param.name.replace("_", "-")}')
+        kwargs[param.name] = value
+
+    res = fn(**kwargs)
+    if autoprint and res is not None:
+        print(res)
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        # The reader of stdout is gone (| head): send the rest to devnull, so flushing it at exit does not fail again
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+        sys.exit(1)
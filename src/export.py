@@ -0,0 +1,200 @@
+from contextlib import contextmanager
+import csv
+import gzip
+import io
+import os
+import sys
+from checkmk import json_dumps
+
+# Use zstandard for .zst output if it is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Streaming report export
+#
+# Reports (hosts, tags, tag histogram, monitoring state) are written record by record as they are produced, through
+# one large write buffer, to stdout or a file. Nothing is collected in memory first, so a 100k host export needs
+# as much memory as one host object. Formats:
+#   json    {"value": [...]} like the REST collections, with the links, id, domainType, ... of the collection if they
+#           are passed as envelope (get_all_hosts from check mk keeps its old output)
+#   ndjson  one JSON object per line
+#   csv     ; separated with header, lists/dicts as JSON
+# Files ending with .gz (gzip) or .zst (zstandard, if installed) are compressed, or set compress explicitly.
+
+FORMATS = ['json', 'ndjson', 'csv']
+COMPRESSIONS = ['gzip', 'zstd']
+BUFFER_SIZE = 1 << 20
+
+HOST_COLUMNS = ['host_name', 'folder', 'attributes']
+TAG_COLUMNS = ['host', 'tag_group', 'value']
+HISTOGRAM_COLUMNS = ['tag_group', 'tag_value', 'host']
+TAG_GROUP_COLUMNS = ['tag_group', 'tag_val_id', 'tag_val_title']
+# CSV header of the tag group report (names of the original get_all_tag_group output)
+TAG_GROUP_HEADER = ['tag_group', 'tag_group_value', 'tag_group_value_title']
+FOLDER_COLUMNS = ['folder', 'title', 'hosts']
+
+
+def compression(filename: str, compress=None) -> str:
+    'Compression of filename: compress if it is set, otherwise by extension (None: uncompressed)'
+    if compress:
+        if compress not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compress} ({" or ".join(COMPRESSIONS)})')
+        return compress
+    if filename.endswith('.gz'):
+        return 'gzip'
+    if filename.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+@contextmanager
+def open_output(filename='-', compress=None, buffer_size=BUFFER_SIZE, line_buffering=False):
+    '''Buffered text stream to filename (- is stdout), compressed with gzip or zstd. stdout is flushed but not closed.
+    line_buffering=True flushes every line (output of long running tasks). If the reader of stdout goes away (| head)
+    the process exits quietly.'''
+    compress = compression(filename, compress)
+    if compress == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+
+    if filename == '-':
+        sys.stdout.flush()
+        raw = sys.stdout.buffer
+    else:
+        raw = open(filename, 'wb', buffering=0)
+    if compress == 'gzip':
+        sink = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+    elif compress == 'zstd':
+        sink = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    else:
+        sink = None
+
+    out = io.TextIOWrapper(io.BufferedWriter(sink if sink is not None else raw, buffer_size), encoding='utf-8', newline='',
+                           line_buffering=line_buffering)
+    try:
+        yield out
+        out.flush()
+    except BrokenPipeError:
+        if filename != '-':
+            raise
+        # The reader of stdout is gone (| head): send the rest to devnull, so flushing it does not fail again, and stop
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+        sys.exit(1)
+    finally:
+        # Detach the wrappers so closing them does not close stdout
+        out.detach().detach()
+        if sink is not None:
+            sink.close()
+        if filename == '-':
+            raw.flush()
+        else:
+            raw.close()
+
+
+def cell(value) -> str:
+    if value is None:
+        return ''
+    return json_dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+
+def as_dict(record) -> dict:
+    'Record as dict (namedtuples are converted)'
+    return record._asdict() if hasattr(record, '_asdict') else record
+
+
+def write_records(out, records, fmt='ndjson', columns=None, header=None, envelope=None) -> int:
+    '''Write records (dicts or namedtuples) to the text stream out in fmt. csv needs columns (missing values are empty),
+    its header row is header (default: the column names). json writes the fields of the dict envelope after value
+    (it is read after the records, so it may be filled while they are produced). Returns the number of records.'''
+    count = 0
+    if fmt == 'ndjson':
+        for rec in records:
+            out.write(json_dumps(as_dict(rec)))
+            out.write('\n')
+            count += 1
+    elif fmt == 'json':
+        out.write('{"value": [')
+        for rec in records:
+            if count:
+                out.write(', ')
+            out.write(json_dumps(as_dict(rec)))
+            count += 1
+        out.write(']')
+        for k, v in (envelope or {}).items():
+            out.write(f', {json_dumps(k)}: {json_dumps(v)}')
+        out.write('}\n')
+    elif fmt == 'csv':
+        if not columns:
+            raise ValueError('csv format needs columns')
+        w = csv.writer(out, delimiter=';', lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
+        w.writerow(header or columns)
+        for rec in records:
+            rec = as_dict(rec)
+            w.writerow([cell(rec.get(c)) for c in columns])
+            count += 1
+    else:
+        raise ValueError(f'Unknown format {fmt} ({", ".join(FORMATS)})')
+    return count
+
+
+def export(records, fmt='ndjson', columns=None, filename='-', compress=None, header=None, envelope=None) -> int:
+    'Stream records to filename (- is stdout) in fmt, returns the number of records'
+    with open_output(filename, compress) as out:
+        return write_records(out, records, fmt, columns, header, envelope)
+
+
+def print_lines(lines, filename='-'):
+    'Write lines (without newline) to filename (- is stdout) while they are produced, every line is flushed'
+    with open_output(filename, line_buffering=True) as out:
+        for line in lines:
+            out.write(line)
+            out.write('\n')
+
+
+def host_rows(hosts):
+    'CSV rows {host_name, folder, attributes} of host objects'
+    for h in hosts:
+        ext = h.get('extensions', {})
+        yield {'host_name': h.get('id') or h.get('title'), 'folder': ext.get('folder'), 'attributes': ext.get('attributes')}
+
+
+def histogram_rows(histogram: dict):
+    'Rows {tag_group, tag_value, host} of a tag histogram, tag values without hosts get one row with an empty host'
+    for (tag_group, tag_value), hosts in histogram.items():
+        for host in hosts:
+            yield {'tag_group': tag_group, 'tag_value': tag_value, 'host': host}
+        if not hosts:
+            yield {'tag_group': tag_group, 'tag_value': tag_value, 'host': ''}
+
+
+def export_hosts(hosts, fmt='json', filename='-', compress=None, envelope=None) -> int:
+    'Export host objects: full objects as json/ndjson (json with the collection envelope), host_name;folder;attributes as csv'
+    if fmt == 'csv':
+        return export(host_rows(hosts), fmt, HOST_COLUMNS, filename, compress)
+    return export(hosts, fmt, None, filename, compress, envelope=envelope)
+
+
+def folder_rows(folders):
+    'CSV rows {folder, title, hosts} of folder objects (hosts only if they were requested with show_hosts)'
+    for f in folders:
+        hosts = f.get('members', {}).get('hosts', {}).get('value', [])
+        yield {'folder': f.get('extensions', {}).get('path') or f.get('id'), 'title': f.get('title'),
+               'hosts': ','.join(link.get('title') or link['href'].rsplit('/', 1)[-1] for link in hosts)}
+
+
+def export_folders(folders, fmt='json', filename='-', compress=None, envelope=None) -> int:
+    'Export folder objects: full objects as json/ndjson (json with the collection envelope), folder;title;hosts as csv'
+    if fmt == 'csv':
+        return export(folder_rows(folders), fmt, FOLDER_COLUMNS, filename, compress)
+    return export(folders, fmt, None, filename, compress, envelope=envelope)
+
+
+def iter_collection(json_res, what: str, envelope=None):
+    'Yield the members of a (streamed) collection response, raise if the request failed. See JsonResult.iter_values.'
+    if not json_res.ok():
+        raise Exception(f'{what} failed ({json_res.res.status_code}): {json_res.res.text}')
+    yield from json_res.iter_values(envelope=envelope)
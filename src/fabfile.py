@@ -1,178 +1,253 @@
-import csv
 import logging
-import sys
-import json
-from fabric import task
-from checkmk import Checkmk, create_checkmk, split_hosts
-import checkutil as p
+from fabric import task, Task
+import tasks as t
 
 
 # Author: Blaž Poje
 # fabfile <=> frontend
 # vse operacije na frontendu so read only, če ni parametra 'doit'
+#
+# The task bodies are plain functions in tasks.py (cli.py runs the same functions without Fabric).
 
 
-@task(aliases=['h'], help={'get-effective-attributes': 'Fetch effective_attributes for this check mk host'}, autoprint=True)
+class LongOnlyTask(Task):
+    'Task without short flags for destructive switches (t.LONG_ONLY), they have to be typed out'
+
+    def arg_opts(self, name, default, taken_names):
+        opts = super().arg_opts(name, default, taken_names)
+        if name in t.LONG_ONLY:
+            opts['names'] = opts['names'][:1]
+        return opts
+
+
+@task(aliases=['h'], help=t.HELP['get-host'], autoprint=True)
 def get_host(c, hostname, get_effective_attributes=False):
     'check mk: get host'
-    return json.dumps(create_checkmk().get_host(hostname, get_effective_attributes).res.json())
+    return t.get_host(hostname, get_effective_attributes)
 
 
-@task(aliases=['d'], help={'doit': 'Enable modification (without this flag it is read only)'}, autoprint=True)
+@task(aliases=['d'], help=t.HELP['delete-host'], autoprint=True)
 def delete_host(c, hostname, doit=False):
     'check mk: delete host'
-    if doit:
-        return create_checkmk().delete_host(hostname)
+    return t.delete_host(hostname, doit)
 
 
-@task(aliases=['c'], help={'doit': 'Enable modification (without this flag it is read only)'}, autoprint=True)
+@task(aliases=['c'], help=t.HELP['create-host'], autoprint=True)
 def create_host(c, hostname, folder, ip=None, alias=None, doit=False):
     'check mk: create host'
-    if doit:
-        return json.dumps(create_checkmk().create_host(hostname, folder, ip, alias).res.json())
+    return t.create_host(hostname, folder, ip, alias, doit)
 
 
-@task(aliases=['u'], help={'doit': 'Enable modification (without this flag it is read only)'}, autoprint=True)
+@task(aliases=['u'], help=t.HELP['update-host'], autoprint=True)
 def update_host(c, hostname, data, etag, doit=False):
     '''check mk: update host
     Change only one parameter: data = {"update_attributes": {"tag_shop": "value1"}}
     Change all checkmk host parameters (any parameters not defined in body will be cleared): data = {"attributes": {"ipaddress": "192.168.0.6"}}
     Remove checkmk parameter (don't change other parameters): data = {"remove_attributes": ["tag_shop_type"]}
     '''
-    if doit:
-        return json.dumps(create_checkmk().update_host(hostname, data, etag).res.json())
+    return t.update_host(hostname, data, etag, doit)
+
+
+@task(aliases=['bc'], help=t.HELP['bulk-create-hosts'])
+def bulk_create_hosts(c, filename, chunk_size=100, doit=False):
+    'check mk: create hosts from CSV/NDJSON file'
+    t.bulk_create_hosts(filename, chunk_size, doit)
+
+
+@task(aliases=['bu'], help=t.HELP['bulk-update-hosts'])
+def bulk_update_hosts(c, filename, chunk_size=100, doit=False):
+    'check mk: update hosts from CSV/NDJSON file'
+    t.bulk_update_hosts(filename, chunk_size, doit)
+
+
+@task(aliases=['bd'], help=t.HELP['bulk-delete-hosts'])
+def bulk_delete_hosts(c, filename, chunk_size=100, doit=False):
+    'check mk: delete hosts from CSV/NDJSON file'
+    t.bulk_delete_hosts(filename, chunk_size, doit)
+
 
+@task(aliases=['rc'], help=t.HELP['reconcile'], klass=LongOnlyTask)
+def reconcile(c, filename, prune=False, scope=None, chunk_size=100, doit=False):
+    'check mk: make hosts match the desired inventory with a minimal set of bulk changes (NDJSON output)'
+    t.reconcile(filename, prune, scope, chunk_size, doit)
 
-@task(aliases=['ut'], help={'doit': 'Enable modification (without this flag it is read only)'}, autoprint=True)
+
+@task(aliases=['cf'], help=t.HELP['check-file'])
+def check_file(c, filename, refresh=False):
+    'Check host names and tags of a bulk/reconcile input file against the tag catalogue, print every invalid row (CSV)'
+    t.check_file(filename, refresh)
+
+
+@task(aliases=['ut'], help=t.HELP['update-host-tag'], autoprint=True)
 def update_host_tag(c, hostname, tag_group, tag_group_value, doit=False):
     'check mk: update host tag'
-    if doit:
-        return json.dumps(create_checkmk().update_host_tag(hostname, tag_group, tag_group_value).res.json())
+    return t.update_host_tag(hostname, tag_group, tag_group_value, doit)
 
 
-@task(aliases=['rt'], help={'doit': 'Enable modification (without this flag it is read only)'}, autoprint=True)
+@task(aliases=['rt'], help=t.HELP['remove-host-tag'], autoprint=True)
 def remove_host_tag(c, hostname, tag_group, doit=False):
     'check mk: remove host tag'
-    if doit:
-        return json.dumps(create_checkmk().remove_host_tag(hostname, tag_group).res.json())
+    return t.remove_host_tag(hostname, tag_group, doit)
 
 
-@task(aliases=['ui'], help={'doit': 'Enable modification (without this flag it is read only)'}, autoprint=True)
+@task(aliases=['ui'], help=t.HELP['update-host-ip'], autoprint=True)
 def update_host_ip(c, hostname, ip, doit=False):
     'check mk: update host ip'
-    if doit:
-        return json.dumps(create_checkmk().update_host_ipaddress(hostname, ip).res.json())
+    return t.update_host_ip(hostname, ip, doit)
 
 
-@task(aliases=['ri'], help={'doit': 'Enable modification (without this flag it is read only)'}, autoprint=True)
+@task(aliases=['ri'], help=t.HELP['remove-host-ip'], autoprint=True)
 def remove_host_ip(c, hostname, doit=False):
     'check mk: remove host ip'
-    if doit:
-        return json.dumps(create_checkmk().remove_host_ipaddress(hostname).res.json())
+    return t.remove_host_ip(hostname, doit)
 
 
-@task(aliases=['a'], autoprint=True)
-def activate(c, force_foreign_changes=False, doit=False):
+@task(aliases=['a'], help=t.HELP['activate'], autoprint=True)
+def activate(c, force_foreign_changes=False, wait=False, if_pending=False, timeout=None, doit=False):
     'check mk: activate'
-    if doit:
-        return json.dumps(create_checkmk().activate_changes(force_foreign_changes).res.json())
-    else:
-        print(f'doit: {doit}')
+    return t.activate(force_foreign_changes, wait, if_pending, timeout, doit)
 
 
-@task(aliases=['di'], help={'doit': 'Enable modification (without this flag it is read only)', 'mode': 'mode is one of the enum values: [\'new\', \'remove\', \'fix_all\', \'refresh\', \'only_host_labels\']', 'hostnames': 'hostnames separated with ; or ,'}, autoprint=True)
-def discover(c, hostnames, mode, doit=False):
+@task(aliases=['di'], help=t.HELP['discover'], autoprint=True)
+def discover(c, hostnames, mode, workers=1, timeout=None, doit=False):
     '''check mk: discover services on check mk hosts'''
-    if doit:
-        return create_checkmk().discover_services(split_hosts(hostnames), mode)
-    else:
-        print(f'doit: {doit}')
+    return t.discover(hostnames, mode, workers, timeout, doit)
 
 
-@task(aliases=['df'], help={'doit': 'Enable modification (without this flag it is read only)', 'hostnames': 'hostnames separated with ; or ,'}, autoprint=True)
-def discover_fixall(c, hostnames, doit=False):
+@task(aliases=['df'], help=t.HELP['discover-fixall'], autoprint=True)
+def discover_fixall(c, hostnames, workers=1, timeout=None, doit=False):
     '''check mk: Fix all services on check mk hosts'''
-    if doit:
-        return create_checkmk().discover_fixall(split_hosts(hostnames))
-    else:
-        print(f'doit: {doit}')
+    return t.discover_fixall(hostnames, workers, timeout, doit)
+
+
+@task(aliases=['bdi'], help=t.HELP['bulk-discover'], autoprint=True)
+def bulk_discover(c, hostnames, mode, batch_size=10, timeout=None, doit=False):
+    '''check mk: discover services on check mk hosts with a server side background job'''
+    return t.bulk_discover(hostnames, mode, batch_size, timeout, doit)
 
 
 @task(aliases=['etag'], autoprint=True)
 def get_etag(c, hostname):
     'check mk: get etag value (value that changes on every modification of check mk host)'
-    return create_checkmk().get_etag(hostname)
+    return t.get_etag(hostname)
 
 
 @task(aliases=['gtg'], autoprint=True)
 def get_tag_group(c, tag_group_name):
     'check mk: Get a host tag group with all its values'
-    j = create_checkmk().get_tag_group(tag_group_name).res.json()
-    return json.dumps(j)
+    return t.get_tag_group(tag_group_name)
 
 
-@task(aliases=['ah'], autoprint=True)
-def get_all_hosts(c):
+@task(aliases=['sr'], help=t.HELP['snapshot-refresh'])
+def snapshot_refresh(c, folders=None, hostnames=None, full=False):
+    'Refresh the local inventory snapshot (all hosts, folders and tag groups if no folders or hostnames are given)'
+    t.snapshot_refresh(folders, hostnames, full)
+
+
+@task(aliases=['ah'], help=t.HELP['get-all-hosts'])
+def get_all_hosts(c, max_age=None, shards=0, format='json', output='-', compress=None):
     'check mk: get all hosts in json'
-    j = create_checkmk().get_all_hosts().res.json()
-    return json.dumps(j)
+    t.get_all_hosts(max_age, shards, format, output, compress)
 
 
-@task(aliases=['ahf'], autoprint=True)
-def get_all_hosts_in_folder(c, folder):
+@task(aliases=['ahf'], help=t.HELP['get-all-hosts-in-folder'])
+def get_all_hosts_in_folder(c, folder, format='json', output='-', compress=None):
     'check mk: get all hosts in folder'
-    j = create_checkmk().get_all_hosts_in_folder(folder).res.json()
-    return json.dumps(j)
+    t.get_all_hosts_in_folder(folder, format, output, compress)
 
 
-@task(aliases=['gaf'], autoprint=True)
-def get_all_folders(c, parent, recursive=False, show_hosts=False):
-    '''check mk: lists subfolders (and the hosts in subfolders) of folder x. It won't show the files that are in folder x. 
-    parent string - Show all sub-folders of this folder. The default is the root-folder. Path delimiters can be either ~, / or \. Please use the one most appropriate for your quoting/escaping needs. A good default choice is ~.
+@task(aliases=['gaf'], help=t.HELP['get-all-folders'])
+def get_all_folders(c, parent, recursive=False, show_hosts=False, format='json', output='-', compress=None):
+    '''check mk: lists subfolders (and the hosts in subfolders) of folder x. It won't show the files that are in folder x.
+    parent string - Show all sub-folders of this folder. The default is the root-folder. Path delimiters can be either ~, / or \\. Please use the one most appropriate for your quoting/escaping needs. A good default choice is ~.
     recursive boolean - List the folder (default: root) and all its sub-folders recursively.
     show_hosts boolean - When set, all hosts that are stored in each folder will also be shown. On large setups this may come at a performance cost, so by default this is switched off.
     '''
-    j = create_checkmk().get_all_folders(parent, recursive, show_hosts).res.json()
-    return json.dumps(j)
+    t.get_all_folders(parent, recursive, show_hosts, format, output, compress)
 
 
-@task(aliases=['at'])
-def get_all_tags(c):
+@task(aliases=['at'], help=t.HELP['get-all-tags'])
+def get_all_tags(c, max_age=None, shards=0, format='csv', output='-', compress=None):
     'Iterate over all hosts and extract their tags in CSV form'
-    res = p.get_all_hosts_tags(create_checkmk())
-    print('host;tag_group;value')
-    for t in res:
-        print(f'{t.host};{t.tag_group};{t.value}')
+    t.get_all_tags(max_age, shards, format, output, compress)
 
 
-@task(aliases=['atg'])
-def get_all_tag_group(c):
+@task(aliases=['atg'], help=t.HELP['get-all-tag-group'])
+def get_all_tag_group(c, max_age=None, format='csv', output='-', compress=None):
     'Iterate over all tag groups and their possible values (enums) in CSV form'
-    res = p.get_all_tag_groups(create_checkmk())
-    print('tag_group;tag_group_value;tag_group_value_title')
-    for t in res:
-        print(f'{t.tag_group};{t.tag_val_id};{t.tag_val_title}')
+    t.get_all_tag_group(max_age, format, output, compress)
 
 
-@task(aliases=['th'])
-def get_tag_hist(c):
+@task(aliases=['th'], help=t.HELP['get-tag-hist'])
+def get_tag_hist(c, max_age=None, shards=0, format='csv', output='-', compress=None):
     'Get all tag groups and their possible values and left join them with hosts that use them. In CSV form'
-    res = p.get_tag_histogram(create_checkmk())
-    print('tag_group;tag_value;host')
-    for key, hosts in res.items():
-        tag_group = key[0]
-        tag_val_id = key[1]
-        for host in hosts:
-            print(f'{tag_group};{tag_val_id};{host}')
-        if not hosts:
-            # Print even if list is empty
-            print(f'{tag_group};{tag_val_id};')
+    t.get_tag_hist(max_age, shards, format, output, compress)
+
+
+@task(aliases=['tq'], help=t.HELP['tag-query'])
+def tag_query(c, query, count=False, max_age=None):
+    'Print hosts whose tags match a boolean tag query'
+    t.tag_query(query, count, max_age)
+
+
+@task(aliases=['sh'], help=t.HELP['sites-get-host'])
+def sites_get_host(c, hostname, sites_file=None, site_names=None):
+    'all sites: get host from every site that knows it (NDJSON: site, host)'
+    t.sites_get_host(hostname, sites_file, site_names)
+
+
+@task(aliases=['sat'], help=t.HELP['sites-get-all-tags'])
+def sites_get_all_tags(c, sites_file=None, site_names=None, shards=0, format='csv', output='-', compress=None):
+    'all sites: iterate over all hosts of all sites and extract their tags in CSV form'
+    t.sites_get_all_tags(sites_file, site_names, shards, format, output, compress)
+
+
+@task(aliases=['sth'], help=t.HELP['sites-get-tag-hist'])
+def sites_get_tag_hist(c, sites_file=None, site_names=None, shards=0, format='csv', output='-', compress=None):
+    'all sites: tag histogram of every site in CSV form'
+    t.sites_get_tag_hist(sites_file, site_names, shards, format, output, compress)
+
+
+@task(aliases=['sa'], help=t.HELP['sites-activate'])
+def sites_activate(c, sites_file=None, site_names=None, force_foreign_changes=False, wait=False, if_pending=False, timeout=None, doit=False):
+    'all sites: activate changes on all sites in parallel (NDJSON: site and activation summary)'
+    t.sites_activate(sites_file, site_names, force_foreign_changes, wait, if_pending, timeout, doit)
+
+
+@task(aliases=['hs'], help=t.HELP['host-status'])
+def host_status(c, query=None, columns=None, state=None, tag=None, format='csv', output='-', compress=None):
+    'check mk: monitoring state of hosts, filtered on the server'
+    t.host_status(query, columns, state, tag, format, output, compress)
+
+
+@task(aliases=['ss'], help=t.HELP['service-status'])
+def service_status(c, query=None, columns=None, state=None, tag=None, hostname=None, format='csv', output='-', compress=None):
+    'check mk: monitoring state of services, filtered on the server'
+    t.service_status(query, columns, state, tag, hostname, format, output, compress)
+
+
+@task(aliases=['w'], help=t.HELP['watch'])
+def watch(c, interval=60, cycles=0, mode='etag', workers=8, initial=False, state_file=None):
+    'check mk: print created, changed and deleted hosts as NDJSON events'
+    t.watch(interval, cycles, mode, workers, initial, state_file)
+
+
+@task(aliases=['b'], help=t.HELP['batch'])
+def batch(c, filename='-', workers=1, daemon=False):
+    'Run operations (fab task names and arguments) from NDJSON over one session, print NDJSON results in input order'
+    t.batch(filename, workers, daemon)
+
+
+@task(help=t.HELP['daemon'])
+def daemon(c, socket=None, workers=1):
+    'Keep a check mk session open and run batches sent to the unix socket (fab batch --daemon)'
+    t.daemon(socket, workers)
 
 
 @task(aliases=['tes'])
 def test(c):
     'test'
-    print('test')
+    t.test()
 
 
 def init_logger():
@@ -0,0 +1,189 @@
+import atexit
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+
+# Per request instrumentation of Checkmk.rest_query
+#
+# Records latency histograms, response sizes, status codes and retries per site and endpoint and the time spent in
+# JSON decoding (streamed bodies are parsed while they are read, so their decode time includes the download). Exported as JSON summary, Prometheus textfile (node_exporter textfile collector) or a trace log with one
+# NDJSON line per request. create_checkmk() enables it from env:
+#   METRICS_JSON=file (- for stderr)   METRICS_PROM=file   TRACE_LOG=file
+
+# Latency histogram buckets in seconds (upper bounds, +Inf is implicit)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# /objects/{domain_type}/{id}... => object id replaced with {id}, query string dropped
+object_id_reg = re.compile(r'^(/objects/[^/]+/)[^/?]+')
+
+
+def endpoint(url_action: str) -> str:
+    'Endpoint template of a REST url (without host names, folders and query string)'
+    return object_id_reg.sub(r'\1{id}', url_action.split('?', 1)[0])
+
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.bytes = 0
+        self.retries = 0
+        self.statuses = {}
+
+    def add(self, status, seconds: float, size: int, retries: int):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.bytes += size
+        self.retries += retries
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def quantile(self, q: float) -> float:
+        'Upper bucket bound of quantile q (the largest observed value if it is above the last bucket, so it stays valid JSON)'
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max_seconds
+
+
+class Metrics:
+    def __init__(self, trace_file=None):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.decode_count = 0
+        self.decode_seconds = 0.0
+        self.started = time.time()
+        self.trace = open(trace_file, 'a', buffering=1) if trace_file else None
+
+    def record(self, method: str, url_action: str, status, seconds: float, size: int, retries=0, site=''):
+        'Record one request to site (status None if it failed without response)'
+        key = (site or '', method, endpoint(url_action))
+        with self.lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats()
+            stats.add(status, seconds, size, retries)
+            if self.trace is not None:
+                self.trace.write(json.dumps({'ts': time.time(), 'site': key[0], 'method': method, 'endpoint': key[2], 'url': url_action,
+                                             'status': status, 'seconds': round(seconds, 6), 'bytes': size,
+                                             'retries': retries}) + '\n')
+
+    def record_decode(self, seconds: float):
+        'Record time spent in JSON decoding of one response body'
+        with self.lock:
+            self.decode_count += 1
+            self.decode_seconds += seconds
+
+    def summary(self) -> dict:
+        'All metrics as a dictionary'
+        with self.lock:
+            endpoints = []
+            for (site, method, ep), s in sorted(self.endpoints.items(), key=lambda kv: -kv[1].seconds):
+                endpoints.append({
+                    'site': site, 'method': method, 'endpoint': ep, 'requests': s.count, 'seconds': round(s.seconds, 6),
+                    'mean_ms': round(s.seconds / s.count * 1000, 3), 'max_ms': round(s.max_seconds * 1000, 3),
+                    'p50_ms_le': s.quantile(0.5) * 1000, 'p99_ms_le': s.quantile(0.99) * 1000,
+                    'bytes': s.bytes, 'retries': s.retries, 'statuses': {str(k): v for k, v in s.statuses.items()}})
+            return {
+                'wall_seconds': round(time.time() - self.started, 6),
+                'requests': sum(s.count for s in self.endpoints.values()),
+                'request_seconds': round(sum(s.seconds for s in self.endpoints.values()), 6),
+                'bytes': sum(s.bytes for s in self.endpoints.values()),
+                'json_decode': {'count': self.decode_count, 'seconds': round(self.decode_seconds, 6)},
+                'endpoints': endpoints}
+
+    def prometheus(self) -> str:
+        'Metrics in Prometheus text exposition format'
+        lines = [
+            '# HELP checkmk_rest_request_duration_seconds Duration of check mk REST requests',
+            '# TYPE checkmk_rest_request_duration_seconds histogram']
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            for (site, method, ep), s in items:
+                labels = f'site="{site}",method="{method}",endpoint="{ep}"'
+                cumulative = 0
+                for bound, n in zip(BUCKETS, s.buckets):
+                    cumulative += n
+                    lines.append(f'checkmk_rest_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'checkmk_rest_request_duration_seconds_bucket{{{labels},le="+Inf"}} {s.count}')
+                lines.append(f'checkmk_rest_request_duration_seconds_sum{{{labels}}} {s.seconds}')
+                lines.append(f'checkmk_rest_request_duration_seconds_count{{{labels}}} {s.count}')
+            lines += ['# HELP checkmk_rest_response_bytes_total Received response bytes',
+                      '# TYPE checkmk_rest_response_bytes_total counter']
+            lines += [f'checkmk_rest_response_bytes_total{{site="{site}",method="{m}",endpoint="{ep}"}} {s.bytes}'
+                      for (site, m, ep), s in items]
+            lines += ['# HELP checkmk_rest_responses_total Responses by status code',
+                      '# TYPE checkmk_rest_responses_total counter']
+            for (site, m, ep), s in items:
+                for status, n in sorted(s.statuses.items(), key=lambda kv: str(kv[0])):
+                    lines.append(f'checkmk_rest_responses_total{{site="{site}",method="{m}",endpoint="{ep}",status="{status}"}} {n}')
+            lines += ['# HELP checkmk_rest_retries_total Retried requests',
+                      '# TYPE checkmk_rest_retries_total counter']
+            lines += [f'checkmk_rest_retries_total{{site="{site}",method="{m}",endpoint="{ep}"}} {s.retries}'
+                      for (site, m, ep), s in items]
+            lines += ['# HELP checkmk_rest_json_decode_seconds_total Time spent decoding JSON bodies',
+                      '# TYPE checkmk_rest_json_decode_seconds_total counter',
+                      f'checkmk_rest_json_decode_seconds_total {self.decode_seconds}']
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, filename: str):
+        'Write JSON summary (- for stderr)'
+        data = json.dumps(self.summary(), indent=4)
+        if filename == '-':
+            print(data, file=sys.stderr)
+        else:
+            with open(filename, 'w') as f:
+                f.write(data + '\n')
+
+    def write_prometheus(self, filename: str):
+        'Write Prometheus textfile (atomically, the textfile collector must never read a partial file)'
+        tmp = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, filename)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
+# Metrics created by from_env (shared by all clients of the process)
+_env_metrics = None
+
+
+def from_env():
+    '''Metrics configured from env METRICS_JSON, METRICS_PROM and TRACE_LOG (exported at exit), None if none is set.
+    All calls return the same Metrics, so clients of several sites are exported together.'''
+    global _env_metrics
+    g = os.environ.get
+    json_file, prom_file, trace_file = g('METRICS_JSON'), g('METRICS_PROM'), g('TRACE_LOG')
+    if not (json_file or prom_file or trace_file):
+        return None
+    if _env_metrics is not None:
+        return _env_metrics
+
+    metrics = _env_metrics = Metrics(trace_file)
+
+    def export():
+        if json_file:
+            metrics.write_json(json_file)
+        if prom_file:
+            metrics.write_prometheus(prom_file)
+        metrics.close()
+
+    atexit.register(export)
+    return metrics
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+
+# Local stand-in for the check mk REST API (only the endpoints Checkmk uses)
+#
+# Holds a synthetic inventory of hosts, folders and tag groups in memory, implements ETag / If-Match on hosts,
+# pending changes, activation and (bulk) discovery, and can add latency to every request. Used for offline
+# load tests and benchmarks (bench.py):
+#
+#   $ python mock_server.py --hosts 10000 --latency 5 --port 8080
+#   $ REST_URL=http://127.0.0.1:8080/main/check_mk/api/1.0 CAFILE= TOKENF=... ./cli.py get-host -h host000001
+
+API_PREFIX = re.compile(r'^.*?/api/1\.0')
+
+
+class Inventory:
+    'Synthetic check mk configuration'
+
+    def __init__(self, hosts=1000, folders=20, tag_groups=8, tag_values=5, seed=1):
+        rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tag_groups = {f'group{g}': [f'value{v}' for v in range(tag_values)] for g in range(tag_groups)}
+        self.folders = ['/'] + [f'/folder{f:03}' for f in range(folders)]
+        self.hosts = {}
+        self.versions = {}
+        for i in range(hosts):
+            name = f'host{i:06}'
+            attributes = {'ipaddress': f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'}
+            for tg, values in self.tag_groups.items():
+                if rnd.random() < 0.8:
+                    attributes[f'tag_{tg}'] = rnd.choice(values)
+            self.hosts[name] = {'folder': rnd.choice(self.folders), 'attributes': attributes}
+            self.versions[name] = 1
+        self.pending_changes = []
+        self.activations = {}
+        self.discovery_jobs = {}
+        # Serialized host collection, invalidated on writes (generation counts writes, it is the collection ETag)
+        self.all_hosts_body = None
+        self.generation = 0
+
+    def etag(self, name: str) -> str:
+        return f'"{name}-{self.versions[name]}"'
+
+    def host_json(self, name: str) -> dict:
+        host = self.hosts[name]
+        return {
+            'links': [{'rel': 'self', 'href': f'/objects/host_config/{name}', 'method': 'GET', 'type': 'application/json'}],
+            'domainType': 'host_config', 'id': name, 'title': name, 'members': {},
+            'extensions': {'folder': host['folder'], 'attributes': dict(host['attributes']),
+                           'is_cluster': False, 'is_offline': False, 'cluster_nodes': None}}
+
+    def collection(self, domain_type: str, values: list) -> dict:
+        return {'links': [{'rel': 'self', 'href': f'/domain-types/{domain_type}/collections/all'}],
+                'id': domain_type, 'domainType': 'link', 'value': values, 'extensions': {}}
+
+    def tag_group_json(self, tg: str) -> dict:
+        return {'domainType': 'host_tag_group', 'id': tg, 'title': tg,
+                'extensions': {'topic': 'Tags', 'tags': [{'id': v, 'title': v.title(), 'aux_tags': []} for v in self.tag_groups[tg]]}}
+
+    def change(self, text: str):
+        'Record pending change (lock held by caller)'
+        self.pending_changes.append({'id': str(len(self.pending_changes)), 'action_name': 'edit-host', 'text': text,
+                                     'user_id': 'automation', 'time': time.time()})
+        self.all_hosts_body = None
+        self.generation += 1
+
+    def validate_attributes(self, attributes: dict):
+        'Raise ValueError on unknown tag groups or values'
+        for key, value in attributes.items():
+            if key.startswith('tag_'):
+                tg = key[4:]
+                if tg not in self.tag_groups or value not in self.tag_groups[tg]:
+                    raise ValueError(f'Invalid tag {key}={value}')
+
+    def update(self, name: str, body: dict):
+        host = self.hosts[name]
+        if 'attributes' in body:
+            self.validate_attributes(body['attributes'])
+            host['attributes'] = dict(body['attributes'])
+        if 'update_attributes' in body:
+            self.validate_attributes(body['update_attributes'])
+            host['attributes'].update(body['update_attributes'])
+        for key in body.get('remove_attributes', []):
+            host['attributes'].pop(key, None)
+        self.versions[name] += 1
+        self.change(f'Modified host {name}')
+
+    def create(self, entry: dict):
+        name = entry['host_name']
+        if name in self.hosts:
+            raise ValueError(f'Host {name} already exists')
+        attributes = dict(entry.get('attributes', {}))
+        self.validate_attributes(attributes)
+        self.hosts[name] = {'folder': '/' + entry.get('folder', '/').replace('~', '/').strip('/'), 'attributes': attributes}
+        self.versions[name] = 1
+        self.change(f'Created host {name}')
+
+    def move(self, name: str, folder: str):
+        self.hosts[name]['folder'] = '/' + folder.replace('~', '/').strip('/')
+        self.versions[name] += 1
+        self.change(f'Moved host {name}')
+
+    def delete(self, name: str):
+        del self.hosts[name]
+        del self.versions[name]
+        self.change(f'Deleted host {name}')
+
+
+SERVICES = ['CPU load', 'Memory', 'Filesystem /']
+
+
+def host_row(name: str, host: dict) -> dict:
+    'Livestatus host row (every 50th host is DOWN)'
+    i = int(name[4:]) if name[4:].isdigit() else 0
+    return {'name': name, 'state': 1 if i % 50 == 0 else 0, 'address': host['attributes'].get('ipaddress', ''),
+            'tags': {k[4:]: v for k, v in host['attributes'].items() if k.startswith('tag_')}}
+
+
+def service_rows(name: str, host: dict):
+    'Livestatus service rows of a host (deterministic mix of OK, WARN and CRIT)'
+    i = int(name[4:]) if name[4:].isdigit() else 0
+    tags = {k[4:]: v for k, v in host['attributes'].items() if k.startswith('tag_')}
+    for n, description in enumerate(SERVICES):
+        state = [0, 0, 0, 0, 0, 0, 0, 1, 1, 2][(i * 7 + n) % 10]
+        yield {'host_name': name, 'description': description, 'state': state,
+               'plugin_output': ['OK', 'WARN', 'CRIT'][state] + f' - {description}', 'host_tags': tags}
+
+
+def evaluate(expr: dict, row: dict) -> bool:
+    'Evaluate a check mk query expression on a livestatus row (dict columns compare "key value")'
+    op = expr['op']
+    if op == 'and':
+        return all(evaluate(e, row) for e in expr['expr'])
+    if op == 'or':
+        return any(evaluate(e, row) for e in expr['expr'])
+    if op == 'not':
+        return not evaluate(expr['expr'], row)
+    left, right = row[expr['left'].split('.', 1)[-1]], expr['right']
+    if isinstance(left, dict):
+        key, _, value = right.partition(' ')
+        if op not in ('=', '!='):
+            raise ValueError(f'Operator {op} is not supported on dict columns')
+        return (left.get(key) == value) == (op == '=')
+    if isinstance(left, int):
+        right = int(right)
+    if op in ('~', '~~', '!~', '!~~'):
+        found = re.search(right, str(left), re.IGNORECASE if '~~' in op else 0) is not None
+        return found != op.startswith('!')
+    return {'=': left == right, '!=': left != right, '<': left < right, '>': left > right,
+            '<=': left <= right, '>=': left >= right}[op]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send small responses immediately (keep-alive + Nagle + delayed ACK adds ~40 ms per request)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def inv(self) -> Inventory:
+        return self.server.inventory
+
+    def reply(self, status: int, body=None, headers=None):
+        data = b''
+        if body is not None:
+            data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def problem(self, status: int, title: str, detail='', ext=None):
+        body = {'title': title, 'status': status, 'detail': detail}
+        if ext is not None:
+            body['ext'] = ext
+        self.reply(status, body)
+
+    def body(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def handle_request(self, method: str):
+        if self.server.latency:
+            time.sleep(max(0.0, random.gauss(self.server.latency, self.server.latency / 4)))
+        url = urlsplit(self.path)
+        path = API_PREFIX.sub('', url.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        for route_method, route, fn in ROUTES:
+            m = route.fullmatch(path)
+            if m is not None and route_method == method:
+                try:
+                    return fn(self, query, *m.groups())
+                except (ValueError, KeyError) as e:
+                    return self.problem(400, 'Bad Request', str(e))
+        self.problem(404, 'Not Found', f'{method} {path}')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    # Hosts
+
+    def get_host(self, query, name):
+        with self.inv.lock:
+            if name not in self.inv.hosts:
+                return self.problem(404, 'Not Found', f'Host {name} not found')
+            body, etag = self.inv.host_json(name), self.inv.etag(name)
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, headers={'ETag': etag})
+        if query.get('effective_attributes') == 'true':
+            body['extensions']['effective_attributes'] = dict(body['extensions']['attributes'])
+        self.reply(200, body, {'ETag': etag})
+
+    def update_host(self, query, name):
+        body = self.body()
+        with self.inv.lock:
+            if name not in self.inv.hosts:
+                return self.problem(404, 'Not Found', f'Host {name} not found')
+            if_match = self.headers.get('If-Match')
+            if not if_match:
+                return self.problem(428, 'Precondition required', 'If-Match header is missing')
+            if if_match != '*' and if_match != self.inv.etag(name):
+                return self.problem(412, 'Precondition failed', 'ETag of the host has changed')
+            self.inv.update(name, body)
+            res, etag = self.inv.host_json(name), self.inv.etag(name)
+        self.reply(200, res, {'ETag': etag})
+
+    def move_host(self, query, name):
+        body = self.body()
+        with self.inv.lock:
+            if name not in self.inv.hosts:
+                return self.problem(404, 'Not Found', f'Host {name} not found')
+            if_match = self.headers.get('If-Match')
+            if not if_match:
+                return self.problem(428, 'Precondition required', 'If-Match header is missing')
+            if if_match != '*' and if_match != self.inv.etag(name):
+                return self.problem(412, 'Precondition failed', 'ETag of the host has changed')
+            self.inv.move(name, body['target_folder'])
+            res, etag = self.inv.host_json(name), self.inv.etag(name)
+        self.reply(200, res, {'ETag': etag})
+
+    def delete_host(self, query, name):
+        with self.inv.lock:
+            if name not in self.inv.hosts:
+                return self.problem(404, 'Not Found', f'Host {name} not found')
+            self.inv.delete(name)
+        self.reply(204)
+
+    def create_host(self, query):
+        entry = self.body()
+        with self.inv.lock:
+            self.inv.create(entry)
+            res, etag = self.inv.host_json(entry['host_name']), self.inv.etag(entry['host_name'])
+        self.reply(200, res, {'ETag': etag})
+
+    def all_hosts(self, query):
+        with self.inv.lock:
+            if self.inv.all_hosts_body is None:
+                values = [self.inv.host_json(name) for name in self.inv.hosts]
+                self.inv.all_hosts_body = json.dumps(self.inv.collection('host_config', values)).encode('utf-8')
+            body = self.inv.all_hosts_body
+            etag = f'"hosts-{self.inv.generation}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, headers={'ETag': etag})
+        self.reply(200, body, {'ETag': etag})
+
+    def bulk(self, query, action):
+        entries = self.body().get('entries', [])
+        failed, succeeded = {}, []
+        with self.inv.lock:
+            for entry in entries:
+                name = entry if action == 'delete' else entry.get('host_name')
+                try:
+                    if action == 'create':
+                        self.inv.create(entry)
+                    elif name not in self.inv.hosts:
+                        raise ValueError(f'Host {name} not found')
+                    elif action == 'update':
+                        self.inv.update(name, entry)
+                    else:
+                        self.inv.delete(name)
+                    succeeded.append(name)
+                except (ValueError, KeyError) as e:
+                    failed[name] = str(e)
+            values = [self.inv.host_json(n) for n in succeeded] if action != 'delete' else []
+        if failed:
+            return self.problem(400, f'Some hosts could not be {action}d', '',
+                                {'failed_hosts': failed, 'succeeded_hosts': {'value': values}})
+        if action == 'delete':
+            return self.reply(204)
+        self.reply(200, self.inv.collection('host_config', values))
+
+    # Folders
+
+    def folder_hosts(self, query, folder):
+        path = '/' + folder.replace('~', '/').replace('\\', '/').strip('/')
+        with self.inv.lock:
+            values = [self.inv.host_json(n) for n, h in self.inv.hosts.items() if h['folder'] == path]
+        self.reply(200, self.inv.collection('host_config', values))
+
+    def all_folders(self, query):
+        parent = '/' + query.get('parent', '~').replace('~', '/').replace('\\', '/').strip('/')
+        recursive = query.get('recursive') == 'true'
+        prefix = parent.rstrip('/') + '/'
+        values = []
+        for path in self.inv.folders:
+            descendant = path != parent and path.startswith(prefix)
+            child = descendant and '/' not in path[len(prefix):]
+            if not (recursive and (path == parent or descendant) or child):
+                continue
+            folder = {'domainType': 'folder_config', 'id': path.replace('/', '~'), 'title': path.strip('/') or 'Main',
+                      'extensions': {'path': path, 'attributes': {}}}
+            if query.get('show_hosts') == 'true':
+                with self.inv.lock:
+                    folder['members'] = {'hosts': {'value': [{'href': f'/objects/host_config/{n}', 'title': n}
+                                                             for n, h in self.inv.hosts.items() if h['folder'] == path]}}
+            values.append(folder)
+        self.reply(200, self.inv.collection('folder_config', values))
+
+    # Tag groups
+
+    def tag_group(self, query, tg):
+        if tg.startswith('tag_'):
+            tg = tg[4:]
+        if tg not in self.inv.tag_groups:
+            return self.problem(404, 'Not Found', f'Tag group {tg} not found')
+        self.reply(200, self.inv.tag_group_json(tg))
+
+    def all_tag_groups(self, query):
+        self.reply(200, self.inv.collection('host_tag_group', [self.inv.tag_group_json(tg) for tg in self.inv.tag_groups]))
+
+    # Monitoring state
+
+    def status(self, query, domain_type):
+        params = parse_qs(urlsplit(self.path).query)
+        expr = json.loads(params['query'][0]) if 'query' in params else None
+        columns = params.get('columns') or (['name'] if domain_type == 'host' else ['host_name', 'description'])
+        with self.inv.lock:
+            hosts = list(self.inv.hosts.items())
+        if domain_type == 'host':
+            rows = (host_row(name, host) for name, host in hosts)
+        else:
+            only = params.get('host_name', [None])[0]
+            rows = (row for name, host in hosts if only in (None, name) for row in service_rows(name, host))
+        values = [{'domainType': 'dict', 'id': row.get('name') or f"{row['host_name']}:{row['description']}",
+                   'extensions': {c: row[c] for c in columns}}
+                  for row in rows if expr is None or evaluate(expr, row)]
+        self.reply(200, self.inv.collection(domain_type, values))
+
+    # Discovery
+
+    def discover(self, query, name):
+        mode = self.body().get('mode')
+        if mode not in ('new', 'remove', 'fix_all', 'refresh', 'only_host_labels'):
+            return self.problem(400, 'Bad Request', f'Invalid mode {mode}')
+        with self.inv.lock:
+            if name not in self.inv.hosts:
+                return self.problem(404, 'Not Found', f'Host {name} not found')
+        time.sleep(self.server.discovery_time)
+        self.reply(200, {'domainType': 'service_discovery', 'id': name, 'extensions': {'check_table': {}, 'host_labels': {}}})
+
+    def bulk_discovery_start(self, query):
+        body = self.body()
+        job_id = 'bulk_discovery'
+        hosts = body.get('hostnames', [])
+        self.inv.discovery_jobs[job_id] = (time.time(), hosts)
+        self.reply(200, {'domainType': 'discovery_run', 'id': job_id, 'extensions': {'active': True, 'state': 'running'}})
+
+    def discovery_status(self, query, job_id):
+        if job_id not in self.inv.discovery_jobs:
+            return self.problem(404, 'Not Found', f'Job {job_id} not found')
+        started, hosts = self.inv.discovery_jobs[job_id]
+        done = min(len(hosts), int((time.time() - started) / max(self.server.discovery_time, 1e-6)))
+        active = done < len(hosts)
+        progress = [f'{h}: discovered' if h in self.inv.hosts else f'{h}: failed (host not found)' for h in hosts[:done]]
+        self.reply(200, {'domainType': 'discovery_run', 'id': job_id,
+                         'extensions': {'active': active, 'state': 'running' if active else 'finished',
+                                        'logs': {'progress': progress, 'result': [] if active else ['Bulk discovery finished']}}})
+
+    # Activation
+
+    def pending_changes(self, query):
+        with self.inv.lock:
+            changes = list(self.inv.pending_changes)
+        self.reply(200, {'domainType': 'activation_run', 'value': changes}, {'ETag': f'"pending-{len(changes)}"'})
+
+    def activate(self, query):
+        self.body()
+        with self.inv.lock:
+            if not self.inv.pending_changes:
+                return self.problem(422, 'Unprocessable Entity', 'Currently there are no changes to activate.')
+            activation_id = f'activation{len(self.inv.activations)}'
+            self.inv.activations[activation_id] = time.time()
+            self.inv.pending_changes = []
+        self.reply(200, {'domainType': 'activation_run', 'id': activation_id, 'extensions': {'sites': ['main'], 'is_running': True}})
+
+    def activation_status(self, query, activation_id):
+        if activation_id not in self.inv.activations:
+            return self.problem(404, 'Not Found', f'Activation {activation_id} not found')
+        running = time.time() - self.inv.activations[activation_id] < self.server.activation_time
+        self.reply(200, {'domainType': 'activation_run', 'id': activation_id, 'extensions': {'sites': ['main'], 'is_running': running}})
+
+
+ROUTES = [(method, re.compile(route), fn) for method, route, fn in [
+    ('GET', r'/objects/host_config/([^/]+)', Handler.get_host),
+    ('PUT', r'/objects/host_config/([^/]+)', Handler.update_host),
+    ('DELETE', r'/objects/host_config/([^/]+)', Handler.delete_host),
+    ('POST', r'/objects/host_config/([^/]+)/actions/move/invoke', Handler.move_host),
+    ('GET', r'/domain-types/host_config/collections/all', Handler.all_hosts),
+    ('POST', r'/domain-types/host_config/collections/all', Handler.create_host),
+    ('POST', r'/domain-types/host_config/actions/bulk-(create|delete)/invoke', Handler.bulk),
+    ('PUT', r'/domain-types/host_config/actions/bulk-(update)/invoke', Handler.bulk),
+    ('GET', r'/objects/folder_config/([^/]+)/collections/hosts', Handler.folder_hosts),
+    ('GET', r'/domain-types/folder_config/collections/all', Handler.all_folders),
+    ('GET', r'/objects/host_tag_group/([^/]+)', Handler.tag_group),
+    ('GET', r'/domain-types/host_tag_group/collections/all', Handler.all_tag_groups),
+    ('GET', r'/domain-types/(host|service)/collections/all', Handler.status),
+    ('POST', r'/objects/host/([^/]+)/actions/discover_services/invoke', Handler.discover),
+    ('POST', r'/domain-types/discovery_run/actions/bulk-discovery-start/invoke', Handler.bulk_discovery_start),
+    ('GET', r'/objects/discovery_run/([^/]+)', Handler.discovery_status),
+    ('GET', r'/domain-types/activation_run/collections/pending_changes', Handler.pending_changes),
+    ('POST', r'/domain-types/activation_run/actions/activate-changes/invoke', Handler.activate),
+    ('GET', r'/objects/activation_run/([^/]+)', Handler.activation_status),
+]]
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, inventory: Inventory, latency=0.0, discovery_time=0.0, activation_time=0.0):
+        'latency, discovery_time and activation_time in seconds'
+        self.inventory = inventory
+        self.latency = latency
+        self.discovery_time = discovery_time
+        self.activation_time = activation_time
+        super().__init__(address, Handler)
+
+    @property
+    def url(self) -> str:
+        'REST_URL of this server'
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/main/check_mk/api/1.0'
+
+
+def start_mock_server(hosts=1000, latency=0.0, port=0, **kwargs) -> MockServer:
+    'Start mock server in a background thread (port 0 picks a free port). Stop it with shutdown().'
+    inventory_args = {k: kwargs.pop(k) for k in ('folders', 'tag_groups', 'tag_values', 'seed') if k in kwargs}
+    server = MockServer(('127.0.0.1', port), Inventory(hosts, **inventory_args), latency, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the check mk REST API')
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--folders', type=int, default=20)
+    parser.add_argument('--tag-groups', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='Added latency per request in ms')
+    parser.add_argument('--discovery-time', type=float, default=0.0, help='Discovery time per host in ms')
+    parser.add_argument('--activation-time', type=float, default=0.0, help='Activation time in ms')
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    inventory = Inventory(args.hosts, args.folders, args.tag_groups)
+    server = MockServer((args.bind, args.port), inventory, args.latency / 1000, args.discovery_time / 1000, args.activation_time / 1000)
+    print(f'REST_URL={server.url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import json
+
+
+# Query expressions of the check mk monitoring collections (livestatus)
+#
+# The host and service collections (Checkmk.get_hosts_status / get_services_status) filter on the server with a
+# query expression {"op": "=", "left": "state", "right": "2"} and return only the requested columns. Expressions
+# are built with col() and combined with & (and), | (or) and ~ (not):
+#
+#   q = (col('state') == 2) & tag('tag_env', 'prod', SERVICE_TAGS)
+#   cmk.get_services_status(q, ['host_name', 'description', 'state', 'plugin_output'])
+
+HOST_COLUMNS = ['name', 'state', 'address', 'tags']
+SERVICE_COLUMNS = ['host_name', 'description', 'state', 'plugin_output']
+
+# Tag column of the hosts table and the host tags column of the services table
+HOST_TAGS = 'tags'
+SERVICE_TAGS = 'host_tags'
+
+# Service and host states by name
+STATES = {'OK': 0, 'WARN': 1, 'CRIT': 2, 'UNKNOWN': 3, 'UP': 0, 'DOWN': 1, 'UNREACH': 2}
+
+
+class Expr:
+    'Query expression (dict in the check mk format), combine with &, | and ~'
+
+    def __init__(self, expr: dict):
+        self.expr = expr
+
+    def __and__(self, other):
+        return and_(self, other)
+
+    def __or__(self, other):
+        return or_(self, other)
+
+    def __invert__(self):
+        return Expr({'op': 'not', 'expr': self.expr})
+
+    def __repr__(self):
+        return f'Expr({self.expr!r})'
+
+    def json(self) -> str:
+        return json.dumps(self.expr)
+
+
+class Column:
+    'Livestatus column, comparisons return Expr'
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def op(self, op: str, value) -> Expr:
+        return Expr({'op': op, 'left': self.name, 'right': str(value)})
+
+    def __eq__(self, value):
+        return self.op('=', value)
+
+    def __ne__(self, value):
+        return self.op('!=', value)
+
+    def __lt__(self, value):
+        return self.op('<', value)
+
+    def __le__(self, value):
+        return self.op('<=', value)
+
+    def __gt__(self, value):
+        return self.op('>', value)
+
+    def __ge__(self, value):
+        return self.op('>=', value)
+
+    def match(self, regex: str) -> Expr:
+        'Regular expression match'
+        return self.op('~', regex)
+
+    def imatch(self, regex: str) -> Expr:
+        'Case insensitive regular expression match'
+        return self.op('~~', regex)
+
+    __hash__ = None
+
+
+def col(name: str) -> Column:
+    return Column(name)
+
+
+def flatten(op: str, exprs) -> list:
+    'Expression dicts of exprs, nested expressions of the same op are merged'
+    res = []
+    for e in exprs:
+        e = e.expr if isinstance(e, Expr) else e
+        res.extend(e['expr'] if e.get('op') == op else [e])
+    return res
+
+
+def and_(*exprs) -> Expr:
+    return Expr({'op': 'and', 'expr': flatten('and', exprs)})
+
+
+def or_(*exprs) -> Expr:
+    return Expr({'op': 'or', 'expr': flatten('or', exprs)})
+
+
+def tag(tag_group: str, value: str, column=HOST_TAGS) -> Expr:
+    '''Host has tag value in tag_group (livestatus keeps tag groups without the tag_ prefix).
+    column is HOST_TAGS in host queries and SERVICE_TAGS in service queries.'''
+    group = tag_group[4:] if tag_group.startswith('tag_') else tag_group
+    return Expr({'op': '=', 'left': column, 'right': f'{group} {value}'})
+
+
+def state(value) -> Expr:
+    'state column equals value (number or name: OK, WARN, CRIT, UNKNOWN, UP, DOWN, UNREACH)'
+    return col('state') == STATES.get(str(value).upper(), value)
+
+
+def to_query(query) -> dict:
+    'Query expression dict from an Expr, a dict or a JSON string (None stays None)'
+    if query is None or isinstance(query, dict):
+        return query
+    if isinstance(query, Expr):
+        return query.expr
+    return json.loads(query)
+
+
+def build_query(query=None, states=None, tags=None, tag_column=HOST_TAGS) -> dict:
+    '''Combine a JSON query, a list of states (any of them) and a list of tag_group=value (all of them, in tag_column) with and.
+    Returns None if nothing is set.'''
+    exprs = [Expr(to_query(query))] if query else []
+    if states:
+        exprs.append(or_(*(state(s) for s in states)) if len(states) > 1 else state(states[0]))
+    for t in tags or []:
+        tag_group, value = t.split('=', 1)
+        exprs.append(tag(tag_group.strip(), value.strip(), tag_column))
+    if not exprs:
+        return None
+    return exprs[0].expr if len(exprs) == 1 else and_(*exprs).expr
+
+
+def iter_records(json_res):
+    'Yield the column values (dict) of every row of a host/service collection response'
+    if not json_res.ok():
+        raise Exception(f'Status query failed ({json_res.res.status_code}): {json_res.res.text}')
+    for item in json_res.iter_values():
+        yield item.get('extensions', {})
+
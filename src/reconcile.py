@@ -0,0 +1,188 @@
+from collections import deque, namedtuple
+from dataclasses import dataclass, field
+from checkmk import Checkmk, BulkResult
+import checkutil as p
+
+
+# Desired state reconcile
+#
+# The desired inventory (CSV/NDJSON/YAML records of host_name, folder, ip and tags) is compared with the current
+# state from one bulk fetch of all hosts. Only the differences are written, with bulk create/update/delete requests
+# (a few requests per thousand hosts instead of a GET and a PUT per host). Hosts whose folder changed are moved one
+# by one (check mk has no bulk move).
+#
+# Attributes are only compared for keys that appear in the desired inventory (managed attributes): a managed
+# attribute that is missing or empty in a desired record is removed from the host, all other attributes are left as
+# they are.
+
+# One planned change: action is create, move, update or delete; entry is the bulk request entry (host name for delete)
+Change = namedtuple('Change', 'action host entry')
+
+
+@dataclass
+class Plan:
+    creates: list = field(default_factory=list)
+    moves: list = field(default_factory=list)
+    updates: list = field(default_factory=list)
+    deletes: list = field(default_factory=list)
+    unchanged: int = 0
+
+    def changes(self):
+        'All changes in the order they are applied'
+        yield from self.creates
+        yield from self.moves
+        yield from self.updates
+        yield from self.deletes
+
+    def summary(self) -> dict:
+        return {'create': len(self.creates), 'move': len(self.moves), 'update': len(self.updates),
+                'delete': len(self.deletes), 'unchanged': self.unchanged}
+
+
+def normalize_folder(folder: str) -> str:
+    'Folder path in / form (check mk accepts ~, / and \\ as path delimiters)'
+    return '/' + (folder or '/').replace('~', '/').replace('\\', '/').strip('/')
+
+
+def desired_host(rec: dict) -> dict:
+    '''Desired host {host_name, folder, attributes} from an inventory record.
+    Record keys are the bulk create columns (host_name;folder;ip;alias;tag_...), tags may also be given as a dict
+    {tag_group: value} (tag_ prefix is added if missing).'''
+    tags = rec.get('tags') or {}
+    attributes = p.host_attributes({k: v for k, v in rec.items() if k != 'tags'})
+    for tag_group, value in tags.items():
+        attributes[tag_group if tag_group.startswith('tag_') else f'tag_{tag_group}'] = value
+    folder = rec.get('folder')
+    return {'host_name': p.record_hostname(rec), 'folder': normalize_folder(folder) if folder else None, 'attributes': attributes}
+
+
+def read_yaml_records(filename: str):
+    'Records from a YAML file (a list of hosts or {hosts: [...]}), PyYAML is optional and only imported here'
+    import yaml
+    with p.open_input(filename) as f:
+        data = yaml.safe_load(f)
+    return data.get('hosts', []) if isinstance(data, dict) else data or []
+
+
+def read_desired(filename: str) -> dict:
+    'Read desired inventory (CSV, NDJSON or YAML by extension, - is CSV on stdin) into {host_name: desired host}'
+    records = read_yaml_records(filename) if filename.endswith(('.yaml', '.yml')) else p.read_records(filename)
+    desired = {}
+    for rec in records:
+        host = desired_host(rec)
+        desired[host['host_name']] = host
+    return desired
+
+
+def managed_attributes(desired: dict) -> set:
+    'Attribute keys that are set on at least one desired host'
+    keys = set()
+    for host in desired.values():
+        keys.update(host['attributes'])
+    return keys
+
+
+def plan(desired: dict, current, prune=False, scope=None) -> Plan:
+    '''Compute the minimal change set between desired hosts and current host objects (items of the host collection).
+    prune=True deletes hosts that are not in the desired inventory below folder scope, it needs scope (/ is the whole site).'''
+    if prune and scope is None:
+        raise ValueError('prune needs a scope folder (/ prunes the whole site)')
+    managed = managed_attributes(desired)
+    scope = normalize_folder(scope) if scope is not None else None
+    res = Plan()
+    seen = set()
+
+    for host_json in current:
+        name = host_json['id']
+        ext = host_json.get('extensions', {})
+        folder = normalize_folder(ext.get('folder'))
+        want = desired.get(name)
+        if want is None:
+            if prune and (folder == scope or folder.startswith(scope.rstrip('/') + '/')):
+                res.deletes.append(Change('delete', name, name))
+            continue
+
+        seen.add(name)
+        if want['folder'] is not None and want['folder'] != folder:
+            res.moves.append(Change('move', name, {'host_name': name, 'target_folder': want['folder']}))
+
+        attributes = ext.get('attributes', {})
+        update_attributes = {k: v for k, v in want['attributes'].items() if attributes.get(k) != v}
+        remove_attributes = sorted(k for k in managed if k in attributes and k not in want['attributes'])
+        if update_attributes or remove_attributes:
+            entry = {'host_name': name}
+            if update_attributes:
+                entry['update_attributes'] = update_attributes
+            if remove_attributes:
+                entry['remove_attributes'] = remove_attributes
+            res.updates.append(Change('update', name, entry))
+        elif want['folder'] is None or want['folder'] == folder:
+            res.unchanged += 1
+
+    for name, want in desired.items():
+        if name not in seen:
+            res.creates.append(Change('create', name, {'host_name': name, 'folder': want['folder'] or '/',
+                                                        'attributes': want['attributes']}))
+    return res
+
+
+def fetch_plan(cmk: Checkmk, desired: dict, prune=False, scope=None) -> Plan:
+    'Plan against the current state of check mk (one streamed fetch of all hosts)'
+    res = cmk.get_all_hosts(stream=True)
+    if not res.ok():
+        raise Exception(f'Fetching all hosts failed ({res.res.status_code})')
+    return plan(desired, res.iter_values(), prune, scope)
+
+
+def move_result(host: str, json_res) -> BulkResult:
+    if json_res is None:
+        return BulkResult(host, None, None, 'not sent')
+    if json_res.ok():
+        return BulkResult(host, True, json_res.res.status_code, '')
+    return BulkResult(host, False, json_res.res.status_code, json_res.res.text)
+
+
+def paired(changes: list, results):
+    '''Pair every change with the bulk result of its host (results may come in any order).
+    Raises if a result belongs to no change or if some changes got no result.'''
+    pending = {}
+    for change in changes:
+        pending.setdefault(change.host, deque()).append(change)
+    for result in results:
+        waiting = pending.get(result.host)
+        if not waiting:
+            raise Exception(f'Bulk result for unexpected host {result.host}')
+        yield waiting.popleft(), result
+        if not waiting:
+            del pending[result.host]
+    if pending:
+        missing = sorted(pending)
+        raise Exception(f'No bulk result for {len(missing)} hosts: {", ".join(missing[:10])}' + (', ...' if len(missing) > 10 else ''))
+
+
+def apply(cmk: Checkmk, plan: Plan, chunk_size=100, send=True):
+    '''Apply the plan: bulk create, move, bulk update, bulk delete. Yields (Change, BulkResult) per change.
+    send=False only logs the requests (dry run), moves use the etag cache and fetch missing etags only when sending.'''
+    yield from paired(plan.creates, cmk.bulk_create_hosts((c.entry for c in plan.creates), chunk_size, send))
+    for change in plan.moves:
+        etag = cmk.cached_etag(change.host) if send else None
+        res = cmk.move_host(change.host, change.entry['target_folder'], etag, send)
+        if res is not None and res.res.status_code == 412:
+            cmk.forget_etag(change.host)
+            res = cmk.move_host(change.host, change.entry['target_folder'], cmk.get_etag(change.host), send)
+        yield change, move_result(change.host, res)
+    yield from paired(plan.updates, cmk.bulk_update_hosts((c.entry for c in plan.updates), chunk_size, send))
+    yield from paired(plan.deletes, cmk.bulk_delete_hosts((c.entry for c in plan.deletes), chunk_size, send))
+
+
+def reconcile(cmk: Checkmk, filename: str, prune=False, scope=None, chunk_size=100, send=True):
+    'Read desired inventory from filename, plan and apply it. Yields (Change, BulkResult) per change.'
+    yield from apply(cmk, fetch_plan(cmk, read_desired(filename), prune, scope), chunk_size, send)
+
+
+def result_record(change: Change, result: BulkResult) -> dict:
+    'Change and its result as one flat record (for NDJSON output)'
+    rec = {'action': change.action, 'host_name': change.host, 'ok': result.ok, 'status': result.status, 'detail': result.detail}
+    if isinstance(change.entry, dict):
+        rec.update({k: v for k, v in change.entry.items() if k != 'host_name'})
+    return rec
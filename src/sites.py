@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import queue
+import threading
+from activation import ActivationManager
+from checkmk import new_checkmk
+import checkutil as p
+
+
+# Multi site client
+#
+# Runs the same operation against every site of a distributed monitoring setup in parallel (one session per site)
+# and merges the results, every record is tagged with its site. A report over all sites takes as long as the slowest
+# site. Sites are read from a sites file (env SITES), CSV (; separated) or NDJSON with the create_checkmk env names:
+#
+#   site_name;rest_url;cafile;user;tokenf
+#   main;https://cmk1.domain.com/main/check_mk/api/1.0;/app/config/myca.pem;automation;/app/config/secret/main.token
+#
+# Empty cafile/user/tokenf columns fall back to env CAFILE/USER/TOKENF.
+
+
+def default_filename() -> str:
+    'Sites file from env SITES'
+    return os.environ.get('SITES', '/app/config/sites.csv')
+
+
+def read_sites(filename: str) -> list:
+    'Site records {site_name, rest_url, cafile, user, tokenf} from a CSV/NDJSON sites file'
+    g = os.environ.get
+    sites = []
+    for rec in p.read_records(filename):
+        rec = {k.lower(): v for k, v in rec.items()}
+        sites.append({
+            'site_name': rec['site_name'], 'rest_url': rec['rest_url'],
+            'cafile': rec.get('cafile') or g('CAFILE'), 'user': rec.get('user') or g('USER'),
+            'tokenf': rec.get('tokenf') or g('TOKENF')})
+    return sites
+
+
+class SiteErrors(Exception):
+    'Operation failed on some sites: errors is {site_name: exception}, results is {site_name: result} of the other sites'
+
+    def __init__(self, errors: dict, results=None):
+        super().__init__('; '.join(f'{site}: {e}' for site, e in errors.items()))
+        self.errors = errors
+        self.results = results or {}
+
+
+class MultiSite:
+    def __init__(self, clients: dict):
+        # {site_name: Checkmk}
+        self.clients = clients
+
+    @classmethod
+    def from_file(cls, filename=None, sites=None) -> 'MultiSite':
+        'Clients of all sites in the sites file (only the sites in list sites if it is set)'
+        records = read_sites(filename or default_filename())
+        if sites:
+            records = [r for r in records if r['site_name'] in sites]
+        return cls({r['site_name']: new_checkmk(r['site_name'], r['rest_url'], r['cafile'], r['user'], r['tokenf'])
+                    for r in records})
+
+    def map(self, fn) -> dict:
+        '''Call fn(cmk) for every site in parallel. Returns {site_name: result}.
+        Raises SiteErrors (after all sites are finished, with the results of the other sites) if it failed on a site.'''
+        def call(item):
+            site, cmk = item
+            try:
+                return site, fn(cmk), None
+            except Exception as e:
+                logging.debug(f'{site}: {e}')
+                return site, None, e
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.clients))) as executor:
+            done = list(executor.map(call, self.clients.items()))
+        errors = {site: e for site, _, e in done if e is not None}
+        results = {site: res for site, res, e in done if e is None}
+        if errors:
+            raise SiteErrors(errors, results)
+        return results
+
+    def merge(self, fn, buffer=1000):
+        '''Iterate fn(cmk) of every site in parallel and yield (site_name, item) as soon as any site produces it.
+        At most buffer items wait in memory. Raises SiteErrors at the end if it failed on a site.'''
+        q = queue.Queue(buffer)
+        done = object()
+        errors = {}
+        stop = threading.Event()
+
+        def produce(site, cmk):
+            try:
+                for item in fn(cmk):
+                    if stop.is_set():
+                        return
+                    q.put((site, item))
+            except Exception as e:
+                logging.debug(f'{site}: {e}')
+                errors[site] = e
+            finally:
+                q.put((site, done))
+
+        threads = [threading.Thread(target=produce, args=item, daemon=True) for item in self.clients.items()]
+        for t in threads:
+            t.start()
+        try:
+            running = len(threads)
+            while running:
+                site, item = q.get()
+                if item is done:
+                    running -= 1
+                else:
+                    yield site, item
+        finally:
+            # Consumer stopped early: let the producers finish
+            stop.set()
+            while any(t.is_alive() for t in threads):
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        if errors:
+            raise SiteErrors(errors)
+
+    def get_host(self, hostname: str) -> dict:
+        '{site_name: host object} of the sites that know hostname'
+        def known(res):
+            return {site: r.json() for site, r in res.items() if r.ok()}
+
+        try:
+            return known(self.map(lambda cmk: cmk.get_host(hostname, False)))
+        except SiteErrors as e:
+            raise SiteErrors(e.errors, known(e.results)) from None
+
+    def iter_all_hosts_tags(self, workers=None):
+        'Yield (site_name, Tag) of all hosts of all sites'
+        return self.merge(lambda cmk: p.iter_all_hosts_tags(cmk, workers))
+
+    def iter_tag_histogram(self, workers=None):
+        'Yield (site_name, (tag_group, tag_value), hosts) of the tag histograms of all sites'
+        for site, (key, hosts) in self.merge(lambda cmk: p.get_tag_histogram(cmk, None, workers).items()):
+            yield site, key, hosts
+
+    def activate(self, force_foreign_changes=False, wait=True, only_if_pending=True, timeout=None) -> dict:
+        '{site_name: activation summary} (ActivationManager.activate) of all sites, activated in parallel'
+        return self.map(lambda cmk: ActivationManager(cmk, force_foreign_changes, timeout=timeout).activate(wait, only_if_pending))
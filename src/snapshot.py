@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import time
+from checkmk import Checkmk, json_dumps, json_loads
+import checkutil as p
+
+
+# Local persistent copy of the check mk inventory (hosts, attributes, tags, folders, etags and tag groups)
+#
+# Read tasks (get_all_tags, get_tag_hist, get_all_hosts, ...) can use the snapshot instead of downloading the whole
+# inventory on every run. A snapshot is refreshed fully (one streamed host collection, skipped if the collection ETag
+# is unchanged), folder by folder or host by host.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hosts (host_name TEXT PRIMARY KEY, folder TEXT, etag TEXT, data TEXT, fetched_at REAL);
+CREATE INDEX IF NOT EXISTS hosts_folder ON hosts (folder);
+CREATE TABLE IF NOT EXISTS tags (host_name TEXT, tag_group TEXT, value TEXT, PRIMARY KEY (host_name, tag_group));
+CREATE INDEX IF NOT EXISTS tags_group_value ON tags (tag_group, value);
+CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, title TEXT, data TEXT, fetched_at REAL);
+CREATE TABLE IF NOT EXISTS tag_groups (tag_group TEXT, tag_val_id TEXT, tag_val_title TEXT, tag_val_aux_tags TEXT,
+                                       PRIMARY KEY (tag_group, tag_val_id));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+def default_filename() -> str:
+    'Snapshot file from env SNAPSHOT (default: in the config volume)'
+    return os.environ.get('SNAPSHOT', '/app/config/snapshot.sqlite')
+
+
+class Snapshot:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_meta(self, key: str):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key: str, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def age(self):
+        'Seconds since the last full refresh (None if the snapshot was never refreshed)'
+        refreshed_at = self.get_meta('refreshed_at')
+        return time.time() - float(refreshed_at) if refreshed_at is not None else None
+
+    def is_fresh(self, max_age: float) -> bool:
+        'Was the snapshot fully refreshed in the last max_age seconds?'
+        age = self.age()
+        return age is not None and age <= max_age
+
+    def store_host(self, host_json: dict, etag=None, now=None):
+        'Insert or replace one host object (as returned by check mk) and its tags'
+        host_name = host_json['id']
+        folder = host_json['extensions'].get('folder')
+        self.db.execute('INSERT OR REPLACE INTO hosts (host_name, folder, etag, data, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                        (host_name, folder, etag, json_dumps(host_json), now or time.time()))
+        self.db.execute('DELETE FROM tags WHERE host_name = ?', (host_name,))
+        self.db.executemany('INSERT INTO tags (host_name, tag_group, value) VALUES (?, ?, ?)', p.host_tags(host_json))
+
+    def stored_hosts(self, where: str, args=()) -> dict:
+        'Stored {host_name: (etag, host object)} of hosts with an etag'
+        rows = self.db.execute(f'SELECT host_name, etag, data FROM hosts WHERE etag IS NOT NULL AND ({where})', args)
+        return {host_name: (etag, json_loads(data)) for host_name, etag, data in rows}
+
+    def delete_hosts(self, where: str, args=()):
+        self.db.execute(f'DELETE FROM tags WHERE host_name IN (SELECT host_name FROM hosts WHERE {where})', args)
+        self.db.execute(f'DELETE FROM hosts WHERE {where}', args)
+
+    def refresh(self, cmk: Checkmk, full=False):
+        '''Replace all hosts, folders and tag groups in one transaction (hosts are streamed from one collection request).
+        The host collection is requested with the ETag of the last refresh: if the server answers 304 the stored hosts
+        are kept and only folders and tag groups are replaced. full=True always refetches all hosts.
+        If anything fails the old snapshot and its refresh time are kept.'''
+        now = time.time()
+        folders = self.fetch_folders(cmk)
+        tag_groups = p.get_all_tag_groups(cmk)
+        res = cmk.get_all_hosts(stream=True, etag=None if full else self.get_meta('hosts_etag') or None)
+        with self.db:
+            if res.res.status_code != 304:
+                stored = self.stored_hosts('1')
+                self.delete_hosts('1')
+                for host_json in res.iter_values():
+                    self.store_host(host_json, kept_etag(stored, host_json), now)
+                self.set_meta('hosts_etag', res.res.headers.get('etag') or '')
+            self.store_folders(folders, now)
+            self.store_tag_groups(tag_groups)
+            self.set_meta('refreshed_at', now)
+
+    def fetch_folders(self, cmk: Checkmk) -> list:
+        'Folder objects of the whole folder tree'
+        res = cmk.get_all_folders('~', recursive=True)
+        if not res.ok():
+            raise Exception(f'Folder query failed ({res.res.status_code})!')
+        return res.json()['value']
+
+    def store_folders(self, folders: list, now=None):
+        'Replace the folder tree (in the current transaction)'
+        self.db.execute('DELETE FROM folders')
+        for folder_json in folders:
+            ext = folder_json.get('extensions', {})
+            path = ext.get('path', folder_json.get('id'))
+            self.db.execute('INSERT OR REPLACE INTO folders (path, title, data, fetched_at) VALUES (?, ?, ?, ?)',
+                            (path, folder_json.get('title'), json_dumps(folder_json), now or time.time()))
+
+    def refresh_folder(self, cmk: Checkmk, folder: str):
+        'Replace the hosts of one folder (path delimiters ~, / or \\)'
+        res = cmk.get_all_hosts_in_folder(folder)
+        if not res.ok():
+            raise Exception(f'Query of folder {folder} failed ({res.res.status_code})!')
+        now = time.time()
+        path = '/' + folder.replace('~', '/').replace('\\', '/').strip('/')
+        with self.db:
+            stored = self.stored_hosts('folder = ?', (path,))
+            self.delete_hosts('folder = ?', (path,))
+            for host_json in res.json()['value']:
+                self.store_host(host_json, kept_etag(stored, host_json), now)
+
+    def refresh_hosts(self, cmk: Checkmk, hostnames: list):
+        'Refetch single hosts (and their etags). Hosts that no longer exist are removed.'
+        with self.db:
+            for hostname in hostnames:
+                res = cmk.get_host(hostname, False)
+                if res.ok():
+                    self.store_host(res.json(), res.res.headers.get('etag'))
+                elif res.res.status_code == 404:
+                    self.delete_hosts('host_name = ?', (hostname,))
+                else:
+                    raise Exception(f'Query of host {hostname} failed ({res.res.status_code})!')
+
+    def store_tag_groups(self, tag_groups: list):
+        'Replace the tag group catalogue (in the current transaction)'
+        self.db.execute('DELETE FROM tag_groups')
+        self.db.executemany('INSERT OR REPLACE INTO tag_groups VALUES (?, ?, ?, ?)',
+                            ((t.tag_group, t.tag_val_id, t.tag_val_title, json_dumps(t.tag_val_aux_tags)) for t in tag_groups))
+
+    def iter_hosts(self):
+        'Yield stored host objects'
+        for (data,) in self.db.execute('SELECT data FROM hosts ORDER BY host_name'):
+            yield json_loads(data)
+
+    def host_names(self) -> list:
+        'Names of all stored hosts'
+        return [row[0] for row in self.db.execute('SELECT host_name FROM hosts ORDER BY host_name')]
+
+    def iter_all_hosts_tags(self):
+        'Yield stored tags (named tuples Tag)'
+        for row in self.db.execute('SELECT host_name, tag_group, value FROM tags ORDER BY host_name, tag_group'):
+            yield p.Tag(*row)
+
+    def get_all_tag_groups(self) -> list:
+        'Stored tag groups (list of named tuples TagGroupOption)'
+        rows = self.db.execute('SELECT tag_group, tag_val_id, tag_val_title, tag_val_aux_tags FROM tag_groups ORDER BY rowid')
+        return [p.TagGroupOption(tg, val_id, title, json_loads(aux)) for tg, val_id, title, aux in rows]
+
+
+def kept_etag(stored: dict, host_json: dict):
+    '''Etag of a host in a new listing (the host collection does not return etags): the stored etag if the host's folder
+    and attributes did not change since it was fetched one by one, None otherwise.'''
+    etag, old = stored.get(host_json['id'], (None, None))
+    if old is None:
+        return None
+    ext, old_ext = host_json['extensions'], old['extensions']
+    if ext.get('folder') != old_ext.get('folder') or ext.get('attributes') != old_ext.get('attributes'):
+        return None
+    return etag
+
+
+def open_snapshot(cmk: Checkmk, max_age: float, filename=None) -> Snapshot:
+    'Open snapshot and fully refresh it if it is older than max_age seconds'
+    snap = Snapshot(filename or default_filename())
+    if not snap.is_fresh(max_age):
+        snap.refresh(cmk)
+    return snap
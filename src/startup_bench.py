@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Startup benchmark of the command line frontends
+#
+# Measures cold start wall time of cli.py and fab (median of n runs) and shows the -X importtime breakdown of cli.py.
+# Fails (exit code 1) if cli.py is slower than --max-ms or imports one of the --forbid modules for a command
+# that doesn't need them, so import time regressions are caught.
+#
+#   $ python startup_bench.py -n 20 --max-ms 150
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def wall_times(cmd: list, n: int) -> list:
+    'Wall time in ms of n runs of cmd'
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def import_times(cmd: list) -> list:
+    'Parse python -X importtime output: list of (cumulative us, self us, module), slowest first'
+    p = subprocess.run(cmd, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf8', check=False)
+    res = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        res.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return sorted(res, reverse=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Startup benchmark of cli.py and fab')
+    parser.add_argument('-n', type=int, default=10, help='Runs per command')
+    parser.add_argument('--command', default='test', help='cli/fab command to start (default: test, needs no server)')
+    parser.add_argument('--top', type=int, default=15, help='Show the slowest top imports')
+    parser.add_argument('--max-ms', type=float, default=None, help='Fail if median cli start time is above this')
+    parser.add_argument('--forbid', default='requests,fabric,invoke,paramiko,cryptography',
+                        help='Fail if cli imports one of these modules for --command (separated with ,)')
+    args = parser.parse_args(argv)
+
+    cli = [sys.executable, 'cli.py', args.command]
+    runs = [('cli.py', cli)]
+    if shutil.which('fab'):
+        runs.append(('fab', ['fab', args.command]))
+
+    medians = {}
+    for name, cmd in runs:
+        times = wall_times(cmd, args.n)
+        medians[name] = statistics.median(times)
+        print(f'{name:<8} median {medians[name]:8.1f} ms   min {min(times):8.1f} ms   max {max(times):8.1f} ms   ({args.n} runs)')
+
+    imports = import_times([sys.executable, '-X', 'importtime', 'cli.py', args.command])
+    print(f'\ncli.py {args.command}: slowest imports (cumulative us, self us)')
+    for cumulative_us, self_us, module in imports[:args.top]:
+        print(f'{cumulative_us:10} {self_us:10}  {module}')
+
+    failed = False
+    imported = {module.strip().split('.')[0] for _, _, module in imports}
+    forbidden = sorted(imported & set(filter(None, args.forbid.split(','))))
+    if forbidden:
+        print(f'\nFAIL: cli.py {args.command} imports {", ".join(forbidden)}')
+        failed = True
+    if args.max_ms is not None and medians['cli.py'] > args.max_ms:
+        print(f'\nFAIL: cli.py median start time {medians["cli.py"]:.1f} ms > {args.max_ms} ms')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
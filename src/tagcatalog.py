@@ -0,0 +1,117 @@
+import difflib
+import json
+import logging
+import os
+import time
+import checkutil as p
+
+
+# Tag group catalogue
+#
+# All tag groups and their values, fetched with one request (checkutil.get_all_tag_groups) and kept in a JSON file
+# for ttl seconds. Checkmk validates tag writes against it before anything is sent (Checkmk.tag_catalog), so a typo
+# costs no GET/PUT round trip, and check_file() reports every invalid row of an input file at once.
+# Enabled by env TAG_CATALOG (file), TAG_CATALOG_TTL (seconds, default 3600).
+
+
+class InvalidTag(ValueError):
+    pass
+
+
+class TagCatalog:
+    def __init__(self, fetch, filename=None, ttl=3600.0):
+        # fetch() returns the list of checkutil.TagGroupOption
+        self.fetch = fetch
+        self.filename = filename
+        self.ttl = ttl
+        # {tag_group: [tag_val_id, ...]}, loaded on first use
+        self._groups = None
+        self.fetched_at = None
+
+    @property
+    def groups(self) -> dict:
+        if self._groups is None:
+            self.load()
+        return self._groups
+
+    def load(self, refresh=False):
+        'Read the catalogue file if it is younger than ttl, fetch it from check mk (and save it) otherwise'
+        if not refresh and self.filename is not None and os.path.exists(self.filename):
+            with open(self.filename) as f:
+                data = json.load(f)
+            if time.time() - data['fetched_at'] <= self.ttl:
+                self._groups, self.fetched_at = data['groups'], data['fetched_at']
+                return
+        self.refresh()
+
+    def refresh(self):
+        'Fetch tag groups from check mk and save them'
+        groups = {}
+        for t in self.fetch():
+            groups.setdefault(t.tag_group, []).append(t.tag_val_id)
+        self._groups, self.fetched_at = groups, time.time()
+        logging.debug(f'tag catalogue: {len(groups)} tag groups fetched')
+        if self.filename is not None:
+            tmp = f'{self.filename}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'fetched_at': self.fetched_at, 'groups': groups}, f)
+            os.replace(tmp, self.filename)
+
+    def error(self, tag_group: str, value) -> str:
+        'Why tag_group=value is invalid (None if it is valid)'
+        values = self.groups.get(tag_group)
+        if values is None:
+            close = difflib.get_close_matches(tag_group, self.groups, 1)
+            return f'Unknown tag group {tag_group}' + (f' (did you mean {close[0]}?)' if close else '')
+        if value not in values:
+            close = difflib.get_close_matches(str(value), [v for v in values if v is not None], 1)
+            hint = f'did you mean {close[0]}?' if close else f'valid: {", ".join(str(v) for v in values)}'
+            return f'Invalid value {value} for tag group {tag_group} ({hint})'
+        return None
+
+    def validate(self, tag_group: str, value):
+        'Raise InvalidTag if tag_group=value is not in the catalogue'
+        error = self.error(tag_group, value)
+        if error is not None:
+            raise InvalidTag(error)
+
+    def attribute_errors(self, attributes: dict) -> list:
+        'Errors of all tag attributes (tag_...) of a host attribute dict'
+        return [e for e in (self.error(k, v) for k, v in attributes.items() if p.is_tag(k)) if e is not None]
+
+    def entry_errors(self, entry: dict) -> list:
+        'Errors of a bulk create/update entry (attributes, update_attributes and remove_attributes)'
+        errors = self.attribute_errors(entry.get('attributes') or {})
+        errors += self.attribute_errors(entry.get('update_attributes') or {})
+        errors += [f'Unknown tag group {k}' for k in entry.get('remove_attributes') or [] if p.is_tag(k) and k not in self.groups]
+        return errors
+
+
+def from_env(fetch, site_name=None):
+    '''TagCatalog from env TAG_CATALOG and TAG_CATALOG_TTL, None if TAG_CATALOG is not set.
+    {site} in TAG_CATALOG is replaced with site_name (one file per site for multi site setups).'''
+    filename = os.environ.get('TAG_CATALOG')
+    if not filename:
+        return None
+    return TagCatalog(fetch, filename.replace('{site}', site_name or ''), float(os.environ.get('TAG_CATALOG_TTL') or 3600))
+
+
+def check_file(catalog: TagCatalog, filename: str, ndjson=None):
+    '''Pre-flight check of a bulk create/update (or reconcile) input file without writing anything.
+    Yields (line, host, error) for every problem: missing host name, duplicate host, invalid tag group or value.
+    line is the record number (1 is the first record after the CSV header).'''
+    seen = set()
+    for line, rec in enumerate(p.read_records(filename, ndjson), 1):
+        host = rec.get('host_name') or rec.get('hostname')
+        if not host:
+            yield line, '', 'Missing host_name'
+            continue
+        if host in seen:
+            yield line, host, 'Duplicate host'
+        seen.add(host)
+        attributes = p.host_attributes(rec)
+        attributes.update(rec.get('update_attributes') or {})
+        for tag_group, value in (rec.get('tags') or {}).items():
+            attributes[tag_group if p.is_tag(tag_group) else f'tag_{tag_group}'] = value
+        for error in catalog.attribute_errors(attributes):
+            yield line, host, error
@@ -0,0 +1,516 @@
+import contextlib
+import sys
+
+
+# Author: Blaž Poje
+# tasks <=> plain functions behind the fab tasks (fabfile.py) and the fast start commands (cli.py)
+#
+# Modules are imported inside the functions, only for the task that runs, so cli.py starts without Fabric, requests, ...
+# vse operacije so read only, če ni parametra 'doit'
+
+DOIT_HELP = 'Enable modification (without this flag it is read only)'
+MODE_HELP = "mode is one of the enum values: ['new', 'remove', 'fix_all', 'refresh', 'only_host_labels']"
+MAX_AGE_HELP = 'Read from the local snapshot (env SNAPSHOT) and refresh it only if older than max-age seconds'
+EXPORT_HELP = {'format': 'json, ndjson or csv', 'output': 'Output file (default - is stdout), .gz and .zst are compressed', 'compress': 'gzip or zstd (default: by output file extension)'}
+SITES_HELP = {'sites-file': 'Sites file (CSV: site_name;rest_url;cafile;user;tokenf or NDJSON), default env SITES', 'site-names': 'Only these sites (separated with ; or ,)'}
+# Destructive switches without short flag
+LONG_ONLY = {'prune'}
+
+SHARDS_HELP = 'Fetch hosts folder by folder with this many parallel requests (0: all hosts in one request)'
+
+
+# Option help of the tasks (fab task name => {option: help})
+HELP = {
+    'get-host': {'get-effective-attributes': 'Fetch effective_attributes for this check mk host'},
+    'delete-host': {'doit': DOIT_HELP},
+    'create-host': {'doit': DOIT_HELP},
+    'update-host': {'doit': DOIT_HELP},
+    'bulk-create-hosts': {
+        'doit': DOIT_HELP,
+        'filename': 'CSV (; separated: host_name;folder;ip;alias;tag_...) or NDJSON file, - for stdin',
+        'chunk-size': 'Number of hosts per request',
+    },
+    'bulk-update-hosts': {
+        'doit': DOIT_HELP,
+        'filename': 'CSV (; separated: host_name;ip;tag_...) or NDJSON file, - for stdin',
+        'chunk-size': 'Number of hosts per request',
+    },
+    'bulk-delete-hosts': {
+        'doit': DOIT_HELP,
+        'filename': 'CSV (column host_name) or NDJSON file, - for stdin',
+        'chunk-size': 'Number of hosts per request',
+    },
+    'reconcile': {
+        'doit': 'Enable modification (without this flag only the plan is shown)',
+        'filename': 'Desired inventory: CSV (; separated: host_name;folder;ip;alias;tag_...), NDJSON or YAML file, - for stdin',
+        'prune': 'Delete hosts below --scope that are not in the desired inventory (no short flag)',
+        'scope': 'Folder that --prune deletes in (and below), required with --prune, / is the whole site',
+        'chunk-size': 'Number of hosts per request',
+    },
+    'check-file': {
+        'filename': 'CSV (; separated: host_name;folder;ip;tag_...) or NDJSON file, - for stdin',
+        'refresh': 'Fetch the tag catalogue even if the cached one (env TAG_CATALOG) is fresh',
+    },
+    'update-host-tag': {'doit': DOIT_HELP},
+    'remove-host-tag': {'doit': DOIT_HELP},
+    'update-host-ip': {'doit': DOIT_HELP},
+    'remove-host-ip': {'doit': DOIT_HELP},
+    'activate': {
+        'doit': DOIT_HELP,
+        'wait': 'Wait until the activation is finished and print its duration',
+        'if-pending': 'Skip activation if there are no pending changes',
+        'timeout': 'Give up waiting after this many seconds',
+    },
+    'discover': {
+        'doit': DOIT_HELP,
+        'mode': MODE_HELP,
+        'hostnames': 'hostnames separated with ; or ,',
+        'workers': 'Number of hosts discovered concurrently',
+        'timeout': 'Per host timeout in seconds',
+    },
+    'discover-fixall': {
+        'doit': DOIT_HELP,
+        'hostnames': 'hostnames separated with ; or ,',
+        'workers': 'Number of hosts discovered concurrently',
+        'timeout': 'Per host timeout in seconds',
+    },
+    'bulk-discover': {
+        'doit': DOIT_HELP,
+        'mode': MODE_HELP,
+        'hostnames': 'hostnames separated with ; or ,',
+        'batch-size': 'Number of hosts the server discovers in one go',
+        'timeout': 'Give up waiting for the job after this many seconds',
+    },
+    'snapshot-refresh': {
+        'folders': 'Refresh only hosts in these folders (separated with ; or ,)',
+        'hostnames': 'Refresh only these hosts (separated with ; or ,)',
+        'full': 'Refetch all hosts even if the host collection is unchanged',
+    },
+    'get-all-hosts': {'max-age': MAX_AGE_HELP, 'shards': SHARDS_HELP} | EXPORT_HELP,
+    'get-all-hosts-in-folder': EXPORT_HELP,
+    'get-all-folders': EXPORT_HELP,
+    'get-all-tags': {'max-age': MAX_AGE_HELP, 'shards': SHARDS_HELP} | EXPORT_HELP,
+    'get-all-tag-group': {'max-age': MAX_AGE_HELP} | EXPORT_HELP,
+    'get-tag-hist': {'max-age': MAX_AGE_HELP, 'shards': SHARDS_HELP} | EXPORT_HELP,
+    'tag-query': {
+        'query': 'Boolean tag query, e.g. "tag_os=linux AND NOT tag_env=prod" (operators: AND, OR, NOT, =, !=, parentheses)',
+        'count': 'Print only the number of matching hosts',
+        'max-age': MAX_AGE_HELP,
+    },
+    'sites-get-host': SITES_HELP,
+    'sites-get-all-tags': SITES_HELP | {'shards': SHARDS_HELP} | EXPORT_HELP,
+    'sites-get-tag-hist': SITES_HELP | {'shards': SHARDS_HELP} | EXPORT_HELP,
+    'sites-activate': SITES_HELP | {
+        'doit': DOIT_HELP,
+        'wait': 'Wait until the activations are finished',
+        'if-pending': 'Skip sites without pending changes',
+        'timeout': 'Give up waiting after this many seconds',
+    },
+    'host-status': {
+        'query': 'Query expression in JSON, e.g. \'{"op": "=", "left": "state", "right": "1"}\'',
+        'columns': 'Returned columns (separated with ; or ,)',
+        'state': 'Only hosts in one of these states (UP, DOWN, UNREACH or numbers, separated with ; or ,)',
+        'tag': 'Only hosts with these tags (tag_group=value, separated with ; or ,)',
+    } | EXPORT_HELP,
+    'service-status': {
+        'query': 'Query expression in JSON, e.g. \'{"op": "=", "left": "state", "right": "2"}\'',
+        'columns': 'Returned columns (separated with ; or ,)',
+        'state': 'Only services in one of these states (OK, WARN, CRIT, UNKNOWN or numbers, separated with ; or ,)',
+        'tag': 'Only services of hosts with these tags (tag_group=value, separated with ; or ,)',
+        'hostname': 'Only services of this host',
+    } | EXPORT_HELP,
+    'watch': {
+        'interval': 'Seconds between polls',
+        'cycles': 'Stop after this many polls (0: run forever)',
+        'mode': 'etag (folder listing + conditional GET per host) or collection (conditional GET of all hosts)',
+        'workers': 'Parallel conditional GETs (etag mode)',
+        'initial': 'Report all existing hosts as created on the first poll',
+        'state-file': 'Keep known hosts (per mode) and the collection ETag between runs in this file',
+    },
+    'batch': {
+        'filename': 'NDJSON file with one operation per line ({"op": "get-host", "args": {"hostname": "h1"}}), - for stdin',
+        'workers': 'Number of operations run concurrently',
+        'daemon': 'Send the batch to the daemon (env DAEMON_SOCKET) instead of opening a session',
+    },
+    'daemon': {
+        'socket': 'Unix socket path (default env DAEMON_SOCKET, otherwise checkmk-rest.sock in XDG_RUNTIME_DIR or /tmp/checkmk-rest-<uid>)',
+        'workers': 'Number of operations of a batch run concurrently',
+    },
+}
+
+
+def json_dumps(obj) -> str:
+    from checkmk import json_dumps
+    return json_dumps(obj)
+
+
+def create_checkmk():
+    from checkmk import create_checkmk
+    return create_checkmk()
+
+
+def split_hosts(hostnames: str) -> list:
+    return hostnames.replace(',', ';').split(';')
+
+
+def open_snapshot(cmk, max_age):
+    '''Open the local snapshot (refresh it if older than max_age seconds) as a context manager that closes it.
+    The context value is None if max_age is not set.'''
+    if max_age is None:
+        return contextlib.nullcontext()
+    import snapshot
+    return snapshot.open_snapshot(cmk, float(max_age))
+
+
+def print_bulk_results(results):
+    'Print BulkResult in CSV form while they arrive'
+    import export as x
+    with x.open_output(line_buffering=True) as out:
+        out.write('host;ok;status;detail\n')
+        for r in results:
+            out.write(f'{r.host};{r.ok};{r.status};{r.detail}\n')
+
+
+def get_host(hostname, get_effective_attributes=False):
+    'check mk: get host'
+    return json_dumps(create_checkmk().get_host(hostname, get_effective_attributes).json())
+
+
+def delete_host(hostname, doit=False):
+    'check mk: delete host'
+    if doit:
+        return create_checkmk().delete_host(hostname)
+
+
+def create_host(hostname, folder, ip=None, alias=None, doit=False):
+    'check mk: create host'
+    if doit:
+        return json_dumps(create_checkmk().create_host(hostname, folder, ip, alias).json())
+
+
+def update_host(hostname, data, etag, doit=False):
+    '''check mk: update host
+    Change only one parameter: data = {"update_attributes": {"tag_shop": "value1"}}
+    Change all checkmk host parameters (any parameters not defined in body will be cleared): data = {"attributes": {"ipaddress": "192.168.0.6"}}
+    Remove checkmk parameter (don't change other parameters): data = {"remove_attributes": ["tag_shop_type"]}
+    '''
+    if doit:
+        return json_dumps(create_checkmk().update_host(hostname, data, etag).json())
+
+
+def bulk_create_hosts(filename, chunk_size=100, doit=False):
+    'check mk: create hosts from CSV/NDJSON file'
+    import checkutil as p
+    print_bulk_results(create_checkmk().bulk_create_hosts(p.read_hosts_create(filename), chunk_size, send=doit))
+
+
+def bulk_update_hosts(filename, chunk_size=100, doit=False):
+    'check mk: update hosts from CSV/NDJSON file'
+    import checkutil as p
+    print_bulk_results(create_checkmk().bulk_update_hosts(p.read_hosts_update(filename), chunk_size, send=doit))
+
+
+def bulk_delete_hosts(filename, chunk_size=100, doit=False):
+    'check mk: delete hosts from CSV/NDJSON file'
+    import checkutil as p
+    print_bulk_results(create_checkmk().bulk_delete_hosts(p.read_hosts_delete(filename), chunk_size, send=doit))
+
+
+def reconcile(filename, prune=False, scope=None, chunk_size=100, doit=False):
+    'check mk: make hosts match the desired inventory with a minimal set of bulk changes (NDJSON output)'
+    import export as x
+    import reconcile as r
+    changes = r.reconcile(create_checkmk(), filename, prune, scope, chunk_size, send=doit)
+    x.print_lines(json_dumps(r.result_record(change, result)) for change, result in changes)
+
+
+def check_file(filename, refresh=False):
+    'Check host names and tags of a bulk/reconcile input file against the tag catalogue, print every invalid row (CSV)'
+    import checkutil as p
+    import export as x
+    import tagcatalog as tc
+    cmk = create_checkmk()
+    catalog = cmk.tag_catalog or tc.TagCatalog(lambda: p.get_all_tag_groups(cmk))
+    if refresh:
+        catalog.refresh()
+    errors = 0
+    with x.open_output(line_buffering=True) as out:
+        out.write('line;host;error\n')
+        for line, host, error in tc.check_file(catalog, filename):
+            out.write(f'{line};{host};{error}\n')
+            errors += 1
+    print(f'{errors} errors', file=sys.stderr)
+    if errors:
+        sys.exit(1)
+
+
+def update_host_tag(hostname, tag_group, tag_group_value, doit=False):
+    'check mk: update host tag'
+    if doit:
+        return json_dumps(create_checkmk().update_host_tag(hostname, tag_group, tag_group_value).json())
+
+
+def remove_host_tag(hostname, tag_group, doit=False):
+    'check mk: remove host tag'
+    if doit:
+        return json_dumps(create_checkmk().remove_host_tag(hostname, tag_group).json())
+
+
+def update_host_ip(hostname, ip, doit=False):
+    'check mk: update host ip'
+    if doit:
+        return json_dumps(create_checkmk().update_host_ipaddress(hostname, ip).json())
+
+
+def remove_host_ip(hostname, doit=False):
+    'check mk: remove host ip'
+    if doit:
+        return json_dumps(create_checkmk().remove_host_ipaddress(hostname).json())
+
+
+def activate(force_foreign_changes=False, wait=False, if_pending=False, timeout=None, doit=False):
+    'check mk: activate'
+    if doit:
+        if wait or if_pending:
+            from activation import ActivationManager
+            timeout = float(timeout) if timeout is not None else None
+            am = ActivationManager(create_checkmk(), force_foreign_changes, timeout=timeout)
+            return json_dumps(am.activate(wait=wait, only_if_pending=if_pending))
+        return json_dumps(create_checkmk().activate_changes(force_foreign_changes).json())
+    else:
+        print(f'doit: {doit}')
+
+
+def discover(hostnames, mode, workers=1, timeout=None, doit=False):
+    '''check mk: discover services on check mk hosts'''
+    if doit:
+        timeout = float(timeout) if timeout is not None else None
+        return create_checkmk().discover_services(split_hosts(hostnames), mode, workers=workers, timeout=timeout)
+    else:
+        print(f'doit: {doit}')
+
+
+def discover_fixall(hostnames, workers=1, timeout=None, doit=False):
+    '''check mk: Fix all services on check mk hosts'''
+    if doit:
+        timeout = float(timeout) if timeout is not None else None
+        return create_checkmk().discover_fixall(split_hosts(hostnames), workers=workers, timeout=timeout)
+    else:
+        print(f'doit: {doit}')
+
+
+def bulk_discover(hostnames, mode, batch_size=10, timeout=None, doit=False):
+    '''check mk: discover services on check mk hosts with a server side background job'''
+    if doit:
+        timeout = float(timeout) if timeout is not None else None
+        return json_dumps(create_checkmk().bulk_discover(split_hosts(hostnames), mode, batch_size, timeout=timeout))
+    else:
+        print(f'doit: {doit}')
+
+
+def get_etag(hostname):
+    'check mk: get etag value (value that changes on every modification of check mk host)'
+    return create_checkmk().get_etag(hostname)
+
+
+def get_tag_group(tag_group_name):
+    'check mk: Get a host tag group with all its values'
+    j = create_checkmk().get_tag_group(tag_group_name).json()
+    return json_dumps(j)
+
+
+def snapshot_refresh(folders=None, hostnames=None, full=False):
+    'Refresh the local inventory snapshot (all hosts, folders and tag groups if no folders or hostnames are given)'
+    import snapshot as s
+    cmk = create_checkmk()
+    with s.Snapshot(s.default_filename()) as snap:
+        if folders is not None:
+            for folder in split_hosts(folders):
+                snap.refresh_folder(cmk, folder)
+        if hostnames is not None:
+            snap.refresh_hosts(cmk, split_hosts(hostnames))
+        if folders is None and hostnames is None:
+            snap.refresh(cmk, full)
+
+
+def get_all_hosts(max_age=None, shards=0, format='json', output='-', compress=None):
+    'check mk: get all hosts in json'
+    import export as x
+    cmk = create_checkmk()
+    # links, id, domainType, ... of the host collection (json output of check mk, not of the snapshot or shards)
+    envelope = {}
+    with open_snapshot(cmk, max_age) as snap:
+        if snap is not None:
+            hosts = snap.iter_hosts()
+        elif shards:
+            hosts = cmk.iter_all_hosts_sharded(shards)
+        else:
+            hosts = x.iter_collection(cmk.get_all_hosts(stream=True), 'Fetching all hosts', envelope)
+        x.export_hosts(hosts, format, output, compress, envelope)
+
+
+def get_all_hosts_in_folder(folder, format='json', output='-', compress=None):
+    'check mk: get all hosts in folder'
+    import export as x
+    res = create_checkmk().get_all_hosts_in_folder(folder, stream=True)
+    envelope = {}
+    x.export_hosts(x.iter_collection(res, f'Fetching hosts of folder {folder}', envelope), format, output, compress, envelope)
+
+
+def get_all_folders(parent, recursive=False, show_hosts=False, format='json', output='-', compress=None):
+    '''check mk: lists subfolders (and the hosts in subfolders) of folder x. It won't show the files that are in folder x.
+    parent string - Show all sub-folders of this folder. The default is the root-folder. Path delimiters can be either ~, / or \\. Please use the one most appropriate for your quoting/escaping needs. A good default choice is ~.
+    recursive boolean - List the folder (default: root) and all its sub-folders recursively.
+    show_hosts boolean - When set, all hosts that are stored in each folder will also be shown. On large setups this may come at a performance cost, so by default this is switched off.
+    '''
+    import export as x
+    res = create_checkmk().get_all_folders(parent, recursive, show_hosts, stream=True)
+    envelope = {}
+    x.export_folders(x.iter_collection(res, 'Listing folders', envelope), format, output, compress, envelope)
+
+
+def get_all_tags(max_age=None, shards=0, format='csv', output='-', compress=None):
+    'Iterate over all hosts and extract their tags in CSV form'
+    import checkutil as p
+    import export as x
+    cmk = create_checkmk()
+    with open_snapshot(cmk, max_age) as snap:
+        res = snap.iter_all_hosts_tags() if snap is not None else p.iter_all_hosts_tags(cmk, shards)
+        x.export(res, format, x.TAG_COLUMNS, output, compress)
+
+
+def get_all_tag_group(max_age=None, format='csv', output='-', compress=None):
+    'Iterate over all tag groups and their possible values (enums) in CSV form'
+    import checkutil as p
+    import export as x
+    cmk = create_checkmk()
+    with open_snapshot(cmk, max_age) as snap:
+        res = snap.get_all_tag_groups() if snap is not None else p.get_all_tag_groups(cmk)
+    x.export(res, format, x.TAG_GROUP_COLUMNS, output, compress, x.TAG_GROUP_HEADER)
+
+
+def get_tag_hist(max_age=None, shards=0, format='csv', output='-', compress=None):
+    'Get all tag groups and their possible values and left join them with hosts that use them. In CSV form'
+    import checkutil as p
+    import export as x
+    cmk = create_checkmk()
+    with open_snapshot(cmk, max_age) as snap:
+        res = p.get_tag_histogram(cmk, snap, shards)
+    x.export(x.histogram_rows(res), format, x.HISTOGRAM_COLUMNS, output, compress)
+
+
+def tag_query(query, count=False, max_age=None):
+    'Print hosts whose tags match a boolean tag query'
+    import checkutil as p
+    import export as x
+    cmk = create_checkmk()
+    with open_snapshot(cmk, max_age) as snap:
+        index = p.get_tag_index(cmk, snap)
+    if count:
+        print(index.count(query))
+    else:
+        x.print_lines(index.query(query))
+
+
+def sites_get_host(hostname, sites_file=None, site_names=None):
+    'all sites: get host from every site that knows it (NDJSON: site, host)'
+    import export as x
+    import sites as m
+    ms = m.MultiSite.from_file(sites_file, split_hosts(site_names) if site_names else None)
+    # Print what the healthy sites returned before the errors of the others are raised
+    try:
+        hosts, errors = ms.get_host(hostname), None
+    except m.SiteErrors as e:
+        hosts, errors = e.results, e
+    x.print_lines(json_dumps({'site': site, 'host': host}) for site, host in hosts.items())
+    if errors:
+        raise errors
+
+
+def sites_get_all_tags(sites_file=None, site_names=None, shards=0, format='csv', output='-', compress=None):
+    'all sites: iterate over all hosts of all sites and extract their tags in CSV form'
+    import export as x
+    import sites as m
+    ms = m.MultiSite.from_file(sites_file, split_hosts(site_names) if site_names else None)
+    rows = ({'site': site} | t._asdict() for site, t in ms.iter_all_hosts_tags(shards))
+    x.export(rows, format, ['site'] + x.TAG_COLUMNS, output, compress)
+
+
+def sites_get_tag_hist(sites_file=None, site_names=None, shards=0, format='csv', output='-', compress=None):
+    'all sites: tag histogram of every site in CSV form'
+    import export as x
+    import sites as m
+    ms = m.MultiSite.from_file(sites_file, split_hosts(site_names) if site_names else None)
+    rows = ({'site': site} | row for site, key, hosts in ms.iter_tag_histogram(shards) for row in x.histogram_rows({key: hosts}))
+    x.export(rows, format, ['site'] + x.HISTOGRAM_COLUMNS, output, compress)
+
+
+def sites_activate(sites_file=None, site_names=None, force_foreign_changes=False, wait=False, if_pending=False, timeout=None, doit=False):
+    'all sites: activate changes on all sites in parallel (NDJSON: site and activation summary)'
+    if not doit:
+        print(f'doit: {doit}')
+        return
+    import export as x
+    import sites as m
+    timeout = float(timeout) if timeout is not None else None
+    ms = m.MultiSite.from_file(sites_file, split_hosts(site_names) if site_names else None)
+    try:
+        summaries, errors = ms.activate(force_foreign_changes, wait, if_pending, timeout), None
+    except m.SiteErrors as e:
+        summaries, errors = e.results, e
+    x.print_lines(json_dumps({'site': site} | summary) for site, summary in summaries.items())
+    if errors:
+        raise errors
+
+
+def host_status(query=None, columns=None, state=None, tag=None, format='csv', output='-', compress=None):
+    'check mk: monitoring state of hosts, filtered on the server'
+    import export as x
+    import monitoring as mo
+    columns = split_hosts(columns) if columns else mo.HOST_COLUMNS
+    q = mo.build_query(query, split_hosts(state) if state else None, split_hosts(tag) if tag else None)
+    res = create_checkmk().get_hosts_status(q, columns, stream=True)
+    x.export(mo.iter_records(res), format, columns, output, compress)
+
+
+def service_status(query=None, columns=None, state=None, tag=None, hostname=None, format='csv', output='-', compress=None):
+    'check mk: monitoring state of services, filtered on the server'
+    import export as x
+    import monitoring as mo
+    columns = split_hosts(columns) if columns else mo.SERVICE_COLUMNS
+    q = mo.build_query(query, split_hosts(state) if state else None, split_hosts(tag) if tag else None, mo.SERVICE_TAGS)
+    res = create_checkmk().get_services_status(q, columns, hostname, stream=True)
+    x.export(mo.iter_records(res), format, columns, output, compress)
+
+
+def watch(interval=60, cycles=0, mode='etag', workers=8, initial=False, state_file=None):
+    'check mk: print created, changed and deleted hosts as NDJSON events'
+    import export as x
+    import watch as w
+    with x.open_output(line_buffering=True) as out:
+        w.watch(create_checkmk(), float(interval), cycles, mode, workers, initial, state_file, out=lambda line: out.write(line + '\n'))
+
+
+def batch(filename='-', workers=1, daemon=False):
+    'Run operations (fab task names and arguments) from NDJSON over one session, print NDJSON results in input order'
+    import batch as b
+    f = sys.stdin if filename == '-' else open(filename, 'r')
+    import export as x
+    with x.open_output(line_buffering=True) as out:
+        if daemon:
+            b.send_batch(f, out)
+        else:
+            # Keep stdout clean NDJSON: progress prints of operations go to stderr
+            with contextlib.redirect_stdout(sys.stderr):
+                b.write_results(b.run_batch(create_checkmk(), f, workers), out)
+
+
+def daemon(socket=None, workers=1):
+    'Keep a check mk session open and run batches sent to the unix socket (fab batch --daemon)'
+    import batch as b
+    b.serve(create_checkmk(), socket, workers)
+
+
+def test():
+    'test'
+    print('test')
@@ -0,0 +1,171 @@
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+import logging
+import asyncio
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# HTTP transport for the check mk session: connection pool size, timeouts, retries with backoff and rate limiting
+
+
+@dataclass
+class TransportConfig:
+    'Transport settings of a Checkmk session'
+    # Connections kept alive per host (set it >= number of worker threads)
+    pool_size: int = 10
+    # Default request timeout in seconds (None waits forever)
+    timeout: float = None
+    # Retries of requests answered with one of retry_statuses (or failed to connect)
+    retries: int = 3
+    retry_statuses: tuple = (429, 502, 503, 504)
+    # Exponential backoff: backoff * 2^attempt seconds (with jitter), at most max_backoff
+    backoff: float = 0.5
+    max_backoff: float = 30.0
+    # Client side rate limit in requests per second shared by all threads (None is unlimited) and its burst size
+    rate: float = None
+    burst: int = 1
+
+
+# Methods that can be repeated when the server may have already processed the request (502/504, read errors)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+class TokenBucket:
+    'Thread safe token bucket: on average rate acquisitions per second, at most burst at once'
+
+    def __init__(self, rate: float, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        'Take one token, sleep until one is available'
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AsyncTokenBucket(TokenBucket):
+    'Token bucket for asyncio tasks (waiting does not block the event loop)'
+
+    async def acquire(self):
+        'Take one token, sleep until one is available'
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+def configure_session(session: requests.Session, config: TransportConfig):
+    'Mount a keep-alive connection pool of config.pool_size connections on the session'
+    adapter = HTTPAdapter(pool_connections=config.pool_size, pool_maxsize=config.pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+
+
+def retry_after(res: requests.Response):
+    'Seconds from the Retry-After header (delta seconds or HTTP date), None if it is missing or invalid'
+    value = res.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(config: TransportConfig, attempt: int) -> float:
+    'Exponential backoff with jitter (between half and full delay)'
+    delay = min(config.max_backoff, config.backoff * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def send(session: requests.Session, pre: requests.PreparedRequest, config: TransportConfig, limiter=None, on_retry=None,
+         **kwargs) -> requests.Response:
+    '''Send prepared request, retry on config.retry_statuses and connection errors.
+    Requests that are not idempotent are only retried when the server surely didn't process them (429, 503, connect timeouts).
+    on_retry(status or exception) is called before every retry.'''
+    idempotent = pre.method in IDEMPOTENT_METHODS
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            res = session.send(pre, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            # Connect timeouts are safe to repeat, other connection errors may happen after the server got the request
+            safe = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+            if attempt >= config.retries or not safe:
+                raise
+            delay = backoff_delay(config, attempt)
+            logging.debug('%s %s: %s, retry in %.2fs', pre.method, pre.url, e, delay)
+            if on_retry is not None:
+                on_retry(e)
+        else:
+            retriable = res.status_code in config.retry_statuses and (idempotent or res.status_code in (429, 503))
+            if attempt >= config.retries or not retriable:
+                return res
+            delay = retry_after(res)
+            delay = min(delay, config.max_backoff) if delay is not None else backoff_delay(config, attempt)
+            logging.debug('%s %s: status %s, retry in %.2fs', pre.method, pre.url, res.status_code, delay)
+            if on_retry is not None:
+                on_retry(res.status_code)
+            # Release the connection back to the pool
+            res.close()
+        attempt += 1
+        time.sleep(delay)
+
+
+async def async_send(client, req, config: TransportConfig, limiter=None, stream=False, on_retry=None):
+    'Send httpx request with the same retry rules as send() (httpx is optional, it is only imported here)'
+    import httpx
+    idempotent = req.method in IDEMPOTENT_METHODS
+    attempt = 0
+    while True:
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            res = await client.send(req, stream=stream)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            if attempt >= config.retries:
+                raise
+            delay = backoff_delay(config, attempt)
+            logging.debug('%s %s: %s, retry in %.2fs', req.method, req.url, e, delay)
+            if on_retry is not None:
+                on_retry(e)
+        else:
+            retriable = res.status_code in config.retry_statuses and (idempotent or res.status_code in (429, 503))
+            if attempt >= config.retries or not retriable:
+                return res
+            delay = retry_after(res)
+            delay = min(delay, config.max_backoff) if delay is not None else backoff_delay(config, attempt)
+            logging.debug('%s %s: status %s, retry in %.2fs', req.method, req.url, res.status_code, delay)
+            if on_retry is not None:
+                on_retry(res.status_code)
+            await res.aclose()
+        attempt += 1
+        await asyncio.sleep(delay)
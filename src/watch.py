@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from checkmk import Checkmk, json_dumps
+
+
+# Change feed of check mk hosts
+#
+# Watcher keeps a fingerprint (ETag) of every known host and reports only hosts that were created, changed or
+# deleted since the last poll. Two modes:
+#   etag        list host names with one folder listing, then a conditional GET (If-None-Match) per known host:
+#               unchanged hosts are answered with 304 and no body, only new and changed hosts are transferred
+#   collection  one conditional GET of the host collection: 304 if nothing changed at all, otherwise the collection
+#               is streamed and compared host by host (fingerprint is a hash of the host object)
+#
+# Events are dicts {event: created|changed|deleted, host, folder, attributes, etag, time}, watch() writes them
+# as NDJSON. The state file keeps the known hosts (and the collection ETag) of each mode separately: ETags and
+# fingerprints can't be compared, so after a mode switch each mode continues from its own last run.
+
+MODES = ['etag', 'collection']
+
+
+def fingerprint(host_json: dict) -> str:
+    'Hash of the host configuration (used when the server sends no per host ETag)'
+    data = json.dumps(host_json.get('extensions', {}), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def event(kind: str, host: str, host_json=None, etag=None) -> dict:
+    ext = host_json.get('extensions', {}) if host_json is not None else {}
+    return {'event': kind, 'host': host, 'folder': ext.get('folder'), 'attributes': ext.get('attributes'),
+            'etag': etag, 'time': time.time()}
+
+
+class Watcher:
+    def __init__(self, cmk: Checkmk, mode='etag', workers=8, known=None, collection_etag=None):
+        assert mode in MODES
+        self.cmk = cmk
+        self.mode = mode
+        self.workers = workers
+        # {hostname: etag or fingerprint} of the last poll
+        self.known = dict(known or {})
+        # ETag of the last host collection (collection mode)
+        self.collection_etag = collection_etag
+
+    def list_hosts(self) -> set:
+        'Host names of all folders (folder listing with host links, no host objects)'
+        res = self.cmk.get_all_folders('~', recursive=True, show_hosts=True)
+        if not res.ok():
+            raise Exception(f'Listing folders failed ({res.res.status_code})')
+        names = set()
+        for folder in res.json()['value']:
+            for link in folder.get('members', {}).get('hosts', {}).get('value', []):
+                names.add(link.get('title') or link['href'].rsplit('/', 1)[-1])
+        return names
+
+    def check_host(self, hostname: str):
+        '''Fetch host if it is new or its etag changed. Returns an event or None if the host is unchanged.
+        Servers that ignore If-None-Match answer 200 with the same etag, which is treated as unchanged too.'''
+        known = self.known.get(hostname)
+        res = self.cmk.get_host_if_changed(hostname, known) if known is not None else self.cmk.get_host(hostname, False)
+        status = res.res.status_code
+        if status == 304:
+            return None
+        if status == 404:
+            return event('deleted', hostname) if known is not None else None
+        if not res.ok():
+            raise Exception(f'Fetching host {hostname} failed ({status})')
+        host_json = res.json()
+        etag = res.res.headers.get('etag') or fingerprint(host_json)
+        if etag == known:
+            return None
+        return event('changed' if known is not None else 'created', hostname, host_json, etag)
+
+    def poll_etag(self) -> list:
+        names = self.list_hosts()
+        events = [event('deleted', host) for host in self.known.keys() - names]
+        events += [e for e in self.cmk.map_hosts(self.check_host, sorted(names), self.workers) if e is not None]
+        return events
+
+    def poll_collection(self) -> list:
+        res = self.cmk.get_all_hosts(stream=True, etag=self.collection_etag)
+        if res.res.status_code == 304:
+            return []
+        if not res.ok():
+            raise Exception(f'Fetching all hosts failed ({res.res.status_code})')
+
+        events, seen = [], set()
+        for host_json in res.iter_values():
+            host, fp = host_json['id'], fingerprint(host_json)
+            seen.add(host)
+            known = self.known.get(host)
+            if known != fp:
+                events.append(event('changed' if known is not None else 'created', host, host_json, fp))
+        events += [event('deleted', host) for host in self.known.keys() - seen]
+        # Only after the whole collection was read: a 304 to this ETag means the known hosts are current
+        self.collection_etag = res.res.headers.get('etag')
+        return events
+
+    def poll(self) -> list:
+        'Events since the last poll (known state is updated)'
+        events = self.poll_etag() if self.mode == 'etag' else self.poll_collection()
+        for e in events:
+            if e['event'] == 'deleted':
+                self.known.pop(e['host'], None)
+            else:
+                self.known[e['host']] = e['etag']
+        return events
+
+
+def load_state(filename: str) -> dict:
+    '''State saved by save_state {mode: {"hosts": {hostname: etag or fingerprint}, "collection_etag": etag}}
+    (empty if the file does not exist). Files of older versions ({hostname: etag} of an unknown mode) are ignored.'''
+    if filename is None or not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        state = json.load(f)
+    if not set(state) <= set(MODES) or not all(isinstance(v, dict) for v in state.values()):
+        logging.warning(f'{filename}: state without modes (older version) is ignored')
+        return {}
+    return state
+
+
+def save_state(filename: str, state: dict):
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, filename)
+
+
+def watch(cmk: Checkmk, interval=60.0, cycles=0, mode='etag', workers=8, initial=False, state_file=None, out=print):
+    '''Poll every interval seconds (cycles=0: forever) and pass every event as NDJSON line to out.
+    The first poll only learns the current hosts unless initial=True or a state_file from an earlier run exists.
+    The state file keeps the known hosts of each mode between runs.'''
+    state = load_state(state_file)
+    saved = state.get(mode, {})
+    watcher = Watcher(cmk, mode, workers, saved.get('hosts'), saved.get('collection_etag'))
+    quiet = not initial and not watcher.known
+    cycle = 0
+    while True:
+        start = time.monotonic()
+        events = watcher.poll()
+        if not quiet:
+            for e in events:
+                out(json_dumps(e))
+        logging.debug(f'watch cycle {cycle}: {len(events)} events, {len(watcher.known)} hosts')
+        if state_file is not None:
+            state[mode] = {'hosts': watcher.known, 'collection_etag': watcher.collection_etag}
+            save_state(state_file, state)
+        quiet = False
+        cycle += 1
+        if cycles and cycle >= cycles:
+            return
+        time.sleep(max(0.0, interval - (time.monotonic() - start)))
@@ -0,0 +1,34 @@
+import os
+import sys
+import pytest
+
+# The modules are flat in src/ and import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from checkmk import Checkmk  # noqa: E402
+from mock_server import start_mock_server  # noqa: E402
+
+
+def mock_server():
+    'Mock check mk with 60 hosts in 4 folders and 3 tag groups, stopped when the generator is closed'
+    server = start_mock_server(60, folders=3, tag_groups=3, tag_values=3, seed=7)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def server():
+    'Mock server with a fresh inventory for every test'
+    yield from mock_server()
+
+
+def client(url: str) -> Checkmk:
+    cmk = Checkmk(url, '', ['automation', 'secret-token'], 'main')
+    cmk.open_session()
+    return cmk
+
+
+@pytest.fixture
+def cmk(server) -> Checkmk:
+    return client(server.url)
@@ -0,0 +1,59 @@
+import checkmk as c
+import checkutil as p
+import tagcatalog as tc
+
+
+def test_bulk_results_in_input_order(server, cmk):
+    cmk.tag_catalog = tc.TagCatalog(lambda: p.get_all_tag_groups(cmk))
+    existing = sorted(server.inventory.hosts)[:2]
+    entries = [
+        {'host_name': 'new1', 'folder': '/', 'attributes': {}},
+        {'host_name': existing[0], 'folder': '/', 'attributes': {}},
+        # Rejected by the tag catalogue, never sent
+        {'host_name': 'new2', 'folder': '/', 'attributes': {'tag_group0': 'nosuchvalue'}},
+        {'host_name': 'new3', 'folder': '/', 'attributes': {'tag_group1': 'value1'}},
+        {'host_name': existing[1], 'folder': '/', 'attributes': {}},
+        {'host_name': 'new4', 'folder': '/', 'attributes': {}},
+        {'host_name': 'new5', 'folder': '/', 'attributes': {}},
+    ]
+    results = list(cmk.bulk_create_hosts(entries, chunk_size=3))
+    assert [res.host for res in results] == [e['host_name'] for e in entries]
+    assert [res.ok for res in results] == [True, False, False, True, False, True, True]
+
+    # Hosts of a partially failed chunk only get the error status if they failed
+    assert results[0].status is None and results[1].status == 400
+    assert 'already exists' in results[1].detail
+    assert results[2].status is None and 'nosuchvalue' in results[2].detail
+    # new5 is alone in a successful chunk
+    assert results[5].status is None and results[6].status == 200
+    assert {'new1', 'new3', 'new4', 'new5'} <= server.inventory.hosts.keys()
+    assert 'new2' not in server.inventory.hosts
+
+
+def test_bulk_delete_results(server, cmk):
+    names = sorted(server.inventory.hosts)[:3]
+    results = list(cmk.bulk_delete_hosts(names + ['nosuchhost'], chunk_size=2))
+    assert [(res.host, res.ok) for res in results] == [(names[0], True), (names[1], True), (names[2], True), ('nosuchhost', False)]
+    assert not set(names) & server.inventory.hosts.keys()
+
+
+def test_bulk_dry_run(server, cmk):
+    results = list(cmk.bulk_update_hosts([{'host_name': 'h1', 'update_attributes': {}}, {'host_name': 'h2', 'update_attributes': {}}], send=False))
+    assert results == [c.BulkResult('h1', None, None, 'not sent'), c.BulkResult('h2', None, None, 'not sent')]
+
+
+def test_iter_json_array_across_chunks():
+    body = '{"links": [{"rel": "self"}], "id": "host_config", "value": [{"id": "a", "n": 1.5}, {"id": "b,]}"}, 12345], "extensions": {}}'
+    for size in (1, 2, 7, len(body)):
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        envelope = {}
+        assert list(c.iter_json_array(chunks, 'value', envelope)) == [{'id': 'a', 'n': 1.5}, {'id': 'b,]}'}, 12345]
+        assert envelope == {'links': [{'rel': 'self'}], 'id': 'host_config', 'extensions': {}}
+        assert list(c.iter_json_array(chunks)) == [{'id': 'a', 'n': 1.5}, {'id': 'b,]}'}, 12345]
+
+
+def test_streamed_collection_keeps_envelope(server, cmk):
+    envelope = {}
+    hosts = list(cmk.get_all_hosts(stream=True).iter_values(envelope=envelope))
+    assert [h['id'] for h in hosts] == list(server.inventory.hosts)
+    assert envelope['id'] == 'host_config' and 'links' in envelope and 'value' not in envelope
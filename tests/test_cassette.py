@@ -0,0 +1,49 @@
+import cassette
+from checkmk import json_dumps
+from conftest import client
+
+
+def session_calls(cmk) -> list:
+    'Reads and writes of a short session, as comparable JSON'
+    out = [cmk.get_host('host000001', False).json(), list(cmk.get_all_hosts(stream=True).iter_values())]
+    etag = cmk.get_etag('host000002')
+    out.append(cmk.update_host('host000002', '{"update_attributes": {"alias": "replayed"}}', etag).res.status_code)
+    out.append([tuple(res) for res in cmk.bulk_create_hosts([{'host_name': 'new1', 'folder': '/', 'attributes': {}},
+                                                             {'host_name': 'host000003', 'folder': '/', 'attributes': {}}])])
+    out.append(cmk.get_host('host000002', False).json()['extensions']['attributes']['alias'])
+    out.append(cmk.get_host('nosuchhost', False).res.status_code)
+    return out
+
+
+def test_record_replay_round_trip(server, tmp_path):
+    filename = str(tmp_path / 'run.ndjson.gz')
+    cmk = client(server.url)
+    cmk.recorder = cassette.Recorder(filename)
+    recorded = session_calls(cmk)
+    cmk.recorder.close()
+
+    entries = cassette.read_cassette(filename)
+    assert len(entries) == 7
+    assert 'secret-token' not in json_dumps(entries)
+
+    # Replay offline: the server is gone, every answer comes from the cassette
+    server.shutdown()
+    server.server_close()
+    replay = client(server.url)
+    adapter = cassette.mount_replay(replay.session, filename, server.url, site='main')
+    assert session_calls(replay) == recorded
+    assert adapter.misses == 0
+
+
+def test_replay_miss_is_404(server, tmp_path):
+    filename = str(tmp_path / 'run.ndjson')
+    cmk = client(server.url)
+    cmk.recorder = cassette.Recorder(filename)
+    cmk.get_host('host000001', False)
+    cmk.recorder.close()
+
+    replay = client(server.url)
+    adapter = cassette.mount_replay(replay.session, filename, server.url)
+    assert replay.get_host('host000001', False).ok()
+    assert replay.get_host('host000002', False).res.status_code == 404
+    assert adapter.misses == 1
@@ -0,0 +1,63 @@
+import pytest
+import reconcile as r
+
+
+def write_inventory(path, inventory, folder: str) -> dict:
+    '''Desired inventory CSV of the mock hosts in folder, with one host left out (pruned), one tag changed, one host
+    moved and two new hosts. Returns the names of the edited hosts.'''
+    names = sorted(name for name, host in inventory.hosts.items() if host['folder'] == folder)
+    pruned, changed, moved = names[:3]
+    rows = ['host_name;folder;tag_group0']
+    for name in names[1:]:
+        value = inventory.hosts[name]['attributes'].get('tag_group0', '')
+        if name == changed:
+            value = 'value2' if value != 'value2' else 'value1'
+        rows.append(f'{name};{"/folder002" if name == moved else folder};{value}')
+    rows += [f'new1;{folder};value0', f'new2;{folder};']
+    path.write_text('\n'.join(rows) + '\n')
+    return {'pruned': pruned, 'changed': changed, 'moved': moved}
+
+
+def test_apply_is_idempotent(server, cmk, tmp_path):
+    inv = server.inventory
+    filename = tmp_path / 'cmdb.csv'
+    edited = write_inventory(filename, inv, '/folder000')
+    outside = {name for name, host in inv.hosts.items() if host['folder'] != '/folder000'}
+    desired = r.read_desired(str(filename))
+
+    plan = r.fetch_plan(cmk, desired, prune=True, scope='/folder000')
+    assert plan.summary() == {'create': 2, 'move': 1, 'update': 1, 'delete': 1, 'unchanged': len(desired) - 4}
+    results = list(r.apply(cmk, plan, chunk_size=2))
+    assert [(c.action, c.host) for c, _ in results] == [(c.action, c.host) for c in plan.changes()]
+    assert all(res.ok for _, res in results), results
+
+    assert edited['pruned'] not in inv.hosts
+    assert inv.hosts[edited['moved']]['folder'] == '/folder002'
+    assert inv.hosts[edited['changed']]['attributes']['tag_group0'] == desired[edited['changed']]['attributes']['tag_group0']
+    assert inv.hosts['new1'] == {'folder': '/folder000', 'attributes': {'tag_group0': 'value0'}}
+    assert outside <= inv.hosts.keys()
+
+    # The second run finds nothing to do
+    again = r.fetch_plan(cmk, desired, prune=True, scope='/folder000')
+    assert again.summary() == {'create': 0, 'move': 0, 'update': 0, 'delete': 0, 'unchanged': len(desired)}
+    assert list(r.apply(cmk, again)) == []
+
+
+def test_dry_run_sends_nothing(server, cmk, tmp_path):
+    filename = tmp_path / 'cmdb.csv'
+    write_inventory(filename, server.inventory, '/folder000')
+    before = {name: dict(host) for name, host in server.inventory.hosts.items()}
+    results = list(r.reconcile(cmk, str(filename), prune=True, scope='/folder000', send=False))
+    assert results and all(res.ok is None and res.detail == 'not sent' for _, res in results)
+    assert server.inventory.hosts == before
+
+
+def test_prune_needs_scope(server, cmk, tmp_path):
+    filename = tmp_path / 'cmdb.csv'
+    write_inventory(filename, server.inventory, '/folder000')
+    desired = r.read_desired(str(filename))
+    with pytest.raises(ValueError):
+        r.fetch_plan(cmk, desired, prune=True)
+    # Without prune nothing is deleted, / prunes every host that is not in the inventory
+    assert r.fetch_plan(cmk, desired).summary()['delete'] == 0
+    assert r.fetch_plan(cmk, desired, prune=True, scope='/').summary()['delete'] == len(server.inventory.hosts) - len(desired) + 2
@@ -0,0 +1,49 @@
+import pytest
+import checkutil as p
+from conftest import client, mock_server
+
+
+@pytest.fixture(scope='module')
+def server():
+    'The queries only read, they share one mock server'
+    yield from mock_server()
+
+
+@pytest.fixture(scope='module')
+def index(server):
+    return p.get_tag_index(client(server.url))
+
+
+def brute_force(inventory, match) -> list:
+    'Hosts of the mock inventory whose tag attributes satisfy match(tags)'
+    return sorted(name for name, host in inventory.hosts.items()
+                  if match({k: v for k, v in host['attributes'].items() if k.startswith('tag_')}))
+
+
+QUERIES = [
+    ('tag_group0=value1', lambda t: t.get('tag_group0') == 'value1'),
+    ('tag_group0!=value1', lambda t: t.get('tag_group0') != 'value1'),
+    ('tag_group2', lambda t: 'tag_group2' in t),
+    ('NOT tag_group2', lambda t: 'tag_group2' not in t),
+    ('tag_group0=value1 AND tag_group1=value2', lambda t: t.get('tag_group0') == 'value1' and t.get('tag_group1') == 'value2'),
+    ('tag_group0=value1 or tag_group1=value2 and tag_group2=value0',
+     lambda t: t.get('tag_group0') == 'value1' or (t.get('tag_group1') == 'value2' and t.get('tag_group2') == 'value0')),
+    ('(tag_group0=value1 OR tag_group1=value2) AND NOT tag_group2=value0',
+     lambda t: (t.get('tag_group0') == 'value1' or t.get('tag_group1') == 'value2') and t.get('tag_group2') != 'value0'),
+    ('tag_group0=nosuchvalue', lambda t: False),
+    ('NOT (tag_nosuchgroup)', lambda t: True),
+]
+
+
+@pytest.mark.parametrize('query,match', QUERIES, ids=[q for q, _ in QUERIES])
+def test_query_matches_brute_force(server, index, query, match):
+    expected = brute_force(server.inventory, match)
+    assert sorted(index.query(query)) == expected
+    assert index.count(query) == len(expected)
+
+
+@pytest.mark.parametrize('query', ['', 'tag_group0=', '(tag_group0', 'tag_group0)', 'AND tag_group0', 'tag_group0 OR',
+                                   '= value1', 'tag_group0=(value1)'])
+def test_invalid_query(query):
+    with pytest.raises(ValueError):
+        p.parse_tag_query(query)